@@ -0,0 +1,23 @@
+"""
+Benchmarks of invoicing.py.
+
+generate.py makes synthetic invoicing.db histories and PPMS inputs at a given scale
+and harness.py times each subcommand, and its phases, against them. Run from the
+main directory, e.g.:
+
+    python3 -m benchmarks.harness --users 50,1000 --years 2 --output bench.json
+    python3 -m benchmarks.harness --users 50 --compare bench.json
+
+startup.py checks that invoicing.py starts without importing its heavy modules:
+
+    python3 -m benchmarks.startup
+
+The invoicing modules live in the main directory so it is put on the path here.
+"""
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
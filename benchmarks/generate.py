@@ -0,0 +1,365 @@
+"""
+Generate a synthetic invoicing.db history and the PPMS inputs of the month that follows it.
+
+The history covers n_years years of months up to, but not including, the charged month
+(by default 202212). In each month a share of the users is invoiced for staff time on one or
+more of their projects and for consumables. The invoices of the history are sent and paid.
+Some users have bought credit that is used against their invoices.
+
+The PPMS inputs are a staff hours export per member of staff per year, with hours for every
+month of the history and the charged month, and a consumables export. Some of the projects of
+the charged month are new so that they are created by the run.
+
+Everything is generated from a seeded random.Random so the same arguments give the same data.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import random
+import re
+import sqlite3
+from benchmarks import REPO_DIR
+from migrations import migrate
+from rollups import rebuild_rollups
+
+STAFF = ["hume", "bell"]
+PROJECT_TYPES = ["wetlab", "bioinf", "training"]
+STAFF_HOURLY_RATE_EUR = 20
+SYLLABLES = [
+    "ba", "be", "bo", "ca", "co", "da", "de", "di", "fa", "fe", "ga", "go", "ha", "he", "ja", "ka", "ki",
+    "la", "le", "li", "lo", "ma", "me", "mi", "mo", "na", "ne", "no", "pa", "pe", "ra", "re", "ri", "ro",
+    "sa", "se", "so", "ta", "te", "to", "va", "ve", "wa", "ya", "yo", "za", "zu", "ster", "berg", "son"
+    ]
+WORDS = [
+    "genome", "assembly", "atlas", "zebrafish", "coral", "symbiont", "single", "cell", "rna", "seq", "long", "read",
+    "methylation", "microbiome", "soil", "marine", "plankton", "metagenome", "phylogeny", "population", "variant",
+    "calling", "transcriptome", "proteome", "course", "workshop", "pipeline", "annotation", "mouse", "yeast",
+    "bacteria", "virus", "evolution", "development", "regeneration", "stress", "heat", "tolerance", "coastal", "reef"
+    ]
+CONSUMABLES = [
+    ("Library prep kit", 450.0), ("Flow cell", 900.0), ("Sequencing run", 1200.0), ("Qubit assay", 35.5),
+    ("Bioanalyzer chip", 60.0), ("Extraction kit", 210.0), ("Barcoding kit", 640.0), ("Cleanup beads", 95.25)
+    ]
+
+
+# The tables of db_structure.txt that are made by the migrations
+MIGRATION_TABLES = ["user_credit_balances", "invoice_documents", "monthly_rollups"]
+
+
+def make_db(db_path):
+    """
+    Make an empty invoicing.db from the tables of db_structure.txt at the latest schema version.
+    """
+    with open(os.path.join(REPO_DIR, "db_structure.txt")) as f:
+        statements = re.findall(r"CREATE TABLE.*?\n\s*\);", f.read(), re.S)
+    con = sqlite3.connect(db_path, isolation_level=None)
+    for statement in statements:
+        # These tables (and the triggers of user_credit_balances) are made by the migrations
+        if not any(_ in statement for _ in MIGRATION_TABLES):
+            con.execute(statement)
+    migrate(con, verbose=False)
+    return con
+
+
+def _months(first_month, n_months):
+    year, month = divmod(first_month, 100)
+    months = []
+    for _ in range(n_months):
+        months.append(year*100 + month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _unique(rng, make, seen):
+    while True:
+        value = make(rng)
+        if value not in seen:
+            seen.add(value)
+            return value
+
+
+def generate(out_dir, n_users, n_years=2, charged_month=202212, seed=0, active_share=0.3):
+    """
+    Write invoicing.db, the PPMS inputs, the invoice templates and a credit invoice input to out_dir.
+    Returns a dict describing what was generated, including the arguments of the
+    create_invoices run that charges the month.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    db_path = os.path.join(out_dir, "invoicing.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    con = make_db(db_path)
+
+    charged_year = charged_month // 100
+    months = _months((charged_year - n_years + 1)*100 + 1, n_years*12)
+    history_months = [_ for _ in months if _ < charged_month]
+
+    # create_invoices finds the projects of a user by their last name being in the project name
+    # so no last name is made that is part of another. As only their first letter is upper case,
+    # one name can only be part of another if it is a prefix of it.
+    seen_names = set()
+    seen_prefixes = set()
+    users = []
+    for user_id in range(1, n_users + 1):
+        while True:
+            last_name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+            if last_name not in seen_prefixes and not any(last_name[:i] in seen_names for i in range(1, len(last_name) + 1)):
+                break
+        seen_names.add(last_name)
+        seen_prefixes.update(last_name[:i] for i in range(1, len(last_name)))
+        users.append({
+            "user_id": user_id, "email": f"{last_name.lower()}@example.org", "first_name": rng.choice(["Ann", "Bob", "Chen", "Dara", "Eli"]),
+            "last_name": last_name, "staff_subsidy_percent": rng.choice([0, 0, 10, 25, 50]),
+            "consumable_subsidy_percent": rng.choice([0, 0, 0, 50])
+            })
+
+    # Each user has a handful of projects. Some of them only appear in the charged month (new projects).
+    # As in the db, project titles are unique.
+    projects = []
+    new_projects = []
+    seen_titles = set()
+    for user in users:
+        for _ in range(rng.randint(1, 4)):
+            project = {
+                "project_id": len(projects) + len(new_projects) + 1, "user_id": user["user_id"],
+                "project_type": rng.choice(PROJECT_TYPES),
+                "project_title": _unique(rng, lambda r: " ".join(r.choice(WORDS) for _ in range(r.randint(3, 5))).capitalize(), seen_titles)
+                }
+            (new_projects if rng.random() < 0.1 else projects).append(project)
+    new_project_ids = {_["project_id"] for _ in new_projects}
+    users_by_id = {_["user_id"]: _ for _ in users}
+    projects_by_id = {_["project_id"]: _ for _ in projects + new_projects}
+    projects_of_user = {}
+    for project in projects + new_projects:
+        projects_of_user.setdefault(project["user_id"], []).append(project)
+
+    # Staff hours of every (project, month). The history months are also charged in the db.
+    hours = {}
+    for month in months:
+        for user in users:
+            if rng.random() >= (active_share if month != charged_month else max(active_share, 0.5)):
+                continue
+            for project in projects_of_user.get(user["user_id"], []):
+                if project["project_id"] in new_project_ids and month != charged_month:
+                    continue
+                if rng.random() < 0.6:
+                    for staff in STAFF:
+                        if rng.random() < 0.7:
+                            hours[(staff, project["project_id"], month)] = round(rng.uniform(0.25, 12), 2)
+
+    # Consumables are only charged to projects with staff hours in the same month as
+    # create_invoices does not allow an invoice of only consumables
+    charged_projects = {}
+    for staff, project_id, month in hours:
+        charged_projects.setdefault(month, set()).add(project_id)
+    consumables = []
+    for month in months:
+        for project_id in sorted(charged_projects.get(month, ())):
+            if rng.random() >= 0.3:
+                continue
+            project = projects_by_id[project_id]
+            name, unit_cost = rng.choice(CONSUMABLES)
+            consumables.append({
+                "project": project, "name": name, "unit_cost": unit_cost, "quantity": rng.randint(1, 4),
+                "reference": f"R{len(consumables) + 1}", "date": f"{rng.randint(1, 28):02d}/{month % 100:02d}/{month // 100} 10:00",
+                "month": month
+                })
+
+    con.execute("BEGIN")
+    con.executemany(
+        "INSERT INTO users (user_id, email, first_name, last_name, staff_subsidy_percent, consumable_subsidy_percent) \
+            VALUES (:user_id, :email, :first_name, :last_name, :staff_subsidy_percent, :consumable_subsidy_percent)",
+        users
+        )
+    con.executemany(
+        "INSERT INTO projects (project_id, project_type, project_title, user_id) VALUES (:project_id, :project_type, :project_title, :user_id)",
+        projects
+        )
+
+    # Paid credit invoices at the start of the history
+    credit = {}
+    for user in users:
+        if rng.random() < 0.2:
+            amount = float(rng.choice([500, 1000, 2000]))
+            credit[user["user_id"]] = amount
+            con.execute(
+                "INSERT INTO invoices (invoice_timestamp, first_month, last_month, chargeable_account, reference_text, user_id, invoice_type, amount_payable, sent, paid) \
+                    VALUES (:invoice_timestamp, :month, :month, 1, :reference_text, :user_id, 'credit', :amount, 1, 1)",
+                {"invoice_timestamp": f"{str(months[0])[:4]}-{str(months[0])[4:]}-01 09:00:00", "month": str(months[0]),
+                 "reference_text": f"SequAna credit; {user['last_name']}", "user_id": user["user_id"], "amount": amount}
+                )
+
+    # A sent and paid debit invoice per user per month of the history in which they were charged
+    staff_hours_of_invoice = {}
+    for (staff, project_id, month), project_hours in hours.items():
+        if month < charged_month:
+            key = (projects_by_id[project_id]["user_id"], month)
+            staff_hours_of_invoice.setdefault(key, {}).setdefault(project_id, 0)
+            staff_hours_of_invoice[key][project_id] += project_hours
+    consumables_of_invoice = {}
+    for consumable in consumables:
+        if consumable["month"] < charged_month:
+            consumables_of_invoice.setdefault((consumable["project"]["user_id"], consumable["month"]), []).append(consumable)
+
+    n_history_invoices = 0
+    for user_id, month in sorted(set(staff_hours_of_invoice) | set(consumables_of_invoice), key=lambda _: (_[1], _[0])):
+        user = users_by_id[user_id]
+        cur = con.execute(
+            "INSERT INTO invoices (invoice_timestamp, first_month, last_month, chargeable_account, user_id, sent, paid) \
+                VALUES (:invoice_timestamp, :month, :month, 1, :user_id, 1, 1)",
+            {"invoice_timestamp": f"{str(month)[:4]}-{str(month)[4:]}-28 12:00:00", "month": str(month), "user_id": user_id}
+            )
+        invoice_id = cur.lastrowid
+        n_history_invoices += 1
+        balance = 0.0
+        for project_id, project_hours in staff_hours_of_invoice.get((user_id, month), {}).items():
+            con.execute(
+                "INSERT INTO staff_time_charges (staff_hours, staff_hourly_rate_eur, subsidy_percent, invoice_id, project_id) \
+                    VALUES (:staff_hours, :staff_hourly_rate_eur, :subsidy_percent, :invoice_id, :project_id)",
+                {"staff_hours": project_hours, "staff_hourly_rate_eur": STAFF_HOURLY_RATE_EUR,
+                 "subsidy_percent": user["staff_subsidy_percent"], "invoice_id": invoice_id, "project_id": project_id}
+                )
+            balance += project_hours * STAFF_HOURLY_RATE_EUR * (1 - user["staff_subsidy_percent"]/100)
+        for consumable in consumables_of_invoice.get((user_id, month), []):
+            con.execute(
+                "INSERT INTO consumable_charges (name, unit_cost, quantity, subsidy_percent, date, invoice_id, project_id, PPMS_reference) \
+                    VALUES (:name, :unit_cost, :quantity, :subsidy_percent, :date, :invoice_id, :project_id, :PPMS_reference)",
+                {"name": consumable["name"], "unit_cost": consumable["unit_cost"], "quantity": consumable["quantity"],
+                 "subsidy_percent": user["consumable_subsidy_percent"], "date": consumable["date"], "invoice_id": invoice_id,
+                 "project_id": consumable["project"]["project_id"], "PPMS_reference": consumable["reference"]}
+                )
+            balance += consumable["unit_cost"] * consumable["quantity"] * (1 - user["consumable_subsidy_percent"]/100)
+        credit_used = min(balance, credit.get(user_id, 0.0))
+        if credit_used > 0:
+            credit[user_id] -= credit_used
+            con.execute(
+                "INSERT INTO credit_debit (amount, debit_invoice_id, user_id) VALUES (:amount, :invoice_id, :user_id)",
+                {"amount": credit_used, "invoice_id": invoice_id, "user_id": user_id}
+                )
+        con.execute(
+            "UPDATE invoices SET amount_payable=:amount_payable WHERE invoice_id=:invoice_id",
+            {"amount_payable": balance - credit_used, "invoice_id": invoice_id}
+            )
+    # The history is inserted directly so its rollups are made here rather than by the runs
+    rebuild_rollups(con)
+    con.execute("COMMIT")
+    con.close()
+
+    # The PPMS staff hours exports. One per member of staff per year.
+    staff_hours_csvs = []
+    month_names = [datetime.date(2000, _, 1).strftime("%B") for _ in range(1, 13)]
+    for year in sorted({_ // 100 for _ in months}):
+        for staff in STAFF:
+            path = os.path.join(out_dir, f"{year}_{staff}.csv")
+            with open(path, "w", newline="", encoding="ISO-8859-1") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Project", "Type"] + month_names + [f"{year} Total"])
+                for project in projects + new_projects:
+                    row = [hours.get((staff, project["project_id"], year*100 + _), 0) for _ in range(1, 13)]
+                    if any(row):
+                        project_name = f"{users_by_id[project['user_id']]['last_name']}_{project['project_type']}: {project['project_title']}"
+                        writer.writerow([project_name, "Staff time"] + row + [round(sum(row), 2)])
+                # SequAna's own projects are in the exports but are never charged
+                writer.writerow(["SequAna_wetlab: Internal development", "Staff time"] + [1]*12 + [12])
+            staff_hours_csvs.append(path)
+
+    consumables_csv = os.path.join(out_dir, "consumables.csv")
+    with open(consumables_csv, "w", newline="", encoding="ISO-8859-1") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Group", "User", "Project name", "Consumable name", "Unit price", "Quantity", "Ref.", "Completed date"])
+        for consumable in consumables:
+            project = consumable["project"]
+            project_name = f"{users_by_id[project['user_id']]['last_name']}_{project['project_type']}: {project['project_title']}"
+            writer.writerow([
+                "Group", "PPMS user", project_name, consumable["name"], consumable["unit_cost"],
+                consumable["quantity"], consumable["reference"], consumable["date"]
+                ])
+
+    template, credit_template = write_templates(out_dir)
+
+    # The runs are unattended. Similar names are expected in random data and new projects are created.
+    decisions_csv = os.path.join(out_dir, "decisions.csv")
+    with open(decisions_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["decision", "subject", "answer"])
+        writer.writerows([["similar_name", "*", "y"], ["new_project", "*", "y"], ["overwrite", "*", "y"]])
+
+    # Credit invoices for a share of the users
+    credit_input_csv = os.path.join(out_dir, "credit_invoices_input.csv")
+    with open(credit_input_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["user_email", "amount_payable"])
+        for user in users:
+            if rng.random() < 0.1:
+                writer.writerow([user["email"], rng.choice([500, 1000])])
+
+    return {
+        "n_users": n_users, "n_years": n_years, "charged_month": charged_month, "seed": seed,
+        "n_projects": len(projects), "n_new_projects": len(new_projects), "n_history_invoices": n_history_invoices,
+        "n_staff_hours_cells": len(hours), "n_consumables": len(consumables),
+        "staff_hours_csvs": staff_hours_csvs, "consumables_csv": consumables_csv, "template": template,
+        "credit_template": credit_template, "credit_input_csv": credit_input_csv, "decisions_csv": decisions_csv,
+        }
+
+
+def write_templates(out_dir):
+    """
+    Write a standard and a credit invoice template that use every field of the invoice contexts.
+    Returns their paths.
+    """
+    from docx import Document
+    template = os.path.join(out_dir, "benchmark_sequana_invoice_template.docx")
+    doc = Document()
+    doc.add_paragraph("Invoice {{ invoice_id }} {{ invoice_date }} {{ invoice_period }} {{ chargeable_account }}")
+    doc.add_paragraph("{{ user_name }} {{ user_email }}")
+    for project_type in PROJECT_TYPES:
+        doc.add_paragraph("{%p for p in " + project_type + "_projects %}")
+        doc.add_paragraph("{{ p.project_title }} {{ p.staff_hours }} {{ p.staff_hourly_rate_eur }} {{ p.staff_cost }} {{ p.subsidy }} {{ p.subtotal }}")
+        doc.add_paragraph("{%p endfor %}")
+    doc.add_paragraph("{%p for c in consumables %}")
+    doc.add_paragraph("{{ c.name }} {{ c.quantity }} {{ c.unit_cost }} {{ c.cost }} {{ c.subsidy }} {{ c.subtotal }}")
+    doc.add_paragraph("{%p endfor %}")
+    doc.add_paragraph("{{ total_staff_hours }} {{ total_staff_cost }} {{ total_subsidy_amount }} {{ amount_payable_staff }}")
+    doc.add_paragraph("{{ total_consumables_cost }} {{ total_consumables_subsidy }} {{ total_consumables_amount_payable }}")
+    doc.add_paragraph("{{ user_balance.starting_available_credit }} {{ user_balance.applied_available_credit }} {{ user_balance.closing_available_credit }} {{ balance }}")
+    doc.save(template)
+
+    credit_template = os.path.join(out_dir, "benchmark_sequana_credit_invoice_template.docx")
+    doc = Document()
+    doc.add_paragraph("Credit invoice {{ invoice_id }} {{ invoice_date }} {{ chargeable_account }}")
+    doc.add_paragraph("{{ user_name }} {{ user_email }} {{ amount }}")
+    doc.save(credit_template)
+    return template, credit_template
+
+
+def write_invoices_input(db_path, path, first_month, last_month):
+    """
+    Write the input of set_invoices_sent / set_invoices_paid for the debit invoices of a charging period.
+    """
+    con = sqlite3.connect(db_path)
+    rows = con.execute(
+        "SELECT users.email, invoices.amount_payable, invoices.invoice_id FROM invoices INNER JOIN users ON users.user_id = invoices.user_id \
+            WHERE invoice_type='debit' AND first_month >=:first_month AND first_month <= :last_month",
+        {"first_month": str(first_month), "last_month": str(last_month)}
+        ).fetchall()
+    con.close()
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["user_email", "amount_payable", "invoice_id"])
+        writer.writerows(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic invoicing.db history and PPMS inputs.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--charged_month", type=int, default=202212)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for key, value in generate(args.out_dir, args.users, n_years=args.years, charged_month=args.charged_month, seed=args.seed).items():
+        print(f"{key}\t{value}")
@@ -0,0 +1,225 @@
+"""
+Time the subcommands of invoicing.py, and their phases, against synthetic data.
+
+For each scale (number of users) a history is generated (see generate.py) and the
+following cases are run in order, in process and unattended (answered by a decisions file):
+    create_invoices           the charged month, one user at a time
+    create_invoices_rerun     the same run again, where no invoice has changed
+    create_invoices_batch     the same run with --batch, on a fresh copy of the data
+    create_credit_invoices    on the db left by create_invoices
+    set_invoices_sent         the invoices made by create_invoices
+    set_invoices_paid         the same invoices
+    report                    all of the finance reports, from the monthly_rollups
+
+The phases are timed by wrapping methods of Invoicing (see PHASES). The results are written
+as JSON so that the runs of different versions can be compared with --compare.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from benchmarks import REPO_DIR
+from benchmarks.generate import generate, write_invoices_input
+
+# The methods of Invoicing that are timed as phases
+PHASES = [
+    "_init_db", "_do_argument_qc", "_resolve_decisions", "_make_consumable_charges", "_make_user_invoices",
+    "_make_user_invoices_batch", "_populate_and_write_invoices", "_render_queued_templates", "_make_credit_invoices",
+    "_check_staged_invoices", "_set_staged_invoices_status", "_refresh_rollups", "_report", "_back_up_db", "_output_xlsx_of_database",
+    ]
+
+
+class PhaseTimer:
+    def __init__(self):
+        # phase to [calls, seconds]
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def instrument(self, cls, phases=PHASES):
+        """
+        Wrap the phase methods of cls so that their calls are timed. The methods are restored on exit.
+        Nested calls of the same phase are only timed once.
+        """
+        originals = {_: getattr(cls, _) for _ in phases if hasattr(cls, _)}
+        for name, method in originals.items():
+            setattr(cls, name, self._timed(name, method))
+        try:
+            yield self
+        finally:
+            for name, method in originals.items():
+                setattr(cls, name, method)
+
+    def _timed(self, name, method):
+        active = []
+
+        def timed(*args, **kwargs):
+            if active:
+                return method(*args, **kwargs)
+            active.append(name)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                calls_seconds = self.phases.setdefault(name, [0, 0.0])
+                calls_seconds[0] += 1
+                calls_seconds[1] += time.perf_counter() - start
+                active.pop()
+        return timed
+
+    def results(self):
+        return {name: {"calls": calls, "seconds": round(seconds, 6)} for name, (calls, seconds) in self.phases.items()}
+
+
+def run_subcommand(work_dir, args, log_path):
+    """
+    Run invoicing.py with args in work_dir, in this process, with stdin empty and stdout
+    and stderr written to log_path. Returns the wall time, status and phase timings of the run.
+    """
+    from invoicing import Invoicing
+    timer = PhaseTimer()
+    cwd, argv, stdin = os.getcwd(), sys.argv, sys.stdin
+    os.chdir(work_dir)
+    sys.argv = ["invoicing.py"] + args
+    # The runs are answered by a decisions file. Any question that is asked instead ends the run
+    sys.stdin = io.StringIO("")
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log), timer.instrument(Invoicing):
+            try:
+                Invoicing()
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    status = f"exit: {e.code}"
+            except Exception as e:
+                traceback.print_exc()
+                status = f"error: {type(e).__name__}: {e}"
+    finally:
+        wall_seconds = time.perf_counter() - start
+        os.chdir(cwd)
+        sys.argv, sys.stdin = argv, stdin
+    return {"wall_seconds": round(wall_seconds, 6), "status": status, "phases": timer.results()}
+
+
+def run_scale(base_dir, n_users, n_years, seed, workers):
+    """
+    Generate the data for a scale and run each case against it. Returns the results of the cases.
+    """
+    scale_dir = os.path.join(base_dir, f"{n_users}_users")
+    data_dir = os.path.join(scale_dir, "data")
+    start = time.perf_counter()
+    data = generate(data_dir, n_users, n_years=n_years, seed=seed)
+    data["generate_seconds"] = round(time.perf_counter() - start, 6)
+
+    month = str(data["charged_month"])
+    create_invoices_args = [
+        "create_invoices", "--first_month", month, "--last_month", month,
+        "--PPMS_input_staff_hours_csvs", ",".join(data["staff_hours_csvs"]),
+        "--PPMS_input_consumables_csv", data["consumables_csv"], "--template", data["template"],
+        "--decisions", data["decisions_csv"], "--workers", str(workers),
+        ]
+    serial_dir = os.path.join(scale_dir, "serial")
+    batch_dir = os.path.join(scale_dir, "batch")
+    for work_dir in (serial_dir, batch_dir):
+        os.makedirs(work_dir)
+        shutil.copy(os.path.join(data_dir, "invoicing.db"), work_dir)
+
+    cases = [
+        ("create_invoices", serial_dir, create_invoices_args + ["--output_dir", "invoices", "--db_backup_dir", "db_backup_create_invoices"]),
+        ("create_invoices_rerun", serial_dir, create_invoices_args + ["--output_dir", "invoices", "--db_backup_dir", "db_backup_create_invoices"]),
+        ("create_invoices_batch", batch_dir, create_invoices_args + ["--batch", "--output_dir", "invoices", "--db_backup_dir", "db_backup_create_invoices"]),
+        ("create_credit_invoices", serial_dir, [
+            "create_credit_invoices", "--input", data["credit_input_csv"], "--template", data["credit_template"],
+            "--output_dir", "credit_invoices", "--decisions", data["decisions_csv"], "--workers", str(workers), "--db_backup_dir", "db_backup_create_credit_invoices"
+            ]),
+        ("set_invoices_sent", serial_dir, ["set_invoices_sent", "--input", "invoices_input.csv", "--db_backup_dir", "db_backup_set_invoices_sent"]),
+        ("set_invoices_paid", serial_dir, ["set_invoices_paid", "--input", "invoices_input.csv", "--db_backup_dir", "db_backup_set_invoices_paid"]),
+        ("report", serial_dir, ["report"]),
+        ]
+    results = []
+    for case, work_dir, args in cases:
+        if case == "create_credit_invoices":
+            os.makedirs(os.path.join(work_dir, "credit_invoices"), exist_ok=True)
+        if case == "set_invoices_sent":
+            write_invoices_input(os.path.join(work_dir, "invoicing.db"), os.path.join(work_dir, "invoices_input.csv"), month, month)
+        for backup_dir in [_ for _ in args if _.startswith("db_backup_")]:
+            # Only create_invoices makes its db_backup directory
+            os.makedirs(os.path.join(work_dir, backup_dir), exist_ok=True)
+        result = run_subcommand(work_dir, args, os.path.join(work_dir, f"{case}.log"))
+        results.append({"case": case, "n_users": n_users, "n_years": n_years, "args": args, **result})
+        print(f"{n_users}\t{case}\t{result['wall_seconds']:.3f}\t{result['status']}")
+    return data, results
+
+
+def _version():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform()}
+
+
+def compare(previous, current):
+    """
+    Print the wall time of each case and phase of current against those of previous.
+    """
+    print("\nn_users\tcase\tphase\tprevious_seconds\tcurrent_seconds\tratio")
+    previous_results = {(_["n_users"], _["case"]): _ for _ in previous["results"]}
+    for result in current["results"]:
+        old = previous_results.get((result["n_users"], result["case"]))
+        if old is None:
+            continue
+        rows = [("total", old["wall_seconds"], result["wall_seconds"])]
+        rows.extend(
+            (phase, old["phases"][phase]["seconds"], timing["seconds"])
+            for phase, timing in result["phases"].items() if phase in old["phases"]
+            )
+        for phase, old_seconds, new_seconds in rows:
+            ratio = f"{new_seconds / old_seconds:.2f}" if old_seconds else "-"
+            print(f"{result['n_users']}\t{result['case']}\t{phase}\t{old_seconds:.3f}\t{new_seconds:.3f}\t{ratio}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subcommands of invoicing.py against synthetic data.")
+    parser.add_argument("--users", default="50", help="Comma separated list of the numbers of users to benchmark. E.g. 50,1000,10000")
+    parser.add_argument("--years", type=int, default=2, help="The number of years of history in the db and the PPMS inputs. Default: 2")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="Passed to --workers of the subcommands that render documents. Default: 1")
+    parser.add_argument("--output", default="bench_output.json", help="The .json file the results are written to. Default: bench_output.json")
+    parser.add_argument("--work_dir", default=None, help="Optional. The directory the data and outputs are kept in. By default a temporary directory that is removed.")
+    parser.add_argument("--compare", default=None, help="Optional. A .json file of earlier results to compare against.")
+    args = parser.parse_args()
+
+    base_dir = args.work_dir or tempfile.mkdtemp(prefix="invoicing_bench_")
+    try:
+        report = {"created": datetime.datetime.now().isoformat(), "version": _version(), "datasets": [], "results": []}
+        print("n_users\tcase\twall_seconds\tstatus")
+        for n_users in [int(_) for _ in args.users.split(",")]:
+            data, results = run_scale(base_dir, n_users, args.years, args.seed, args.workers)
+            report["datasets"].append({k: v for k, v in data.items() if not isinstance(v, (str, list))})
+            report["results"].extend(results)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Check the startup time of invoicing.py.
+
+invoicing.py only imports the heavy modules (pandas, docxtpl, openpyxl, ...) in the
+methods that need them. Each case below is run in a fresh interpreter with
+-X importtime and fails if any of HEAVY_MODULES is imported or if the total import
+time is over the budget. The exit status is 1 if any case fails so that the check can
+be run after each change, e.g.:
+
+    python3 -m benchmarks.startup
+    python3 -m benchmarks.startup --budget_ms 150
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import REPO_DIR
+from benchmarks.generate import make_db
+
+DEFAULT_BUDGET_MS = 250
+HEAVY_MODULES = ["pandas", "numpy", "docxtpl", "docx", "jinja2", "lxml", "openpyxl", "yaml"]
+
+# (case, arguments, stdin) of the runs that are checked. make_new_user is answered on stdin
+CASES = [
+    ("help", ["-h"], ""),
+    ("create_invoices_help", ["create_invoices", "-h"], ""),
+    ("make_new_user", ["make_new_user"], "Doe\nJane\njane.doe@example.org\n0.5\n0\ny\n"),
+    ]
+
+
+def parse_importtime(stderr):
+    """
+    Returns the total import time in seconds and the set of the top level packages imported
+    from the -X importtime output in stderr.
+    """
+    total_us = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            # The header line
+            continue
+        # Nested imports are indented and are already part of the cumulative time of their parent
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative_us)
+        packages.add(name.strip().split(".")[0])
+    return total_us / 1e6, packages
+
+
+def run_case(args, stdin, work_dir):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.join(REPO_DIR, "invoicing.py")] + args,
+        input=stdin, capture_output=True, text=True, cwd=work_dir
+        )
+    wall_seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"invoicing.py {' '.join(args)} exited with {result.returncode}:\n{result.stdout}{result.stderr}")
+    import_seconds, packages = parse_importtime(result.stderr)
+    return wall_seconds, import_seconds, sorted(packages.intersection(HEAVY_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that invoicing.py starts without importing its heavy modules.")
+    parser.add_argument("--budget_ms", type=int, default=DEFAULT_BUDGET_MS, help=f"The import time budget of each case in ms. Default: {DEFAULT_BUDGET_MS}")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="invoicing_startup_") as work_dir:
+        # make_new_user needs an invoicing.db to add the user to
+        make_db(os.path.join(work_dir, "invoicing.db")).close()
+        print("case\twall_seconds\timport_seconds\theavy_modules\tresult")
+        for case, case_args, stdin in CASES:
+            wall_seconds, import_seconds, heavy_modules = run_case(case_args, stdin, work_dir)
+            ok = not heavy_modules and import_seconds * 1000 <= args.budget_ms
+            failed = failed or not ok
+            print(f"{case}\t{wall_seconds:.3f}\t{import_seconds:.3f}\t{','.join(heavy_modules) or '-'}\t{'ok' if ok else 'FAIL'}")
+    if failed:
+        sys.exit(f"invoicing.py is over its startup budget of {args.budget_ms} ms or imports a heavy module at startup.")
+
+
+if __name__ == "__main__":
+    main()
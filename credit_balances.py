@@ -0,0 +1,46 @@
+"""
+Verification of the user_credit_balances ledger.
+
+The ledger is maintained by triggers on the invoices and credit_debit tables
+(see migrations.py). Here the balances are recomputed from scratch and compared
+to the ledger so that any drift can be reported and, if requested, repaired.
+"""
+
+import sqlite3
+
+# Differences smaller than this (in EUR) are floating point noise rather than drift.
+TOLERANCE = 0.005
+
+RECOMPUTE_SQL = """
+    SELECT user_id, SUM(total_credit), SUM(total_debit) FROM (
+        SELECT user_id, amount_payable AS total_credit, 0 AS total_debit FROM invoices WHERE invoice_type='credit' AND sent=1 AND paid=1
+        UNION ALL
+        SELECT user_id, 0 AS total_credit, amount AS total_debit FROM credit_debit
+        ) GROUP BY user_id
+    """
+
+
+def find_credit_balance_drift(con):
+    """
+    Returns a list of (user_id, ledger_credit, ledger_debit, recomputed_credit, recomputed_debit)
+    for each user whose ledger entry does not match the balances recomputed from scratch.
+    """
+    con: sqlite3.Connection
+    recomputed = {user_id: (credit, debit) for user_id, credit, debit in con.execute(RECOMPUTE_SQL).fetchall()}
+    ledger = {user_id: (credit, debit) for user_id, credit, debit in con.execute("SELECT user_id, total_credit, total_debit FROM user_credit_balances").fetchall()}
+    drift = []
+    for user_id in sorted(set(recomputed) | set(ledger)):
+        ledger_credit, ledger_debit = ledger.get(user_id, (0.0, 0.0))
+        recomputed_credit, recomputed_debit = recomputed.get(user_id, (0.0, 0.0))
+        if abs(ledger_credit - recomputed_credit) > TOLERANCE or abs(ledger_debit - recomputed_debit) > TOLERANCE:
+            drift.append((user_id, ledger_credit, ledger_debit, recomputed_credit, recomputed_debit))
+    return drift
+
+
+def rebuild_credit_balances(con):
+    """
+    Replace the contents of the ledger with the balances recomputed from scratch.
+    Must be called inside a transaction.
+    """
+    con.execute("DELETE FROM user_credit_balances")
+    con.execute(f"INSERT INTO user_credit_balances (user_id, total_credit, total_debit) {RECOMPUTE_SQL}")
@@ -0,0 +1,168 @@
+"""
+Online, compressed and deduplicated backups of the invoicing database.
+
+Snapshots are taken with the sqlite online backup API, a few pages at a time,
+so they are consistent even if another connection is writing to the database.
+Each snapshot is gzip compressed and stored under the sha256 of its content in
+the objects directory of the backup directory. Identical snapshots are
+therefore only stored once. The list of snapshots is kept in snapshots.tsv
+as one timestamp and content hash per line.
+
+A retention policy prunes the list of snapshots. The most recent snapshots are always
+kept, as is the latest snapshot of each of the most recent days and months.
+Objects that are no longer referenced by any snapshot are deleted.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+
+SNAPSHOT_INDEX = "snapshots.tsv"
+OBJECTS_DIR = "objects"
+
+# The number of pages copied per step of the online backup
+# and the seconds slept between steps to let other connections in.
+PAGES_PER_STEP = 256
+STEP_SLEEP = 0.005
+
+# Retention policy defaults. None means no limit.
+KEEP_LAST = 10
+KEEP_DAILY = 31
+KEEP_MONTHLY = None
+
+
+def backup_db(db_path, backup_dir, timestamp, pages_per_step=PAGES_PER_STEP):
+    """
+    Take a snapshot of the database at db_path and store it in backup_dir under timestamp.
+    timestamp must be in the format YYYYMMDDTHHMMSS.
+    Returns the sha256 of the snapshot.
+    """
+    objects_dir = os.path.join(backup_dir, OBJECTS_DIR)
+    os.makedirs(objects_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=backup_dir) as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "snapshot.db")
+        src = sqlite3.connect(db_path)
+        dst = sqlite3.connect(snapshot_path)
+        try:
+            src.backup(dst, pages=pages_per_step, sleep=STEP_SLEEP)
+        finally:
+            dst.close()
+            src.close()
+
+        snapshot_hash = _sha256_of_file(snapshot_path)
+        object_path = _object_path(backup_dir, snapshot_hash)
+        if os.path.exists(object_path):
+            print(f"An identical snapshot is already stored as {object_path}.")
+        else:
+            tmp_object_path = os.path.join(tmp_dir, "snapshot.db.gz")
+            with open(snapshot_path, "rb") as f_in, open(tmp_object_path, "wb") as f_out:
+                # mtime=0 so that the compressed object only depends on the snapshot content
+                with gzip.GzipFile(filename="", mode="wb", fileobj=f_out, mtime=0) as gz:
+                    shutil.copyfileobj(f_in, gz)
+            os.replace(tmp_object_path, object_path)
+
+    snapshots = read_snapshot_index(backup_dir)
+    snapshots.append((timestamp, snapshot_hash))
+    _write_snapshot_index(backup_dir, snapshots)
+    return snapshot_hash
+
+
+def restore_backup(db_path, backup_dir, snapshot=None, pages_per_step=PAGES_PER_STEP):
+    """
+    Restore the snapshot identified by snapshot (a timestamp or a prefix of its sha256) to db_path.
+    If snapshot is None, the most recent snapshot is restored.
+    The restore is made with the online backup API so that other connections see either the old or the restored database.
+    Returns the (timestamp, sha256) of the restored snapshot.
+    """
+    timestamp, snapshot_hash = find_snapshot(backup_dir, snapshot)
+    with tempfile.TemporaryDirectory(dir=backup_dir) as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "snapshot.db")
+        with gzip.open(_object_path(backup_dir, snapshot_hash), "rb") as f_in, open(snapshot_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        if _sha256_of_file(snapshot_path) != snapshot_hash:
+            raise RuntimeError(f"The stored snapshot {snapshot_hash} is corrupt. It has not been restored.")
+        src = sqlite3.connect(snapshot_path)
+        dst = sqlite3.connect(db_path)
+        try:
+            src.backup(dst, pages=pages_per_step, sleep=STEP_SLEEP)
+        finally:
+            dst.close()
+            src.close()
+    return timestamp, snapshot_hash
+
+
+def find_snapshot(backup_dir, snapshot=None):
+    snapshots = read_snapshot_index(backup_dir)
+    if not snapshots:
+        raise FileNotFoundError(f"No snapshots found in {backup_dir}.")
+    if snapshot is None:
+        return snapshots[-1]
+    matches = [_ for _ in snapshots if _[0] == snapshot or _[1].startswith(snapshot)]
+    if not matches:
+        raise ValueError(f"No snapshot in {backup_dir} matches {snapshot}.")
+    if len({_[1] for _ in matches}) > 1:
+        raise ValueError(f"{snapshot} matches more than one snapshot: {matches}")
+    return matches[-1]
+
+
+def prune_backups(backup_dir, keep_last=KEEP_LAST, keep_daily=KEEP_DAILY, keep_monthly=KEEP_MONTHLY):
+    """
+    Apply the retention policy to the snapshots in backup_dir.
+    Keeps the keep_last most recent snapshots and the latest snapshot of each of the
+    keep_daily most recent days and the keep_monthly most recent months.
+    Returns the list of (timestamp, sha256) of the snapshots that were removed.
+    """
+    snapshots = sorted(read_snapshot_index(backup_dir))
+    keep = set(snapshots[-keep_last:]) if keep_last else set()
+    # Snapshot timestamps are YYYYMMDDTHHMMSS so the day and month are prefixes
+    for prefix_length, keep_n in ((8, keep_daily), (6, keep_monthly)):
+        latest_per_period = {}
+        for snapshot in snapshots:
+            latest_per_period[snapshot[0][:prefix_length]] = snapshot
+        periods = sorted(latest_per_period)
+        if keep_n is not None:
+            periods = periods[-keep_n:] if keep_n else []
+        keep.update(latest_per_period[_] for _ in periods)
+
+    removed = [_ for _ in snapshots if _ not in keep]
+    if removed:
+        _write_snapshot_index(backup_dir, [_ for _ in snapshots if _ in keep])
+        referenced_hashes = {_[1] for _ in keep}
+        for snapshot_hash in {_[1] for _ in removed} - referenced_hashes:
+            os.remove(_object_path(backup_dir, snapshot_hash))
+    return removed
+
+
+def read_snapshot_index(backup_dir):
+    """
+    Returns the list of (timestamp, sha256) of the snapshots in backup_dir in the order they were taken.
+    """
+    index_path = os.path.join(backup_dir, SNAPSHOT_INDEX)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as f:
+        return [tuple(line.rstrip("\n").split("\t")) for line in f if line.strip()]
+
+
+def _write_snapshot_index(backup_dir, snapshots):
+    index_path = os.path.join(backup_dir, SNAPSHOT_INDEX)
+    tmp_index_path = f"{index_path}.tmp"
+    with open(tmp_index_path, "w") as f:
+        for timestamp, snapshot_hash in snapshots:
+            f.write(f"{timestamp}\t{snapshot_hash}\n")
+    os.replace(tmp_index_path, index_path)
+
+
+def _object_path(backup_dir, snapshot_hash):
+    return os.path.join(backup_dir, OBJECTS_DIR, f"{snapshot_hash}.db.gz")
+
+
+def _sha256_of_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
@@ -0,0 +1,81 @@
+"""
+Export of the invoicing database to an .xlsx workbook with one worksheet per table.
+
+The tables are read in chunks and the rows are streamed into an openpyxl
+write-only workbook so that memory use stays fixed however large the tables grow.
+The export uses its own connection so that it can be run in a detached process
+once the changes of a run have been committed (see start_background_export):
+
+    python3 db_export.py invoicing.db db_backup/20221123T101010_db_backup.xlsx
+"""
+
+import datetime
+import os
+import sqlite3
+import subprocess
+import sys
+
+CHUNK_SIZE = 5000
+
+
+def export_db_to_xlsx(db_path, xlsx_path, chunk_size=CHUNK_SIZE):
+    """
+    Write every table of the database at db_path to a worksheet of the workbook at xlsx_path.
+    All tables are read from a single snapshot of the database.
+    """
+    # openpyxl is only imported here so that starting a background export doesn't load it
+    from openpyxl import Workbook
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        # A read transaction so that all of the tables are exported from the same snapshot
+        con.execute("BEGIN")
+        tables = [_[0] for _ in con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+        workbook = Workbook(write_only=True)
+        for table in tables:
+            worksheet = workbook.create_sheet(title=table)
+            cur = con.execute(f"SELECT * FROM {table}")
+            worksheet.append([_[0] for _ in cur.description])
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                for row in rows:
+                    worksheet.append(row)
+                rows = cur.fetchmany(chunk_size)
+        con.execute("COMMIT")
+    finally:
+        con.close()
+    workbook.save(xlsx_path)
+
+
+def start_background_export(db_path, xlsx_path, chunk_size=CHUNK_SIZE):
+    """
+    Run export_db_to_xlsx in a detached child process and return the path of its log
+    without waiting for it. The process is in its own session so that it carries on after
+    the run has exited. Its success or failure is written to xlsx_path + ".log".
+    """
+    xlsx_path = os.path.abspath(xlsx_path)
+    log_path = f"{xlsx_path}.log"
+    with open(log_path, "w") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), os.path.abspath(db_path), xlsx_path, "--chunk_size", str(chunk_size)],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+    return log_path
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Export every table of an invoicing.db to an .xlsx workbook.")
+    parser.add_argument("db_path")
+    parser.add_argument("xlsx_path")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    try:
+        export_db_to_xlsx(args.db_path, args.xlsx_path, chunk_size=args.chunk_size)
+    except Exception as e:
+        print(f"{datetime.datetime.now().isoformat()} FAILED: the .xlsx export of {args.db_path} to {args.xlsx_path} failed: {e!r}")
+        sys.exit(1)
+    print(f"{datetime.datetime.now().isoformat()} OK: finished writing {args.xlsx_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Decisions that answer the questions asked during an invoicing run.
+
+A decisions file lets create_invoices (and create_credit_invoices) run unattended.
+It is a .csv file, or a .yml/.yaml file holding a list of records, where each record has the fields:
+    decision: one of new_user, new_project, similar_name or overwrite
+    subject: what the decision is about (see below)
+    answer: y or n (not needed for new_user)
+    first_name, email, staff_subsidy, consumable_subsidy: only for new_user. The subsidies
+        are given as a value between 0 and 1 (0.5 = 50%) as when they are entered at the prompt.
+
+The subject of each type of decision is:
+    new_user: the last name of a user that is not yet in the db. The user will be created with the given details.
+    new_project: the project as it is named in the PPMS input (e.g. Smith_wetlab: Genome assembly).
+        y to create the project, n to skip it.
+    similar_name: a last name or project name that is very similar to another. y to continue, n to exit.
+    overwrite: the path of an output document that already exists, or * for all of them. y to overwrite.
+"""
+
+import csv
+import os
+
+NEW_USER = "new_user"
+NEW_PROJECT = "new_project"
+SIMILAR_NAME = "similar_name"
+OVERWRITE = "overwrite"
+DECISION_TYPES = [NEW_USER, NEW_PROJECT, SIMILAR_NAME, OVERWRITE]
+# The subject of a decision that applies to every subject of its type
+ANY_SUBJECT = "*"
+
+COLUMNS = ["decision", "subject", "answer", "first_name", "email", "staff_subsidy", "consumable_subsidy"]
+
+
+class Decisions:
+    def __init__(self, records=()):
+        # (decision, subject) to "y" or "n"
+        self._answers = {}
+        # last_name to (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent)
+        self._new_users = {}
+        for record in records:
+            self.add_record(record)
+
+    @classmethod
+    def from_file(cls, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found.")
+        if path.lower().endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("PyYAML is needed to read a .yml decisions file. Install it or use a .csv decisions file.")
+            with open(path) as f:
+                records = yaml.safe_load(f) or []
+            if not isinstance(records, list):
+                raise ValueError(f"{path} should hold a list of decisions.")
+        else:
+            with open(path, newline="", encoding="ISO-8859-1") as f:
+                records = list(csv.DictReader(f))
+        return cls(records)
+
+    def add_record(self, record):
+        unknown_fields = [_ for _ in record if _ not in COLUMNS]
+        if unknown_fields:
+            raise ValueError(f"Unknown fields {unknown_fields} in decision {record}. The fields are {COLUMNS}")
+        decision = str(record.get("decision") or "").strip()
+        subject = str(record.get("subject") or "").strip()
+        if decision not in DECISION_TYPES:
+            raise ValueError(f"Unknown decision {decision!r} in {record}. It should be one of {DECISION_TYPES}")
+        if not subject:
+            raise ValueError(f"The decision {record} has no subject.")
+        if decision == NEW_USER:
+            first_name = str(record.get("first_name") or "").strip()
+            email = str(record.get("email") or "").strip()
+            if not first_name or not email:
+                raise ValueError(f"The new_user decision for {subject} needs a first_name and an email.")
+            try:
+                staff_subsidy = float(record.get("staff_subsidy"))
+                consumable_subsidy = float(record.get("consumable_subsidy"))
+            except (TypeError, ValueError):
+                raise ValueError(f"The new_user decision for {subject} needs a staff_subsidy and a consumable_subsidy between 0 and 1.")
+            if not ((0 <= staff_subsidy <= 1) and (0 <= consumable_subsidy <= 1)):
+                raise ValueError(f"The subsidies of the new_user decision for {subject} should be between 0 and 1 (0.5 = 50%).")
+            self.add_new_user(subject, first_name, email, staff_subsidy*100, consumable_subsidy*100)
+        else:
+            self.add_answer(decision, subject, record.get("answer"))
+
+    def add_answer(self, decision, subject, answer):
+        # YAML reads unquoted yes and no as booleans
+        if isinstance(answer, bool):
+            answer = "y" if answer else "n"
+        answer = str(answer or "").strip().lower()
+        if answer in ("yes", "no"):
+            answer = answer[0]
+        if answer not in ("y", "n"):
+            raise ValueError(f"The answer to the {decision} decision for {subject} should be y or n, not {answer!r}")
+        self._answers[(decision, subject)] = answer
+
+    def add_new_user(self, last_name, first_name, email, staff_subsidy_percent, consumable_subsidy_percent):
+        self._new_users[last_name] = (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent)
+
+    def get_answer(self, decision, subject):
+        """
+        Returns "y" or "n", or None if there is no decision for the subject.
+        """
+        if decision == NEW_USER:
+            return "y" if subject in self._new_users else None
+        answer = self._answers.get((decision, subject))
+        if answer is None:
+            answer = self._answers.get((decision, ANY_SUBJECT))
+        return answer
+
+    def get_new_user(self, last_name):
+        """
+        Returns the (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent)
+        of the new user or None if there is no decision for last_name.
+        """
+        return self._new_users.get(last_name)
@@ -0,0 +1,70 @@
+"""
+Record of the invoice documents written by create_invoices.
+
+Each document is recorded in the invoice_documents table with the hash and JSON of
+the context it was rendered from and the sha256 of the file that was written. The hash
+covers the context (lines, totals and credit applied), the format of the document and,
+for .docx documents, the template. A rerun for the same period only re-renders the
+documents whose hash has changed. A document that is missing is re-issued from its
+recorded context, and a document that is still as it was written is overwritten
+without asking when its invoice changes.
+"""
+
+import hashlib
+import json
+import os
+
+
+def context_to_json(context):
+    return json.dumps(context, sort_keys=True, default=str)
+
+
+def context_hash(context_json, extension, template_hash=None):
+    """
+    The sha256 of everything a document is rendered from.
+    """
+    document_hash = hashlib.sha256()
+    for part in (extension, template_hash or "", context_json):
+        document_hash.update(part.encode("utf-8"))
+        document_hash.update(b"\0")
+    return document_hash.hexdigest()
+
+
+def file_sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def load_recorded_document(cur, path):
+    """
+    The (invoice_id, context_hash, context_json, document_sha256) recorded for the document at path or None.
+    """
+    cur.execute(
+        "SELECT invoice_id, context_hash, context_json, document_sha256 FROM invoice_documents WHERE path=:path",
+        {"path": path}
+        )
+    return cur.fetchone()
+
+
+def is_written_document(path, recorded):
+    """
+    True if the file at path is the document that was recorded as written there, i.e. it has not been changed since.
+    """
+    return recorded is not None and os.path.exists(path) and file_sha256(path) == recorded[3]
+
+
+def record_documents(cur, documents):
+    """
+    Record the written documents, a list of dicts of path, invoice_id, context_hash, context_json
+    and document_sha256, replacing any earlier record of the same path.
+    """
+    cur.executemany(
+        "INSERT INTO invoice_documents (path, invoice_id, context_hash, context_json, document_sha256) \
+            VALUES (:path, :invoice_id, :context_hash, :context_json, :document_sha256) \
+                ON CONFLICT (path) DO UPDATE SET invoice_id=excluded.invoice_id, context_hash=excluded.context_hash, \
+                    context_json=excluded.context_json, document_sha256=excluded.document_sha256",
+        documents
+        )
@@ -0,0 +1,114 @@
+"""
+Whole batch computation of the lines and totals of the invoices of a run.
+
+The staff and consumable lines of every invoice in the batch are read with one
+query each. Costs, subsidies and subtotals are computed as columns and the lines are
+grouped into the per invoice context items and totals used to populate the invoice
+documents. The totals are accumulated in the order that the lines appear on the
+invoice (wetlab, bioinf and training projects by staff hours, then consumables by
+name) so that they are identical to summing the lines one at a time.
+"""
+
+import numpy as np
+import pandas as pd
+
+PROJECT_TYPES = ["wetlab", "bioinf", "training"]
+
+
+def _format_2f(values):
+    return [f"{_:.2f}" for _ in values]
+
+
+def _accumulate(values):
+    # np.cumsum adds in order, unlike np.sum which sums pairwise
+    return float(np.cumsum(values)[-1]) if len(values) else 0.0
+
+
+def compute_invoice_totals(con, invoice_ids):
+    """
+    Returns a dict of invoice_id to (context, totals) for each of invoice_ids.
+    context holds the {project_type}_projects lists and, if the invoice has any,
+    the consumables list. totals is a dict of the Invoice totals attributes to their values.
+    """
+    con.execute("CREATE TEMP TABLE invoices_to_total (invoice_id INTEGER PRIMARY KEY)")
+    try:
+        con.executemany("INSERT INTO invoices_to_total (invoice_id) VALUES (:invoice_id)", [{"invoice_id": _} for _ in set(invoice_ids)])
+        staff_df = pd.DataFrame(
+            con.execute(
+                "SELECT staff_time_charges.invoice_id, project_type, project_title, staff_hours, staff_hourly_rate_eur, subsidy_percent \
+                    FROM invoices_to_total INNER JOIN staff_time_charges ON staff_time_charges.invoice_id = invoices_to_total.invoice_id \
+                        INNER JOIN projects ON projects.project_id = staff_time_charges.project_id \
+                            ORDER BY staff_time_charges.invoice_id, staff_hours DESC, charge_id"
+                ).fetchall(),
+            columns=["invoice_id", "project_type", "project_title", "staff_hours", "staff_hourly_rate_eur", "subsidy_percent"]
+            )
+        consumable_rows = con.execute(
+            "SELECT consumable_charges.invoice_id, name, unit_cost, quantity, subsidy_percent \
+                FROM invoices_to_total INNER JOIN consumable_charges ON consumable_charges.invoice_id = invoices_to_total.invoice_id \
+                    ORDER BY consumable_charges.invoice_id, name ASC, charge_id"
+            ).fetchall()
+    finally:
+        con.execute("DROP TABLE temp.invoices_to_total")
+
+    # Staff lines in the order that they appear on the invoice
+    staff_df["type_order"] = staff_df["project_type"].map({_: i for i, _ in enumerate(PROJECT_TYPES)})
+    staff_df = staff_df.loc[staff_df["type_order"].notna()]
+    staff_df = staff_df.sort_values(["invoice_id", "type_order"], kind="stable")
+    staff_hours = staff_df["staff_hours"].to_numpy(dtype=np.float64)
+    staff_hourly_rate_eur = staff_df["staff_hourly_rate_eur"].to_numpy(dtype=np.float64)
+    staff_subsidy_percent = staff_df["subsidy_percent"].to_numpy(dtype=np.float64)
+    staff_cost = staff_hours * staff_hourly_rate_eur
+    staff_subsidy = staff_cost * (staff_subsidy_percent / 100)
+    staff_subtotal = staff_cost - staff_subsidy
+
+    consumables_df = pd.DataFrame(consumable_rows, columns=["invoice_id", "name", "unit_cost", "quantity", "subsidy_percent"])
+    con_unit_cost = consumables_df["unit_cost"].to_numpy(dtype=np.float64)
+    con_subsidy_percent = consumables_df["subsidy_percent"].to_numpy(dtype=np.float64)
+    con_cost = con_unit_cost * consumables_df["quantity"].to_numpy(dtype=np.float64)
+    con_subsidy = con_cost * (con_subsidy_percent / 100)
+    con_subtotal = con_cost - con_subsidy
+
+    staff_items = pd.DataFrame({
+        "project_title": staff_df["project_title"].to_numpy(dtype=object),
+        "staff_hours": _format_2f(staff_hours),
+        "staff_hourly_rate_eur": _format_2f(staff_hourly_rate_eur),
+        "staff_cost": _format_2f(staff_cost),
+        "subsidy": _format_2f(staff_subsidy_percent),
+        "subtotal": _format_2f(staff_subtotal),
+        }).to_dict("records")
+    consumable_items = pd.DataFrame({
+        "name": consumables_df["name"].to_numpy(dtype=object),
+        # Formatted from the values as read so that integer quantities are not shown as floats
+        "quantity": [f"{_[3]}" for _ in consumable_rows],
+        "unit_cost": _format_2f(con_unit_cost),
+        "cost": _format_2f(con_cost),
+        "subsidy": _format_2f(con_subsidy_percent),
+        "subtotal": _format_2f(con_subtotal),
+        }).to_dict("records")
+
+    # The row positions of the lines of each invoice
+    staff_lines = pd.Series(np.arange(len(staff_df))).groupby(staff_df["invoice_id"].to_numpy(), sort=False).indices
+    consumable_lines = pd.Series(np.arange(len(consumables_df))).groupby(consumables_df["invoice_id"].to_numpy(), sort=False).indices
+    project_types = staff_df["project_type"].to_numpy(dtype=object)
+
+    invoice_totals = {}
+    for invoice_id in invoice_ids:
+        s = staff_lines.get(invoice_id, np.array([], dtype=np.int64))
+        c = consumable_lines.get(invoice_id, np.array([], dtype=np.int64))
+        context = {f"{_}_projects": [] for _ in PROJECT_TYPES}
+        for i in s:
+            context[f"{project_types[i]}_projects"].append(staff_items[i])
+        if len(c):
+            context["consumables"] = [consumable_items[i] for i in c]
+        totals = {
+            "balance": _accumulate(np.concatenate([staff_subtotal[s], con_subtotal[c]])),
+            "total_staff_hours": _accumulate(staff_hours[s]),
+            "total_staff_cost": _accumulate(staff_cost[s]),
+            "total_staff_subsidy_amount": _accumulate(staff_subsidy[s]),
+            "charges_count": len(s),
+            "total_consumable_cost": _accumulate(con_cost[c]),
+            "total_comsumables_subsidy_amount": _accumulate(con_subsidy[c]),
+            "total_consumables_amount_payable": _accumulate(con_subtotal[c]),
+            }
+        invoice_totals[invoice_id] = (context, totals)
+    return invoice_totals
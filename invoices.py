@@ -1,32 +1,30 @@
 """
 Class represenation of the invoices table
+Invoices are loaded through a repository.Repository so that each row is only loaded once per run.
 """
 
-import sqlite3
-import sys
-
 class Invoice:
-    def __init__(self, invoice_id, con=None):
-        self.con: sqlite3.Connection
-        if con:
-            self.con = con
-        else:
-            self.con = sqlite3.connect('invoicing.db')
-        self.cur = self.con.cursor()
-        self._invoice_id = invoice_id
-        self.cur.execute(
-            f"select invoice_timestamp, first_month, last_month, \
-            chargeable_account, user_id, amount_payable, reference_text, sent, paid \
-            from invoices where invoice_id={self._invoice_id}"
-            )
-        results = self.cur.fetchall()
-        assert(len(results) == 1)
+    __slots__ = (
+        "_repository", "_invoice_id", "_invoice_timestamp", "_first_month", "_last_month",
+        "_chargeable_account", "_user_id", "_amount_payable", "_reference_text", "_sent", "_paid",
+        "balance", "total_staff_hours", "total_staff_cost", "total_staff_subsidy_amount", "charges_count",
+        "total_consumable_cost", "total_comsumables_subsidy_amount", "total_consumables_amount_payable",
+        "credit_used_against_this_invoice"
+        )
+
+    def __init__(self, repository, row):
+        self._repository = repository
+        self._load(row)
+        self.reset_totals()
+
+    def _load(self, row):
         (
-            self._invoice_timestamp, self._first_month, self._last_month,
+            self._invoice_id, self._invoice_timestamp, self._first_month, self._last_month,
             self._chargeable_account, self._user_id,
             self._amount_payable, self._reference_text, self._sent, self._paid
-            ) = results[0]
-        
+            ) = row
+
+    def reset_totals(self):
         # Properties used when generating an invoice
         self.balance = 0.0
         self.total_staff_hours = 0.0
@@ -45,7 +43,7 @@ class Invoice:
     @property
     def paid(self):
         return self._paid
-        
+
     @property
     def sent(self):
         return self._sent
@@ -60,17 +58,14 @@ class Invoice:
 
     @property
     def amount_payable(self):
-        self.cur.execute(
-            f"select amount_payable \
-            from invoices where invoice_id={self._invoice_id}"
-            )
-        return self.cur.fetchone()[0]
+        return self._amount_payable
 
     @amount_payable.setter
     def amount_payable(self, amount):
         assert(amount >= 0)
-        self.cur.execute(f"update invoices set amount_payable={amount} where invoice_id={self._invoice_id}")
-        self.con.commit()
+        # Committing is the responsibility of the owner of the connection.
+        self._repository.set_invoice_amount_payable(self._invoice_id, amount)
+        self._amount_payable = amount
 
     @property
     def user_id(self):
@@ -78,11 +73,10 @@ class Invoice:
 
     def _get_consumables_charges(self):
         # Get the consumable charges for the invoice
-        self.cur.execute(f"select charge_id, unit_cost, quantity, subsidy_percent from consumable_charges where invoice_id = {self.invoice_id}")
+        results = self._repository.get_consumable_charges(self.invoice_id)
         # We want a total value for the charges
-        results = self.cur.fetchall()
         total_consumable_charges = 0
         for charge_id, unit_cost, quantity, subsidy_percent in results:
             total_consumable_charges += (quantity - (quantity * subsidy_percent/100)) * unit_cost
-        
-        return total_consumable_charges
\ No newline at end of file
+
+        return total_consumable_charges
@@ -4,70 +4,200 @@ Script for making the SequAna invoices.
 
 TODO write output of database to csv file.
 
+The heavy modules (pandas and the modules that use it, docxtpl and openpyxl) are
+only imported by the methods that need them so that subcommands that don't use
+them, and -h, start quickly. See benchmarks/startup.py.
 """
 
-from mailbox import FormatError
-from docxtpl import DocxTemplate
 import argparse
 import sqlite3
 import os
-import pandas as pd
-from difflib import get_close_matches
 import sys
 import datetime
-import shutil
+import json
+import time
 from datetime import timezone
-from invoices import Invoice
-from users import User
-from projects import Project
+from repository import Repository
+from invoice_documents import context_to_json, context_hash, file_sha256, load_recorded_document, is_written_document, record_documents
+from similarity import find_similar_names
+from decisions import Decisions, NEW_USER, NEW_PROJECT, SIMILAR_NAME, OVERWRITE
+from plan import copy_db_to_memory, snapshot_tables, diff_snapshots, print_plan, write_plan_json
+from profiling import Profiler, ProfiledConnection, print_profile, write_profile_json
+from transactions import RunTransaction
+from migrations import migrate, get_schema_version
+from query_plans import check_query_plans
+from credit_balances import find_credit_balance_drift, rebuild_credit_balances
+from rollups import AGING_BUCKETS, FIRST_MONTH, LAST_MONTH, refresh_rollups, rebuild_rollups, outstanding_balances, revenue_by_month, subsidy_totals, invoice_aging
+from db_backup import backup_db, prune_backups, restore_backup, find_snapshot, read_snapshot_index
+
+
+class FormatError(ValueError):
+    """
+    A command line argument is not in the expected format.
+    """
+
+
+# The values of --format to the extensions of the documents written for each invoice
+OUTPUT_FORMATS = {"docx": ["docx"], "pdf": ["pdf"], "both": ["docx", "pdf"]}
 
 
 class Invoicing:
     def __init__(self):
         self.backup_date_time_str = str(datetime.datetime.now(timezone.utc)).replace(" ", "T").replace("-","").replace(":","").split(".")[0]
+        # Answers to the questions of the run. See decisions.py
+        self.decisions = Decisions()
+        self.unattended = False
+        # When True the run is made against an in memory copy of the db. See plan.py
+        self.plan = False
+        # Wall times of the phases of the run. SQL is only traced with --profile. See profiling.py
+        self.profiler = Profiler()
         self.args = self._parse_args()
         
     def _init_db(self):
-        self.con = sqlite3.connect('invoicing.db')
+        try:
+            profile = self.args.profile
+        except AttributeError:
+            profile = False
+        factory = ProfiledConnection if profile else sqlite3.Connection
+        # Transactions are controlled explicitly by self.transaction
+        if self.plan:
+            # A plan is made against an in memory copy of the db so that invoicing.db is never changed
+            self.con = copy_db_to_memory('invoicing.db', factory=factory)
+        else:
+            self.con = sqlite3.connect('invoicing.db', isolation_level=None, factory=factory)
+        if profile:
+            self.profiler.attach(self.con)
         self.cur = self.con.cursor()
+        # Make sure that the db schema is up to date before it is used
+        migrate(self.con)
+        # Users, projects and invoices are loaded once per run through the repository
+        self.repository = Repository(self.con)
+        try:
+            commit_every = self.args.commit_every
+        except AttributeError:
+            commit_every = None
+        self.transaction = RunTransaction(self.con, commit_every=commit_every, on_rollback=self.repository.clear)
 
     def _output_xlsx_of_database(self):
         """
-        As a fail safe we will output the database to csv and save this in the db_backup
-        directory
+        As a fail safe we will output the database to an .xlsx file and save this in the db_backup
+        directory. The tables are streamed to the file in chunks so memory use stays fixed.
+        If requested, the export is done in a detached process so that the run returns right away.
         """
-        # Get a list of all of the tables in the database
-        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [_[0] for _ in self.cur.fetchall()]
-
-        # Create a writer so that we can write the pandas dataframes to the excel
-        # on separate sheets
         try:
             db_csv_path = os.path.join(self.args.db_backup_dir, f'{self.backup_date_time_str}_db_backup.xlsx')
         except AttributeError:
             if not os.path.exists("db_backup"):
                 os.makedirs("db_backup")
             db_csv_path = os.path.join("db_backup", f'{self.backup_date_time_str}_db_backup.xlsx')
-        
-        with pd.ExcelWriter(db_csv_path, engine='openpyxl') as writer:
 
-            # Make a dataframe from each of the tables in the sqlite database
-            for table in tables:
-                df = pd.read_sql_query(f"SELECT * FROM {table}", self.con)
-                df.to_excel(writer, sheet_name=f'{table}', index=False)
-        
         print(f"\n\nBacking up invoicing.db to {db_csv_path}")
+        from db_export import export_db_to_xlsx, start_background_export
+        try:
+            background = self.args.background_xlsx_export
+        except AttributeError:
+            background = False
+        if background:
+            log_path = start_background_export('invoicing.db', db_csv_path)
+            print(f"The export is being written in the background. Its result will be logged to {log_path}")
+        else:
+            export_db_to_xlsx('invoicing.db', db_csv_path)
 
     def _make_new_user(self):
         self._init_db()
         first_name, last_name, email, staff_subsidy, consumable_subsidy = self._get_first_name_email_subsidy_of_user()
-        self.cur.execute(
-                "INSERT INTO users (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent) VALUES (:first_name, :user_last_name, :email, :staff_subsidy, :consumable_subsidy)",
-                {"first_name":first_name, "user_last_name":last_name, "email":email, "staff_subsidy":staff_subsidy, "consumable_subsidy":consumable_subsidy}
-                )
-        self.con.commit()
+        with self.transaction:
+            self.cur.execute(
+                    "INSERT INTO users (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent) VALUES (:first_name, :user_last_name, :email, :staff_subsidy, :consumable_subsidy)",
+                    {"first_name":first_name, "user_last_name":last_name, "email":email, "staff_subsidy":staff_subsidy, "consumable_subsidy":consumable_subsidy}
+                    )
         print(f"User {first_name} {last_name} successfully added to database.") 
 
+    def _migrate_db(self):
+        """
+        Upgrade invoicing.db to the latest schema version.
+        The upgrade is done by _init_db so there is nothing else to do here but report.
+        """
+        self._init_db()
+        print(f"invoicing.db is at schema version {get_schema_version(self.con)}.")
+
+    def _check_query_plans(self):
+        """
+        Check that none of the queries of the invoicing code do a full table scan of invoicing.db.
+        """
+        self._init_db()
+        if check_query_plans(self.con, source_dir=os.path.dirname(os.path.abspath(__file__))):
+            sys.exit(1)
+
+    def _verify_credit_balances(self):
+        """
+        Recompute the credit balance of every user from scratch and report any
+        drift from the user_credit_balances ledger. Optionally rebuild the ledger.
+        """
+        self._init_db()
+        drift = find_credit_balance_drift(self.con)
+        if not drift:
+            print("The credit balances of all users match the user_credit_balances ledger.")
+            return
+        print("The following users have credit balances that do not match the user_credit_balances ledger:")
+        print("user_id\tledger_credit\tledger_debit\trecomputed_credit\trecomputed_debit")
+        for result in drift:
+            print("\t".join([str(_) for _ in result]))
+        if self.args.repair:
+            with self.transaction:
+                rebuild_credit_balances(self.con)
+            print("The user_credit_balances ledger has been rebuilt.")
+        else:
+            sys.exit("Run again with --repair to rebuild the ledger.")
+
+    def _refresh_rollups(self, months):
+        """
+        Bring the monthly_rollups of months up to date with the changes of the run. See rollups.py
+        """
+        refresh_rollups(self.con, months)
+
+    def _report(self):
+        """
+        Print the finance reports from the monthly_rollups table: the outstanding balances of
+        each user, the revenue of each month by project type, the subsidy totals and the invoice aging.
+        """
+        self._init_db()
+        if self.args.refresh:
+            with self.transaction:
+                rebuild_rollups(self.con)
+            print("monthly_rollups has been rebuilt from the history.")
+        first_month = self.args.first_month or FIRST_MONTH
+        last_month = self.args.last_month or LAST_MONTH
+        reports = ["outstanding", "revenue", "subsidies", "aging"] if self.args.report == "all" else [self.args.report]
+
+        if "outstanding" in reports:
+            print("\nOutstanding balances")
+            print("user_id\tlast_name\temail\tunsent_eur\toutstanding_eur\tavailable_credit_eur")
+            for user_id, last_name, email, unsent, outstanding, available_credit in outstanding_balances(self.con, first_month, last_month):
+                print(f"{user_id}\t{last_name}\t{email}\t{unsent:.2f}\t{outstanding:.2f}\t{available_credit:.2f}")
+
+        if "revenue" in reports:
+            print("\nRevenue by month and project type")
+            print("month\tproject_type\tstaff_hours\tstaff_cost_eur\tstaff_subsidy_eur\tconsumables_cost_eur\tconsumables_subsidy_eur\tnet_eur")
+            for month, project_type, *amounts in revenue_by_month(self.con, first_month, last_month):
+                print("\t".join([month, project_type] + [f"{_:.2f}" for _ in amounts]))
+
+        if "subsidies" in reports:
+            print("\nSubsidy totals")
+            print("project_type\tstaff_subsidy_eur\tconsumables_subsidy_eur\ttotal_subsidy_eur")
+            totals = [0.0, 0.0, 0.0]
+            for project_type, *amounts in subsidy_totals(self.con, first_month, last_month):
+                print("\t".join([project_type] + [f"{_:.2f}" for _ in amounts]))
+                totals = [a + b for a, b in zip(totals, amounts)]
+            print("\t".join(["total"] + [f"{_:.2f}" for _ in totals]))
+
+        if "aging" in reports:
+            as_of = datetime.date.fromisoformat(self.args.as_of) if self.args.as_of else datetime.date.today()
+            print(f"\nInvoice aging of the outstanding amounts as of {as_of}")
+            print("\t".join(["user_id", "last_name", "email"] + [f"{_[0]}_eur" for _ in AGING_BUCKETS] + ["total_eur"]))
+            for user_id, last_name, email, *amounts in invoice_aging(self.con, as_of, first_month, last_month):
+                print("\t".join([str(user_id), last_name, email] + [f"{_:.2f}" for _ in amounts]))
+
     def _set_invoices_paid(self):
         """
         Set the paid status of one or more invoices to True
@@ -77,23 +207,19 @@ class Invoicing:
         # Get a dataframe where each row is a an invoice to be set to paid.
         self.invoice_df = self._do_invoices_input_csv_qc(required_cols=["user_email", "amount_payable", "invoice_id"])
 
-        # Check that all credit invoices listed in the df exist
-        self._check_that_all_invoices_in_invoices_input_df_exist_sent()
+        with self.transaction:
+            self._stage_invoices_input()
+
+            # Check that all invoices listed in the df exist and have been sent but not paid
+            self._check_staged_invoices(sent=True)
 
-        # Set the invoices to paid
-        self._set_invoice_to_paid()
+            # Set the invoices to paid
+            self._set_staged_invoices_status("paid")
 
         self._back_up_db()
 
         self._output_xlsx_of_database()
 
-    def _set_invoice_to_paid(self):
-        for ind, ser in self.invoice_df.iterrows():
-            invoice = Invoice(invoice_id=ser["invoice_id"], con=self.con)
-            self.cur.execute("update invoices set paid=:paid where invoice_id=:invoice_id", {"paid": True, "invoice_id": invoice.invoice_id})
-            self.con.commit()
-            print(f"Invoice {invoice.invoice_id} ({invoice.reference_text}) set to paid")
-
     def _set_invoice_to_sent(self):
         """
         Set the sent status of one or more invoices to True
@@ -101,53 +227,88 @@ class Invoicing:
 
         self._init_db()
 
-        # Get a dataframe where each row is a credit invoice to be created.
+        # Get a dataframe where each row is an invoice to be set to sent.
         self.invoice_df = self._do_invoices_input_csv_qc(required_cols=["user_email", "amount_payable", "invoice_id"])
 
-        # Check that all credit invoices listed in the df exist
-        self._check_that_all_invoices_in_invoices_input_df_exist_not_sent()
+        with self.transaction:
+            self._stage_invoices_input()
+
+            # Check that all invoices listed in the df exist and have been neither sent nor paid
+            self._check_staged_invoices(sent=False)
 
-        # Set the invoices to sent
-        self._set_invoices_to_sent()
+            # Set the invoices to sent
+            self._set_staged_invoices_status("sent")
 
         self._back_up_db()
 
         self._output_xlsx_of_database()
-        
-    def _set_invoices_to_sent(self):
-        for ind, ser in self.invoice_df.iterrows():
-            invoice = Invoice(invoice_id=ser["invoice_id"], con=self.con)
-            self.cur.execute("update invoices set sent=:sent where invoice_id=:invoice_id", {"sent": True, "invoice_id": invoice.invoice_id})
-            self.con.commit()
-            print(f"Invoice {invoice.invoice_id} ({invoice.reference_text}) set to sent")
-        
-    def _check_that_all_invoices_in_invoices_input_df_exist_sent(self):
-        for ind, ser in self.invoice_df.iterrows():
-            self.cur.execute(
-                    "select invoice_id from invoices where \
-                    sent=:sent and \
-                    paid=:paid and invoice_id=:invoice_id", 
-                    {"sent":True, "paid":False, "invoice_id":ser["invoice_id"]}
-                    )
-            invoice_ids = [_[0] for _ in self.cur.fetchall()]
-            if len(invoice_ids) == 0:
-                print(f"Cannot find an invoice matching invoice_id {ser['invoice_id']} that is sent but not paid.")
-                sys.exit()
-
-    def _check_that_all_invoices_in_invoices_input_df_exist_not_sent(self):
-        # Here the series ser contains the following columns: "user_email", "amount_payable", "invoice_id"
-        for ind, ser in self.invoice_df.iterrows():
-            
-            self.cur.execute(
-                    "select invoice_id from invoices where \
-                    sent=:sent and \
-                    paid=:paid and invoice_id=:invoice_id", 
-                    {"sent":False, "paid":False, "invoice_id":ser["invoice_id"]}
-                    )
-            invoice_ids = [_[0] for _ in self.cur.fetchall()]
-            if len(invoice_ids) == 0:
-                print(f"Cannot find an invoice matching id {ser['invoice_id']} that is not sent nor paid.")
-                sys.exit()
+
+    def _stage_invoices_input(self):
+        """
+        Load the rows of self.invoice_df into the temp table staged_invoices so that they
+        can be checked and updated with single statements.
+        """
+        self.cur.execute(
+            "CREATE TEMP TABLE staged_invoices ( \
+                row_id INTEGER PRIMARY KEY, \
+                invoice_id INTEGER NOT NULL, \
+                user_email TEXT NOT NULL \
+                )"
+            )
+        self.cur.executemany(
+            "INSERT INTO staged_invoices (invoice_id, user_email) VALUES (:invoice_id, :user_email)",
+            [{"invoice_id": int(invoice_id), "user_email": str(user_email)} for invoice_id, user_email in zip(self.invoice_df["invoice_id"], self.invoice_df["user_email"])]
+            )
+
+    def _check_staged_invoices(self, sent):
+        """
+        Check in a single query that every staged invoice exists, belongs to the user with the given
+        email and has the given sent status without having been paid. Every row that fails is
+        reported before exiting.
+        """
+        self.cur.execute(
+            "SELECT staged_invoices.row_id, staged_invoices.invoice_id, staged_invoices.user_email, invoices.invoice_id, users.email, invoices.sent, invoices.paid \
+                FROM staged_invoices LEFT JOIN invoices ON invoices.invoice_id = staged_invoices.invoice_id \
+                    LEFT JOIN users ON users.user_id = invoices.user_id \
+                        WHERE invoices.invoice_id IS NULL OR users.email IS NOT staged_invoices.user_email OR invoices.sent != :sent OR invoices.paid != 0 \
+                            ORDER BY staged_invoices.row_id",
+            {"sent": sent}
+            )
+        bad_rows = self.cur.fetchall()
+        if bad_rows:
+            expected_status = "sent but not paid" if sent else "neither sent nor paid"
+            print(f"The following invoices of the input cannot be set to {'paid' if sent else 'sent'}. Every invoice must exist, match the user_email and be {expected_status}.")
+            print("row\tinvoice_id\tuser_email\tproblem")
+            for row_id, invoice_id, user_email, db_invoice_id, db_email, db_sent, db_paid in bad_rows:
+                if db_invoice_id is None:
+                    problem = "no such invoice"
+                elif db_email != user_email:
+                    problem = f"the invoice belongs to {db_email}"
+                elif db_paid:
+                    problem = "already paid"
+                else:
+                    problem = "already sent" if db_sent else "not sent"
+                print(f"{row_id}\t{invoice_id}\t{user_email}\t{problem}")
+            sys.exit("Exiting")
+
+    def _set_staged_invoices_status(self, status):
+        """
+        Set the sent or paid status of all of the staged invoices to True with a single UPDATE.
+        """
+        if status == "sent":
+            self.cur.execute("UPDATE invoices SET sent=1 WHERE invoice_id IN (SELECT invoice_id FROM staged_invoices)")
+        else:
+            self.cur.execute("UPDATE invoices SET paid=1 WHERE invoice_id IN (SELECT invoice_id FROM staged_invoices)")
+        self.cur.execute(
+            "SELECT invoice_id, reference_text FROM invoices WHERE invoice_id IN (SELECT invoice_id FROM staged_invoices) ORDER BY invoice_id"
+            )
+        for invoice_id, reference_text in self.cur.fetchall():
+            print(f"Invoice {invoice_id} ({reference_text}) set to {status}")
+        self.cur.execute(
+            "SELECT DISTINCT invoices.first_month FROM staged_invoices INNER JOIN invoices WHERE invoices.invoice_id = staged_invoices.invoice_id"
+            )
+        self._refresh_rollups([_[0] for _ in self.cur.fetchall()])
+        self.cur.execute("DROP TABLE temp.staged_invoices")
 
     def _init_create_credit_invoices(self):
         """
@@ -156,18 +317,25 @@ class Invoicing:
         """
 
         self._init_db()
+        self._load_decisions()
 
         # Get a dataframe where each row is a credit invoice to be created.
         self.invoice_df = self._do_invoices_input_csv_qc(required_cols=["user_email", "amount_payable"])
 
         # Make the credit invoices if they don't already exist
-        self._make_credit_invoices()
+        with self.transaction:
+            self._make_credit_invoices()
+
+        # The documents are only written once the credit invoices they show have been committed
+        from rendering import render_documents
+        render_documents(self.render_jobs, workers=self.args.workers, template_cache_dir=self.args.template_cache_dir)
 
         self._back_up_db()
 
         self._output_xlsx_of_database()
 
     def _do_invoices_input_csv_qc(self, required_cols):
+        import pandas as pd
         c_inv_df = pd.read_csv(self.args.input, encoding = "ISO-8859-1")
         # When making a credit invoice we will only require "user_email", "amount_payable"
         # When setting paid or sent we will require "user_email", "amount_payable", "invoice_id"
@@ -186,10 +354,11 @@ class Invoicing:
     def _check_all_users_in_input_csv_exist(self):
         # check that all of the user emails are found in the database
         # that are included in users input csv.
-        self.cur.execute("SELECT email from users;")
-        db_user_emails = [_[0] for _ in self.cur.fetchall()]
+        # The users are indexed by email so that each email is a single lookup.
+        self.cur.execute("SELECT email, user_id from users;")
+        self.user_ids_by_email = {email: user_id for email, user_id in self.cur.fetchall()}
         input_users = self.invoice_df["user_email"].to_list()
-        missing_users = [_ for _ in input_users if _ not in db_user_emails]
+        missing_users = [_ for _ in input_users if _ not in self.user_ids_by_email]
         if missing_users:
             print(
                     ("WARNING: The following emails are related to a user in the database.\n"
@@ -200,7 +369,7 @@ class Invoicing:
                 print(f"\t{missing}")
         
             print("The following user emails are currently in the database:")
-            for u_email in db_user_emails:
+            for u_email in self.user_ids_by_email:
                 print(f"\t{u_email}")
 
             sys.exit("Exiting")
@@ -208,191 +377,663 @@ class Invoicing:
     def _check_credit_invoices_dont_already_exist(self):
         # Check to see that such an invoice doesn't already exist
         # if not create the invoice in the db.
-        for ind, ser in self.invoice_df.iterrows():
-            user_email = ser["user_email"]
-            amount = ser["amount_payable"]
-            self.cur.execute(
-                    "SELECT invoices.invoice_id, users.email, users.user_id from \
-                        invoices inner join users on invoices.user_id=users.user_id where \
-                            invoices.amount_payable=:amount and users.email=:user_email and invoices.sent=:sent and invoices.invoice_type=:invoice_type", 
-                            {"amount": amount, "user_email": user_email, "sent":False, "invoice_type": "credit"}
-                            )
-            results = self.cur.fetchall()
-            if results:
-                print(("One or more invoices already exist matching your inputs. "
-                "If you really want to make another credit invoice that already "
-                "matches an existing credit invoice, "
-                "then make sure that the existing invoice has been marked "
-                "as sent using the subcommand mark_invoice_sent."))
-                print("invoice_id\temail\tuser_id")
-                for result in results:
-                    print("\t".join([str(_) for _ in result]))
-                sys.exit("Exiting")
+        # All unsent credit invoices are read at once and matched against the input by (email, amount)
+        self.cur.execute(
+                "SELECT invoices.invoice_id, users.email, users.user_id, invoices.amount_payable from \
+                    invoices inner join users on invoices.user_id=users.user_id where \
+                        invoices.invoice_type=:invoice_type and invoices.sent=:sent",
+                        {"sent":False, "invoice_type": "credit"}
+                        )
+        unsent_credit_invoices = {}
+        for invoice_id, email, user_id, amount in self.cur.fetchall():
+            unsent_credit_invoices.setdefault((email, amount), []).append((invoice_id, email, user_id))
+        results = []
+        for user_email, amount in dict.fromkeys(zip(self.invoice_df["user_email"].to_list(), self.invoice_df["amount_payable"].to_list())):
+            results.extend(unsent_credit_invoices.get((user_email, amount), []))
+        if results:
+            print(("One or more invoices already exist matching your inputs. "
+            "If you really want to make another credit invoice that already "
+            "matches an existing credit invoice, "
+            "then make sure that the existing invoice has been marked "
+            "as sent using the subcommand mark_invoice_sent."))
+            print("invoice_id\temail\tuser_id")
+            for result in results:
+                print("\t".join([str(_) for _ in result]))
+            sys.exit("Exiting")
 
     def _make_credit_invoices(self):
-        # Check that the credit template exists
-        if not os.path.exists(self.args.template):
-            sys.exit(f"Cannot locate {self.args.template}. Exiting.")
+        # The extensions of the documents written for each credit invoice
+        self.output_formats = OUTPUT_FORMATS[self.args.format]
+
+        # Check that the credit template exists. It is only needed for the .docx documents
+        if "docx" in self.output_formats:
+            if self.args.template is None:
+                sys.exit("--template is required to make .docx credit invoices. Exiting.")
+            if not os.path.exists(self.args.template):
+                sys.exit(f"Cannot locate {self.args.template}. Exiting.")
         
         self._check_all_users_in_input_csv_exist()
 
         self._check_credit_invoices_dont_already_exist()
-        
-        # Create the credit invoice and print confirmation out to the terminal
-        for ind, ser in self.invoice_df.iterrows():
-            user_email = ser["user_email"]
-            self.cur.execute(f"select user_id from users where email=:user_email", {"user_email": user_email})
-            user_id = self.cur.fetchone()[0]
-            user = User(user_id, con=self.con)
-            amount = ser["amount_payable"]
-            invoice_timestamp = str(datetime.datetime.now())
-            first_month = last_month = invoice_timestamp.split(" ")[0].split("-")[0] + invoice_timestamp.split(" ")[0].split("-")[1]
-            chargeable_account = self.args.chargeable_account
-            
-            # First insert the record
-            self.cur.execute("insert into invoices \
-            (invoice_timestamp, first_month, last_month, chargeable_account, user_id, invoice_type, amount_payable, sent, paid) \
-            values(:invoice_timestamp, :first_month, :last_month, :chargeable_account, :user_id, :invoice_type, :amount_payable, :sent, :paid)", 
-                {
-                    "invoice_timestamp": invoice_timestamp, "first_month": first_month, "last_month": last_month, 
-                    "chargeable_account": chargeable_account, "user_id": user.user_id, "invoice_type": "credit", 
-                    "amount_payable": amount, "sent": False, "paid": False
-                }
-            )
 
-            self.con.commit()
-            # Then get the id of the record that we just made and use it to make the reference text
-            # Example: SequAna credit; invoice C2; Yamada, Norico
-            self.cur.execute(f"select invoice_id from invoices where invoice_timestamp=:invoice_timestamp", {"invoice_timestamp": invoice_timestamp})
-            invoice_id = self.cur.fetchone()[0]
-            reference = f"SequAna credit; invoice C{invoice_id}; {user.last_name}, {user.first_name}"
-            # update the reference text
-            self.cur.execute(
-                    "update invoices set reference_text=:reference where invoice_id=:invoice_id", 
-                    {"reference": reference, "invoice_id": invoice_id}
-                    )
-            self.con.commit()
-            
-            # Now we need to populate the credit invoice template
-            self.credit_doc = DocxTemplate(self.args.template)
-            self.credit_context = {}
-
-            invoice_date = invoice_timestamp.split(" ")[0].replace("-", "")
-            self.credit_context["invoice_date"] = invoice_date
-            self.credit_context["user_name"] = f"{user.last_name}, {user.first_name}"
-            self.credit_context["user_email"] = user.email
-            self.credit_context["invoice_id"] = f"C{invoice_id}"
-            self.credit_context["chargeable_account"] = chargeable_account
-            self.credit_context["amount"] = amount
-            self.credit_doc.render(self.credit_context)
-            outpath = os.path.join(self.args.output_dir, f"{invoice_date}_{user.last_name.replace(' ', '_')}_SequAna_Credit_Invoice_C{invoice_id}.docx")
-            
+        # The (template_path, context, outpath) of each of the credit invoices to be rendered
+        self.render_jobs = []
+
+        # All of the credit invoices of the run are made together with the same timestamp
+        invoice_timestamp = str(datetime.datetime.now())
+        first_month = last_month = invoice_timestamp.split(" ")[0].split("-")[0] + invoice_timestamp.split(" ")[0].split("-")[1]
+        chargeable_account = self.args.chargeable_account
+        credit_invoices = [
+            {
+                "invoice_timestamp": invoice_timestamp, "first_month": first_month, "last_month": last_month,
+                "chargeable_account": chargeable_account, "user_id": self.user_ids_by_email[user_email], "invoice_type": "credit",
+                "amount_payable": amount, "sent": False, "paid": False
+            }
+            for user_email, amount in zip(self.invoice_df["user_email"].to_list(), self.invoice_df["amount_payable"].to_list())
+        ]
+
+        # Insert all of the records.
+        # New rows are given the next invoice_id in turn so the ids of the records are those above
+        # the largest id before the insert. They are read back by primary key to be sure.
+        self.cur.execute("SELECT MAX(invoice_id) FROM invoices")
+        max_invoice_id = self.cur.fetchone()[0] or 0
+        self.cur.executemany("insert into invoices \
+        (invoice_timestamp, first_month, last_month, chargeable_account, user_id, invoice_type, amount_payable, sent, paid) \
+        values(:invoice_timestamp, :first_month, :last_month, :chargeable_account, :user_id, :invoice_type, :amount_payable, :sent, :paid)",
+            credit_invoices
+        )
+        self.cur.execute(
+                "SELECT invoice_id, user_id FROM invoices WHERE invoice_id > :max_invoice_id ORDER BY invoice_id",
+                {"max_invoice_id": max_invoice_id}
+                )
+        results = self.cur.fetchall()
+        assert([_[1] for _ in results] == [_["user_id"] for _ in credit_invoices])
+
+        # Then make the reference text of each record from its id
+        # Example: SequAna credit; invoice C2; Yamada, Norico
+        references = []
+        for (invoice_id, user_id), credit_invoice in zip(results, credit_invoices):
+            user = self.repository.get_user(user_id)
+            credit_invoice["invoice_id"] = invoice_id
+            references.append({"reference": f"SequAna credit; invoice C{invoice_id}; {user.last_name}, {user.first_name}", "invoice_id": invoice_id})
+        self.cur.executemany("update invoices set reference_text=:reference where invoice_id=:invoice_id", references)
+
+        self._refresh_rollups([first_month])
+
+        # Queue the credit invoice documents. They are rendered in one batch once the run has been committed
+        for credit_invoice in credit_invoices:
+            self._queue_credit_invoice(credit_invoice)
+
+    def _queue_credit_invoice(self, credit_invoice):
+        user = self.repository.get_user(credit_invoice["user_id"])
+        invoice_id = credit_invoice["invoice_id"]
+
+        # Now we need to populate the credit invoice template
+        self.credit_context = {}
+
+        invoice_date = credit_invoice["invoice_timestamp"].split(" ")[0].replace("-", "")
+        self.credit_context["invoice_date"] = invoice_date
+        self.credit_context["user_name"] = f"{user.last_name}, {user.first_name}"
+        self.credit_context["user_email"] = user.email
+        self.credit_context["invoice_id"] = f"C{invoice_id}"
+        self.credit_context["chargeable_account"] = credit_invoice["chargeable_account"]
+        self.credit_context["amount"] = credit_invoice["amount_payable"]
+        for extension in self.output_formats:
+            outpath = os.path.join(self.args.output_dir, f"{invoice_date}_{user.last_name.replace(' ', '_')}_SequAna_Credit_Invoice_C{invoice_id}.{extension}")
+
             if os.path.exists(outpath):
-                if self._get_n_y_user_response(question_text=f"\n\n{outpath} already exists.\nOverwrite? [y/n]: ") == "y":
-                    self.credit_doc.save(outpath)
-                    print(f"\nWriting {outpath}.")
+                if self._get_n_y_user_response(question_text=f"\n\n{outpath} already exists.\nOverwrite? [y/n]: ", decision=(OVERWRITE, outpath)) == "y":
+                    self.render_jobs.append((self.args.template, self.credit_context, outpath))
                 else:
                     print("Skipping credit invoice output")
-                    continue
             else:
-                self.credit_doc.save(outpath)
-                print(f"\nWriting {outpath}.")
+                self.render_jobs.append((self.args.template, self.credit_context, outpath))
 
     def _init_create_invoices(self):
         """
         Make standard charge invoives according to the user provided inputs
         """
+        self.plan = self.args.plan or self.args.plan_json is not None
+        periods = self._get_billing_periods()
 
-        self._init_db()
-        
+        with self.profiler.phase("init_db"):
+            self._init_db()
 
-        (
-            self.month_range, self.hours_charged_df, self.user_last_names_to_invoice,
-            self.chargeable_account, self.staff_hourly_rate_eur, self.output_dir
-        ) = self._do_argument_qc()
+        self._load_decisions()
 
-        # We need to make the consumable charges for the period
-        # so that they are available when we work out the balances
-        # on the per user basis.
-        if self.args.PPMS_input_consumables_csv:
-            self._make_consumable_charges()
-        
-        self._make_user_invoices()
+        # The PPMS inputs are read once and shared by all of the periods of the run
+        self.ppms_staff_hours_df = None
+        self.ppms_consumables_df = None
+        # As are the checks for similar names (see _find_similar_names)
+        self.similar_names_cache = {}
 
-        self._back_up_db()
+        # The (first_month, last_month, users invoiced, documents written, seconds) of each period
+        period_results = []
+        for first_month, last_month in periods:
+            start = time.perf_counter()
+            self._create_invoices_for_period(first_month, last_month)
+            period_results.append((first_month, last_month, len(self.user_last_names_to_invoice), self.documents_written, time.perf_counter() - start))
 
-        self._output_xlsx_of_database()
+        if not self.plan:
+            with self.profiler.phase("back_up_db"):
+                self._back_up_db()
+
+            with self.profiler.phase("xlsx_export"):
+                self._output_xlsx_of_database()
+
+        if len(periods) > 1:
+            print("\n\nfirst_month\tlast_month\tusers\tdocuments_written\tseconds")
+            for first_month, last_month, n_users, documents_written, seconds in period_results:
+                print(f"{first_month}\t{last_month}\t{n_users}\t{documents_written}\t{seconds:.3f}")
+
+        if self.args.profile:
+            self._output_profile(periods[0][0], periods[-1][1])
+
+    def _get_billing_periods(self):
+        """
+        The (first_month, last_month) of each of the billing periods of the run, in order.
+        Either --first_month and --last_month give a single period or --periods gives a comma
+        separated list of them. Each is YYYYMM (a single month), YYYYMM-YYYYMM (a period
+        from the first to the last month) or YYYYMM..YYYYMM (a period for each of the months).
+        """
+        if self.args.periods is None:
+            if self.args.first_month is None or self.args.last_month is None:
+                sys.exit("Either --first_month and --last_month or --periods must be given. Exiting.")
+            return [(str(self.args.first_month), str(self.args.last_month))]
+        if self.args.first_month is not None or self.args.last_month is not None:
+            sys.exit("--periods cannot be given together with --first_month or --last_month. Exiting.")
+
+        periods = []
+        for period in self.args.periods.split(","):
+            period = period.strip()
+            if ".." in period:
+                first_month, last_month = period.split("..")
+                periods.extend((_, _) for _ in self._get_months_between(first_month, last_month))
+            elif "-" in period:
+                periods.append(tuple(period.split("-")))
+            else:
+                periods.append((period, period))
+
+        # Periods are run in order and must not overlap so that no month is invoiced twice
+        for (first_month, last_month), (next_first_month, next_last_month) in zip(periods, periods[1:]):
+            if not next_first_month > last_month:
+                sys.exit(f"The billing period {next_first_month}-{next_last_month} overlaps or comes before {first_month}-{last_month}. Exiting.")
+        return periods
+
+    @staticmethod
+    def _get_months_between(first_month, last_month):
+        if not (len(first_month) == len(last_month) == 6 and first_month.isdigit() and last_month.isdigit()):
+            raise FormatError("The months of a range of periods should be in format YYYYMM..YYYYMM")
+        months = []
+        year, month = int(first_month[:4]), int(first_month[4:])
+        while year * 100 + month <= int(last_month):
+            months.append(f"{year * 100 + month}")
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+    def _create_invoices_for_period(self, first_month, last_month):
+        """
+        Make the invoices of a single billing period. Each period is made in its own
+        transaction, as if it were a run of its own.
+        """
+        with self.profiler.phase("argument_qc"):
+            (
+                self.month_range, self.hours_charged_df, self.user_last_names_to_invoice,
+                self.chargeable_account, self.staff_hourly_rate_eur, self.output_dir
+            ) = self._do_argument_qc(first_month, last_month)
+
+        # Answer all of the questions of the period before any of the work is done
+        with self.profiler.phase("resolve_decisions"):
+            self._resolve_decisions()
+
+        if self.plan:
+            self.planned_documents = []
+            tables_before_run = snapshot_tables(self.con)
+
+        # The whole period is a single transaction so that either all or none of
+        # the changes are made to the database.
+        with self.transaction:
+            # We need to make the consumable charges for the period
+            # so that they are available when we work out the balances
+            # on the per user basis.
+            if self.args.PPMS_input_consumables_csv:
+                with self.profiler.phase("consumable_charges"):
+                    self._make_consumable_charges()
+
+            # NB the populate_invoices phase is part of this phase
+            with self.profiler.phase("user_invoices"):
+                if self.args.batch:
+                    self._make_user_invoices_batch()
+                else:
+                    self._make_user_invoices()
+
+            # The invoices of the period all have its first_month
+            with self.profiler.phase("refresh_rollups"):
+                self._refresh_rollups([first_month])
+
+        # The documents are only written once the invoices they show have been committed.
+        # They are recorded in invoice_documents in a short transaction of their own.
+        with self.transaction:
+            self._render_queued_templates()
+
+        print("\nOutput of invoices complete.")
+
+        print("Invoicing Complete.")
+
+        if self.plan:
+            self._output_plan(tables_before_run)
+
+    def _output_profile(self, first_month, last_month):
+        """
+        Report the profile of the run and write it as JSON next to the invoices.
+        """
+        profile = self.profiler.report(first_month=first_month, last_month=last_month, batch=self.args.batch, plan=self.plan)
+        print_profile(profile)
+        # A plan does not make the output directory otherwise
+        os.makedirs(self.output_dir, exist_ok=True)
+        profile_path = os.path.join(self.output_dir, f"{first_month}_{last_month}_invoicing_profile.json")
+        write_profile_json(profile_path, profile)
+        print(f"\nProfile written to {profile_path}")
 
     def _back_up_db(self):
         """
-        Back up the database by simply copying the current invoices.db file into the specified db_backup directory
+        Back up the database as a compressed snapshot in the specified db_backup directory
+        and then apply the backup retention policy. See db_backup.py.
         """
-        backup_db_path = os.path.join(self.args.db_backup_dir, f'{self.backup_date_time_str}_db_backup_invoicing.db')
-        print(f"\n\nBacking up invoicing.db to {backup_db_path}")
-        shutil.copyfile('invoicing.db', backup_db_path)
+        print(f"\n\nBacking up invoicing.db to {self.args.db_backup_dir}")
+        snapshot_hash = backup_db('invoicing.db', self.args.db_backup_dir, self.backup_date_time_str)
+        print(f"Snapshot {self.backup_date_time_str} stored as {snapshot_hash}")
+        for timestamp, pruned_hash in prune_backups(self.args.db_backup_dir):
+            print(f"Pruned snapshot {timestamp} ({pruned_hash})")
+
+    def _restore_backup(self):
+        """
+        Restore invoicing.db from one of the snapshots in the db_backup directory.
+        A snapshot of the current database is taken first so that the restore can be undone.
+        """
+        if self.args.list:
+            print("timestamp\tsha256")
+            for timestamp, snapshot_hash in read_snapshot_index(self.args.db_backup_dir):
+                print(f"{timestamp}\t{snapshot_hash}")
+            return
+        timestamp, snapshot_hash = find_snapshot(self.args.db_backup_dir, self.args.snapshot)
+        if self._get_n_y_user_response(question_text=f"\n\nRestore invoicing.db from snapshot {timestamp} ({snapshot_hash})? [y/n]: ") != "y":
+            sys.exit("Exiting at users request")
+        print(f"Taking a snapshot of the current invoicing.db before restoring.")
+        self._back_up_db()
+        restore_backup('invoicing.db', self.args.db_backup_dir, snapshot=snapshot_hash)
+        print(f"invoicing.db restored from snapshot {timestamp} ({snapshot_hash})")
 
     def _make_consumable_charges(self):
         """
         Create new consumable charges for the rows of the consumables input if they don't already exist
         This means creating new projects and invoices if they don't exist that the consumable
         charges can be associated to.
+        The rows are staged in a temporary table and matched against the existing charges in sql.
+        The new charges are then inserted in a single statement.
         """
         print("\nChecking whether consumable charges in input already exist and creating if not.\n")
-        # Now we need to check whether a consumables object exists for each of the rows of the df
-        for ind, ser in self.consumables_df.iterrows():
-            if self._project_exists(project_name=ser["Project name"]):
-                project_id, user_id = self._get_project_id_user_id_from_project(project_name=ser["Project name"])
-
-            # First check to see if there is an index matching the Project name
-                if self._invoice_exists(user_id=user_id):
-                    invoice_id = self._get_invoice_id(user_id=user_id)
-                    # Then an invoice exists and it is possible that a consumable charge already exists that we can check for
-                    if self._consumable_charge_exits(project_id=project_id, invoice_id=invoice_id, name=ser["Consumable name"], date=ser["month"], unit_cost=ser["Unit price"], quantity=ser["Quantity"], ref=ser["Ref."]):
-                        pass
-                    else:
-                        # create consumable charge with invoice and project ids
-                        self._create_consumable_charge(ser)
-                else:
-                    self._create_consumable_charge(ser)
-            else:
-                self._create_consumable_charge(ser)
+        self._stage_consumables()
+
+        # Mark the rows that match a charge already in the db through an existing project and invoice
+        self.cur.execute(
+            "UPDATE staged_consumables SET charge_exists=1 WHERE EXISTS ( \
+                SELECT 1 FROM consumable_charges \
+                    INNER JOIN projects ON projects.project_id=consumable_charges.project_id \
+                    INNER JOIN invoices ON invoices.invoice_id=consumable_charges.invoice_id \
+                    INNER JOIN users ON users.user_id=projects.user_id \
+                WHERE consumable_charges.name=staged_consumables.name AND consumable_charges.date=staged_consumables.date \
+                    AND consumable_charges.unit_cost=staged_consumables.unit_cost AND consumable_charges.quantity=staged_consumables.quantity \
+                    AND consumable_charges.PPMS_reference=staged_consumables.PPMS_reference \
+                    AND projects.project_title=staged_consumables.project_title AND projects.project_type=staged_consumables.project_type \
+                    AND users.last_name=staged_consumables.last_name AND invoices.user_id=users.user_id \
+                    AND invoices.first_month<=:first_month AND invoices.last_month>=:last_month)",
+            {"first_month":int(self.first_month), "last_month":int(self.last_month)}
+            )
+
+        # The user, project and invoice of the new charges are got or made once per project rather than once per charge
+        self.cur.execute("SELECT project_name FROM staged_consumables WHERE charge_exists=0 GROUP BY project_name ORDER BY MIN(row_id)")
+        for (project_name,) in self.cur.fetchall():
+            # Only the users of the run count towards --commit_every
+            with self.transaction.savepoint(count=False):
+                self.current_user = self._get_or_make_user_for_invoicing(user_last_name=self._get_last_name_from_project_name(project_name))
+                self.current_project = self._get_or_make_project(project_name)
+                self.current_invoice = self._get_or_make_invoice()
+                self.cur.execute(
+                    "UPDATE staged_consumables SET charge_invoice_id=:invoice_id, charge_project_id=:project_id WHERE project_name=:project_name",
+                    {"invoice_id": self.current_invoice.invoice_id, "project_id": self.current_project.project_id, "project_name": project_name}
+                    )
+
+        # Rows that are repeated in the input are only charged once thanks to the unique natural key
+        self.cur.execute(
+            "INSERT INTO consumable_charges (name, unit_cost, quantity, date, invoice_id, project_id, PPMS_reference) \
+                SELECT name, unit_cost, quantity, date, charge_invoice_id, charge_project_id, PPMS_reference FROM staged_consumables \
+                    WHERE charge_exists=0 AND charge_invoice_id IS NOT NULL ORDER BY row_id \
+                ON CONFLICT DO NOTHING"
+            )
+        print(f"{self.cur.rowcount} consumable charges created.")
+        self.cur.execute("DROP TABLE temp.staged_consumables")
         print("\nFinished checking consumable charges from input.")
 
+    def _stage_consumables(self):
+        """
+        Load the rows of self.consumables_df into the staged_consumables temporary table
+        """
+        self.cur.execute("DROP TABLE IF EXISTS temp.staged_consumables")
+        self.cur.execute(
+            "CREATE TEMP TABLE staged_consumables ( \
+                row_id INTEGER PRIMARY KEY, project_name TEXT NOT NULL, last_name TEXT NOT NULL, \
+                project_title TEXT NOT NULL, project_type TEXT NOT NULL, \
+                name TEXT NOT NULL, unit_cost REAL NOT NULL, quantity INTEGER NOT NULL, date TEXT NOT NULL, PPMS_reference TEXT NOT NULL, \
+                charge_exists INTEGER NOT NULL DEFAULT 0, charge_invoice_id INTEGER, charge_project_id INTEGER)"
+            )
+        df = self.consumables_df
+        project_names = df["Project name"].tolist()
+        self.cur.executemany(
+            "INSERT INTO staged_consumables (project_name, last_name, project_title, project_type, name, unit_cost, quantity, date, PPMS_reference) \
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            zip(
+                project_names,
+                [self._get_last_name_from_project_name(_) for _ in project_names],
+                [self._get_project_title_and_type(_)[0] for _ in project_names],
+                [self._get_project_title_and_type(_)[1] for _ in project_names],
+                df["Consumable name"].tolist(), df["Unit price"].tolist(), df["Quantity"].tolist(),
+                df["month"].tolist(), df["Ref."].tolist()
+                )
+            )
+
     def _make_user_invoices(self):
+        """
+        Make the invoice of each user in its own savepoint. With --commit_every the users are
+        invoiced N at a time: the invoices of each N users are populated and committed and only
+        then are their documents rendered. If a user fails, it is rolled back to its savepoint
+        and the users invoiced before it are committed and rendered so that a rerun can pick up
+        where the run stopped. Without --commit_every the whole period is rolled back.
+        """
+        # The (user_id, invoice_id) of each invoice to populate once all of its users' charges are made
+        self.invoices_to_populate = []
         for user_last_name in self.user_last_names_to_invoice:
-            
-            self.current_user = self._get_or_make_user_for_invoicing(user_last_name)
-            
-            self.current_invoice = self._get_or_make_invoice()
+            n_invoices_to_populate = len(self.invoices_to_populate)
+            try:
+                with self.transaction.savepoint(), self.profiler.unit(user_last_name):
+                    self._make_user_invoice(user_last_name)
+            except Exception:
+                if self.transaction.commit_every:
+                    print(f"\nInvoicing {user_last_name} failed. Committing the users invoiced before it.")
+                    # The invoice of the failed user has been rolled back with its savepoint
+                    self._populate_and_write_invoices(self.invoices_to_populate[:n_invoices_to_populate])
+                    self._commit_invoiced_users()
+                raise
+            if self.transaction.commit_due():
+                self._populate_and_write_invoices(self.invoices_to_populate)
+                self._commit_invoiced_users()
+                self.invoices_to_populate = []
+
+        # The documents of the remaining users are rendered once the period has been committed
+        self._populate_and_write_invoices(self.invoices_to_populate)
+
+    def _commit_invoiced_users(self):
+        """
+        Commit the users invoiced so far, then render their documents and record them in a
+        transaction of their own so that no document is written for an invoice that isn't committed.
+        """
+        with self.profiler.phase("refresh_rollups"):
+            self._refresh_rollups([self.first_month])
+        self.transaction.commit()
+        self._render_queued_templates()
+        self.transaction.commit()
+
+    def _make_user_invoice(self, user_last_name):
+
+        self.current_user = self._get_or_make_user_for_invoicing(user_last_name)
+
+        self.current_invoice = self._get_or_make_invoice()
+
+        if self.current_invoice.sent:
+            # Then this invoice has already been sent and we should not be modifying it so we will skip
+            print("An invoice already exists that has been sent.\nSkipping this user and moving to next.\n")
+            return
+        # Find projects that are of the user in the PPMS input and check to see if they match projects in the database
+        # If they do not match then create the project in a similar way to users above
+        # For each project, make sure that a charge exists or create if it does not.
+        # Delete any existing charges from the db for the user for this period that aren't included
+        # in the current PPMS input.
+
+        # Keep track of the db charge objects that are related to the PPMS input
+        # NB it may be that there were other charges that were already in the db that were
+        # related to the invoice that may have been wrong and we don't want to include
+        # these. As such we should delete any charges that belong to the current invoice
+        # that aren't in the self.charge_ids_related_to_PPMS_invoice
+        self.charge_ids_related_to_PPMS_invoice = []
+        for proj_of_user in [_ for _ in self.hours_charged_df.index if user_last_name.replace(" ", "_") in _]:
+            self.current_project = self._get_or_make_project(proj_of_user)
+
+            self._get_or_make_charge(proj_of_user)
 
-            if self.current_invoice.sent:
-                # Then this invoice has already been sent and we should not be modifying it so we will skip
-                print("An invoice already exists that has been sent.\nSkipping this user and moving to next.\n")
+        self._check_for_and_delete_unused_or_old_charges()
+
+        self.invoices_to_populate.append((self.current_user.user_id, self.current_invoice.invoice_id))
+
+    def _make_user_invoices_batch(self):
+        """
+        Set based equivalent of _make_user_invoices.
+        The users, projects, invoices and staff_time_charges relevant to the charging period
+        are read into in memory indexes once and diffed against self.hours_charged_df in a single pass.
+        The resulting inserts, updates and deletes are then applied using executemany
+        so that the number of round trips to the db does not grow with the number of PPMS projects.
+        """
+        print("\nMaking invoices in batch mode.")
+        # The total staff hours for each of the PPMS projects for the charging period
+        staff_hours_by_project = self.hours_charged_df.sum(axis=1).to_dict()
+        # The PPMS projects grouped by the last name of the user they belong to.
+        ppms_projects_by_last_name = {}
+        for proj_of_user in self.hours_charged_df.index:
+            ppms_projects_by_last_name.setdefault(self._get_last_name_from_project_name(proj_of_user), []).append(proj_of_user)
+
+        # Users
+        user_index = self._load_batch_user_index()
+        for user_last_name in self.user_last_names_to_invoice:
+            if user_last_name not in user_index:
+                # New users require interactive input so we fall back to the single user path.
+                self._get_or_make_user_for_invoicing(user_last_name)
+                user_index = self._load_batch_user_index()
+
+        # Invoices
+        invoice_index = self._load_batch_invoice_index()
+        invoices_to_insert = []
+        invoices_to_update = []
+        invoice_timestamp = datetime.datetime.now()
+        for user_last_name in self.user_last_names_to_invoice:
+            user_id, staff_subsidy_percent = user_index[user_last_name]
+            if user_id in invoice_index:
+                assert(len(invoice_index[user_id]) == 1)
+                invoice_id, first_month, last_month, sent = invoice_index[user_id][0]
+                if first_month == self.first_month and last_month == self.last_month:
+                    if not sent:
+                        invoices_to_update.append({"timestamp": invoice_timestamp, "chargeable_account": self.chargeable_account, "invoice_id": invoice_id})
+                else:
+                    raise NotImplementedError(
+                        f"One or more invoices exist for user {user_last_name} \
+                            which have a charging period that over lap with the user specified charging period.\n{invoice_index[user_id]}"
+                            )
+            else:
+                invoices_to_insert.append(
+                    {
+                        "timestamp": invoice_timestamp, "first_month": self.first_month, "last_month":self.last_month,
+                        "chargeable_account":self.chargeable_account, "user_id":user_id, "amount_payable":99999.99
+                        }
+                    )
+        self.cur.executemany(
+            "UPDATE invoices SET invoice_timestamp=:timestamp, chargeable_account=:chargeable_account WHERE invoice_id=:invoice_id",
+            invoices_to_update
+            )
+        self.cur.executemany(
+            "INSERT INTO invoices(invoice_timestamp, first_month, last_month, chargeable_account, user_id, amount_payable) VALUES (:timestamp, :first_month, :last_month, :chargeable_account, :user_id, :amount_payable)",
+            invoices_to_insert
+            )
+        print(f"{len(invoices_to_insert)} invoices created. {len(invoices_to_update)} existing unsent invoices updated.")
+        invoice_index = self._load_batch_invoice_index()
+
+        # Invoices that have already been sent must not be modified so we drop their users here.
+        users_to_invoice = []
+        for user_last_name in self.user_last_names_to_invoice:
+            user_id, staff_subsidy_percent = user_index[user_last_name]
+            if invoice_index[user_id][0][3]:
+                print(f"An invoice already exists for {user_last_name} that has been sent.\nSkipping this user and moving to next.\n")
                 continue
-            # Find projects that are of the user in the PPMS input and check to see if they match projects in the database
-            # If they do not match then create the project in a similar way to users above
-            # For each project, make sure that a charge exists or create if it does not.
-            # Delete any existing charges from the db for the user for this period that aren't included
-            # in the current PPMS input.
-            
-            # Keep track of the db charge objects that are related to the PPMS input
-            # NB it may be that there were other charges that were already in the db that were
-            # related to the invoice that may have been wrong and we don't want to include
-            # these. As such we should delete any charges that belong to the current invoice
-            # that aren't in the self.charge_ids_related_to_PPMS_invoice
-            self.charge_ids_related_to_PPMS_invoice = []
-            for proj_of_user in [_ for _ in self.hours_charged_df.index if user_last_name.replace(" ", "_") in _]:
-                self.current_project = self._get_or_make_project(proj_of_user)
-                
-                self._get_or_make_charge(proj_of_user)
-            
-            self._check_for_and_delete_unused_or_old_charges()
+            users_to_invoice.append(user_last_name)
+
+        # Projects
+        project_index = self._load_batch_project_index()
+        projects_to_insert = []
+        for user_last_name in users_to_invoice:
+            user_id, staff_subsidy_percent = user_index[user_last_name]
+            for proj_of_user in ppms_projects_by_last_name.get(user_last_name, []):
+                proj_title, proj_type = self._get_project_title_and_type(proj_of_user)
+                assert(proj_type in ["bioinf", "wetlab", "training"])
+                if user_id in [_[1] for _ in project_index.get((proj_title, proj_type), [])]:
+                    continue
+                if self._get_n_y_user_response(question_text=f"\n\nProject with title: {proj_title} does not exist in the database. \n\nWould you like to create this project now?\nEntering n will skip this project.\n[y/n]:", decision=(NEW_PROJECT, proj_of_user)) == "y":
+                    if self._get_n_y_user_response(question_text=f"\n\nProject details are:\n\ttitle: {proj_title}\n\tproject_type: {proj_type}\n\tuser: {user_last_name}\n\tIs this correct? Entering n will exit the program so that you can correct the project information in PPMS input.\n[y/n]: ", decision=(NEW_PROJECT, proj_of_user)) == "y":
+                        projects_to_insert.append({"title": proj_title, "proj_type": proj_type, "user_id": user_id})
+                    else:
+                        sys.exit("\nExiting at users request.")
+        self.cur.executemany(
+            "INSERT INTO projects (project_title, project_type, user_id) VALUES (:title, :proj_type, :user_id)",
+            projects_to_insert
+            )
+        if projects_to_insert:
+            print(f"{len(projects_to_insert)} projects created.")
+            project_index = self._load_batch_project_index()
+
+        # Staff time charges
+        charge_index = self._load_batch_staff_charge_index()
+        charges_to_insert = []
+        charges_to_update = []
+        charges_to_keep = set()
+        for user_last_name in users_to_invoice:
+            user_id, staff_subsidy_percent = user_index[user_last_name]
+            invoice_id = invoice_index[user_id][0][0]
+            for proj_of_user in ppms_projects_by_last_name.get(user_last_name, []):
+                proj_title, proj_type = self._get_project_title_and_type(proj_of_user)
+                project_rows = project_index.get((proj_title, proj_type), [])
+                assert(len(project_rows) == 1)
+                project_id = project_rows[0][0]
+                staff_hours = staff_hours_by_project[proj_of_user]
+                existing_charges = charge_index.get((invoice_id, project_id), [])
+                if existing_charges:
+                    assert(len(existing_charges) == 1)
+                    obj_charge_id, obj_project_title, obj_staff_hours, obj_staff_hourly_rate_eur, obj_staff_subsidy_percent = existing_charges[0]
+                    if (obj_staff_hours, obj_staff_hourly_rate_eur, obj_staff_subsidy_percent) != (staff_hours, self.staff_hourly_rate_eur, staff_subsidy_percent):
+                        print(
+                            f"Modifying staff_time_charges object {obj_charge_id} already in database: "
+                            f"{obj_staff_hours}, {obj_staff_hourly_rate_eur}, {obj_staff_subsidy_percent} --> "
+                            f"{staff_hours}, {self.staff_hourly_rate_eur}, {staff_subsidy_percent}"
+                            )
+                        charges_to_update.append(
+                            {
+                                "staff_hours": staff_hours, "staff_hourly_rate_eur": self.staff_hourly_rate_eur,
+                                "subsidy_percent": staff_subsidy_percent, "charge_id": obj_charge_id
+                                }
+                            )
+                    charges_to_keep.add(obj_charge_id)
+                else:
+                    charges_to_insert.append(
+                        {
+                            "staff_hours": staff_hours, "staff_hourly_rate_eur": self.staff_hourly_rate_eur,
+                            "subsidy_percent": staff_subsidy_percent, "invoice_id": invoice_id,
+                            "project_id": project_id
+                            }
+                        )
 
-            self._populate_and_write_template()
+        # Any charges that belong to the invoices of this run but that are not
+        # in the current PPMS input are old or wrong and must be deleted.
+        invoice_ids_to_check = {invoice_index[user_index[_][0]][0][0] for _ in users_to_invoice}
+        charges_to_delete = []
+        for (invoice_id, project_id), existing_charges in charge_index.items():
+            if invoice_id not in invoice_ids_to_check:
+                continue
+            for charge in existing_charges:
+                if charge[0] not in charges_to_keep:
+                    charges_to_delete.append(charge)
+        if charges_to_delete:
+            print("Deleting the following old charges")
+            print("charge_id\tproject_title\tstaff_hours\tstaff_hourly_rate_eur\tsubsidy_percent")
+            for charge in charges_to_delete:
+                print("\t".join([str(_) for _ in charge]))
 
-        print("\nOutput of invoices complete.")
+        self.cur.executemany(
+            "INSERT INTO staff_time_charges (staff_hours, staff_hourly_rate_eur, subsidy_percent, invoice_id, project_id) \
+                VALUES (:staff_hours, :staff_hourly_rate_eur, :subsidy_percent, :invoice_id, :project_id)",
+            charges_to_insert
+            )
+        self.cur.executemany(
+            "UPDATE staff_time_charges SET staff_hours=:staff_hours, staff_hourly_rate_eur=:staff_hourly_rate_eur, subsidy_percent=:subsidy_percent WHERE charge_id=:charge_id",
+            charges_to_update
+            )
+        self.cur.executemany(
+            "DELETE FROM staff_time_charges WHERE charge_id=:charge_id",
+            [{"charge_id": _[0]} for _ in charges_to_delete]
+            )
+        print(f"{len(charges_to_insert)} staff_time_charges created, {len(charges_to_update)} updated and {len(charges_to_delete)} deleted.")
 
-        print("Invoicing Complete.")
+        # Finally populate the invoices and queue their documents. They are rendered once the period has been committed
+        self._populate_and_write_invoices([
+            (user_index[_][0], invoice_index[user_index[_][0]][0][0]) for _ in users_to_invoice
+            ])
+
+    def _load_batch_user_index(self):
+        """
+        Index of user last_name to (user_id, staff_subsidy_percent) for all users in the db.
+        """
+        self.cur.execute("SELECT last_name, user_id, staff_subsidy_percent FROM users")
+        return {last_name: (user_id, staff_subsidy_percent) for last_name, user_id, staff_subsidy_percent in self.cur.fetchall()}
+
+    def _load_batch_invoice_index(self):
+        """
+        Index of user_id to a list of (invoice_id, first_month, last_month, sent) for the debit invoices
+        that start within the charging period.
+        As for _get_or_make_invoice, a user being invoiced may only have one such invoice.
+        """
+        self.cur.execute(
+            "SELECT user_id, invoice_id, first_month, last_month, sent FROM invoices WHERE invoice_type='debit' AND first_month >=:user_defined_first_month AND first_month <= :user_defined_last_month",
+            {"user_defined_first_month":self.first_month, "user_defined_last_month":self.last_month}
+            )
+        invoice_index = {}
+        for user_id, invoice_id, first_month, last_month, sent in self.cur.fetchall():
+            invoice_index.setdefault(user_id, []).append((invoice_id, first_month, last_month, sent))
+        return invoice_index
+
+    def _load_batch_project_index(self):
+        """
+        Index of (project_title, project_type) to a list of (project_id, user_id).
+        """
+        self.cur.execute("SELECT project_title, project_type, project_id, user_id FROM projects")
+        project_index = {}
+        for project_title, project_type, project_id, user_id in self.cur.fetchall():
+            project_index.setdefault((project_title, project_type), []).append((project_id, user_id))
+        return project_index
+
+    def _load_batch_staff_charge_index(self):
+        """
+        Index of (invoice_id, project_id) to a list of
+        (charge_id, project_title, staff_hours, staff_hourly_rate_eur, subsidy_percent)
+        for the staff_time_charges of the debit invoices that start within the charging period.
+        """
+        self.cur.execute(
+            "SELECT staff_time_charges.invoice_id, staff_time_charges.project_id, charge_id, project_title, staff_hours, staff_hourly_rate_eur, subsidy_percent \
+                FROM staff_time_charges INNER JOIN projects ON projects.project_id = staff_time_charges.project_id \
+                    WHERE invoice_id IN (SELECT invoice_id FROM invoices WHERE invoice_type='debit' AND first_month >=:user_defined_first_month AND first_month <= :user_defined_last_month)",
+            {"user_defined_first_month":self.first_month, "user_defined_last_month":self.last_month}
+            )
+        charge_index = {}
+        for invoice_id, project_id, *charge in self.cur.fetchall():
+            charge_index.setdefault((invoice_id, project_id), []).append(tuple(charge))
+        return charge_index
+
+    @staticmethod
+    def _get_project_title_and_type(project_string):
+        return ":".join(project_string.split(":")[1:]).strip(), project_string.split(':')[0].split("_")[-1]
 
     def _apply_credits_for_user(self):
         """
@@ -419,7 +1060,6 @@ class Invoicing:
                                 "current_user_id": self.current_user.user_id
                                 }
                                 )
-                self.con.commit()
                 # Then make credit_debit object if available credit
                 credit_used = self._make_credit_debit_object_for_invoices_if_available_credit()
                     
@@ -439,9 +1079,10 @@ class Invoicing:
 
     def _make_credit_debit_object_for_invoices_if_available_credit(self):
         # If a credit debit does not exist, then check to see if there is avialable credit
-        if self.current_user.available_credit > 0:
+        available_credit = self.current_user.available_credit
+        if available_credit > 0:
             # If so then create a credit debit object and associate it to the current invoice.
-            if self.current_user.available_credit > self.current_invoice.balance:
+            if available_credit > self.current_invoice.balance:
                 credit_used = self.current_invoice.balance
                 # If the amount of credit available is greater than the balance of the invoice
                 # then make a credit_debit for the amount of the invoice balance
@@ -454,21 +1095,19 @@ class Invoicing:
                                 "current_user_id":self.current_user.user_id
                                 }
                                 )
-                self.con.commit()
             else:
-                credit_used = self.current_user.available_credit
+                credit_used = available_credit
                 # If the balance of the invoice is greater than the available credit
                 # then make a credit_debit for the amount of the available credit
                 self.cur.execute(
                         "insert into credit_debit (amount, debit_invoice_id, user_id) \
                             values(:available_credit, :current_invoice_id, :current_user_id)", 
                             {
-                                "available_credit": self.current_user.available_credit, 
+                                "available_credit": available_credit, 
                                 "current_invoice_id": self.current_invoice.invoice_id, 
                                 "current_user_id":self.current_user.user_id
                                 }
                                 )
-                self.con.commit()
             self.current_invoice.credit_used_against_this_invoice + credit_used
             self.current_invoice.balance -= credit_used
             return credit_used
@@ -495,12 +1134,24 @@ class Invoicing:
         delete_ids = [_[0] for _ in results]
         for delete_id in delete_ids:
             self.cur.execute("DELETE FROM staff_time_charges WHERE charge_id = :delete_id", {"delete_id":delete_id})
-            self.con.commit()
+
+    def _populate_and_write_invoices(self, user_and_invoice_ids):
+        """
+        Populate and write the invoice of each (user_id, invoice_id) in user_and_invoice_ids.
+        The lines and totals of all of the invoices are computed together before any is populated.
+        """
+        from invoice_totals import compute_invoice_totals
+        with self.profiler.phase("populate_invoices"):
+            self.invoice_totals = compute_invoice_totals(self.con, [_[1] for _ in user_and_invoice_ids])
+            for user_id, invoice_id in user_and_invoice_ids:
+                self.current_user = self.repository.get_user(user_id)
+                self.current_invoice = self.repository.get_invoice(invoice_id, reload=True)
+                with self.profiler.unit(self.current_user.last_name):
+                    self._populate_and_write_template()
 
     def _populate_and_write_template(self):
         # Here populate the template
         # Populate the user and invoice data
-        self.doc = DocxTemplate(self.template_path)
         self._populate_context()
         
         # Apply credits to the
@@ -509,28 +1160,101 @@ class Invoicing:
         
         self._write_template()
 
-        # At this point we have all of the projects and charges created and associated to the users invoice.
-        # We can now commit
-        self.con.commit()
-
         # The final thing to do is to update the invoice amount_payable to self.current_invoice.balance
         # And if this is > 0 then to create an outstanding payment object.
         self.current_invoice.amount_payable = self.current_invoice.balance
 
     def _write_template(self):
-        self.doc.render(self.context)
-        outpath = os.path.join(self.output_dir, f"{self.first_month}_{self.last_month}_{self.current_user.last_name.replace(' ', '_')}_SequAna_Invoice.docx")
-        if os.path.exists(outpath):
-            if self._get_n_y_user_response(question_text=f"\n\n{outpath} already exists.\nOverwrite? [y/n]: ") == "y":
-                self.doc.save(outpath)
-                print(f"\nWriting {outpath}.")
+        """
+        Queue the invoice documents, one per output format, for rendering.
+        The queued documents are rendered by _render_queued_templates once their
+        invoices have been committed.
+        A document whose context, format and template are unchanged since it was
+        last written is not rendered again.
+        """
+        context_json = context_to_json(self.context)
+        for extension in self.output_formats:
+            outpath = self._get_invoice_outpath(self.current_user.last_name, extension)
+            if self.plan:
+                # Nothing is written by a plan so there is nothing to overwrite
+                self.render_jobs.append((self.template_path, self.context, outpath))
+                continue
+            document_hash = context_hash(context_json, extension, self.template_hash if extension == "docx" else None)
+            recorded = load_recorded_document(self.cur, os.path.abspath(outpath))
+            if recorded is not None and recorded[1] == document_hash:
+                if not os.path.exists(outpath):
+                    # Re-issue the document from the context it was rendered from
+                    print(f"\n{outpath} is missing. Re-issuing it from its recorded context.")
+                    self._queue_invoice_document(outpath, json.loads(recorded[2]), document_hash, recorded[2])
+                    continue
+                if is_written_document(outpath, recorded):
+                    print(f"\n{outpath} is unchanged. Skipping.")
+                    continue
+            # A document that is as it was written by an earlier run is overwritten without asking
+            if os.path.exists(outpath) and not is_written_document(outpath, recorded):
+                if self._get_n_y_user_response(question_text=f"\n\n{outpath} already exists.\nOverwrite? [y/n]: ", decision=(OVERWRITE, outpath)) == "y":
+                    self._queue_invoice_document(outpath, self.context, document_hash, context_json)
+                else:
+                    print("Commiting db objects and moving to next invoice.")
             else:
-                print("Commiting db objects and moving to next invoice.")
+                self._queue_invoice_document(outpath, self.context, document_hash, context_json)
+
+    def _queue_invoice_document(self, outpath, context, document_hash, context_json):
+        self.render_jobs.append((self.template_path, context, outpath))
+        self.documents_to_record[os.path.abspath(outpath)] = {
+            "path": os.path.abspath(outpath), "invoice_id": self.current_invoice.invoice_id,
+            "context_hash": document_hash, "context_json": context_json
+            }
+
+    def _output_plan(self, tables_before_run):
+        """
+        Report the invoices and the changes to the db that the run would make.
+        """
+        # invoice_id to the invoice row. An invoice has one document per output format
+        invoices = {}
+        for template_path, context, outpath in self.planned_documents:
+            if context["invoice_id"] in invoices:
+                invoices[context["invoice_id"]]["document"] += f",{outpath}"
+                continue
+            invoices[context["invoice_id"]] = {
+                "invoice_id": context["invoice_id"], "user_name": context["user_name"],
+                "total_staff_hours": context["total_staff_hours"], "amount_payable_staff": context["amount_payable_staff"],
+                "total_consumables_amount_payable": context["total_consumables_amount_payable"],
+                "applied_available_credit": context["user_balance"]["applied_available_credit"],
+                "balance": context["balance"], "document": outpath
+                }
+        plan = {
+            "first_month": self.first_month, "last_month": self.last_month,
+            "invoices": list(invoices.values()), "changes": diff_snapshots(tables_before_run, snapshot_tables(self.con))
+            }
+        print_plan(plan)
+        if self.args.plan_json:
+            write_plan_json(self.args.plan_json, plan)
+            print(f"\nPlan written to {self.args.plan_json}")
+
+    def _get_invoice_outpath(self, user_last_name, extension="docx"):
+        return os.path.join(self.output_dir, f"{self.first_month}_{self.last_month}_{user_last_name.replace(' ', '_')}_SequAna_Invoice.{extension}")
+
+    def _render_queued_templates(self):
+        if self.plan:
+            # A plan renders no documents. They are reported by _output_plan
+            self.planned_documents.extend(self.render_jobs)
         else:
-            self.doc.save(outpath)
-            print(f"\nWriting {outpath}.")
+            from rendering import render_documents
+            with self.profiler.phase("render_documents"):
+                render_documents(self.render_jobs, workers=self.workers, template_cache_dir=self.template_cache_dir)
+                self.documents_written += len(self.render_jobs)
+                # Record what each document was rendered from so that a rerun can skip it if it is unchanged
+                documents = list(self.documents_to_record.values())
+                for document in documents:
+                    document["document_sha256"] = file_sha256(document["path"])
+                record_documents(self.cur, documents)
+        self.render_jobs = []
+        self.documents_to_record = {}
 
     def _populate_context(self):
+        # The invoice object is shared for the run so start its totals afresh
+        self.current_invoice.reset_totals()
         self.context = {}
         self.context["invoice_id"] = self.current_invoice.invoice_id
         self.context["invoice_date"] = self.current_invoice.invoice_timestamp.split(" ")[0].replace("-", "")
@@ -539,12 +1263,12 @@ class Invoicing:
         self.context["user_name"] = f"{self.current_user.last_name}, {self.current_user.first_name}"
         self.context["user_email"] = self.current_user.email
 
-        # Charge data for wetlab projects
-        # Get wetlab projects for the user
-        self._populate_context_with_projects_for_project_type("wetlab")
-        self._populate_context_with_projects_for_project_type("bioinf")
-        self._populate_context_with_projects_for_project_type("training")
-        self._populate_context_with_consumable_costs()
+        # Charge data for the wetlab, bioinf and training projects and the consumables
+        # as computed for the whole batch by _populate_and_write_invoices
+        lines_context, totals = self.invoice_totals[self.current_invoice.invoice_id]
+        self.context.update(lines_context)
+        for total, value in totals.items():
+            setattr(self.current_invoice, total, value)
 
         self.context["total_consumables_cost"] = f"{self.current_invoice.total_consumable_cost:.2f}"
         self.context["total_consumables_subsidy"] = f"{self.current_invoice.total_comsumables_subsidy_amount:.2f}"
@@ -559,43 +1283,6 @@ class Invoicing:
         self.context["amount_payable_staff"] = f"{self.current_invoice.total_staff_cost - self.current_invoice.total_staff_subsidy_amount:.2f}"
         self.context["balance"] = f"{self.current_invoice.balance:.2f}"
 
-    def _populate_context_with_consumable_costs(self):
-        self.cur.execute(
-            "SELECT name, unit_cost, quantity, subsidy_percent \
-            FROM consumable_charges \
-            WHERE invoice_id=:invoice_id ORDER BY name ASC", 
-            {"invoice_id": self.current_invoice.invoice_id}
-            )
-        results = self.cur.fetchall()
-        if results:
-            self.context["consumables"] = []
-        else:
-            # If there are no consumables then no need to proceed.
-            return
-        
-        for con_charge in results:
-            name, unit_cost, quantity, subsidy_percent = con_charge
-            con_cost = unit_cost * quantity
-            subsidy_dec = subsidy_percent/100
-            subtotal = con_cost - (con_cost * subsidy_dec)
-            
-            self.current_invoice.total_consumable_cost += con_cost
-            self.current_invoice.total_comsumables_subsidy_amount += con_cost * subsidy_dec
-            self.current_invoice.total_consumables_amount_payable += subtotal
-
-            self.current_invoice.balance += subtotal
-            self.context[f"consumables"].append(
-                {
-                    "name": name,
-                    "quantity": f"{quantity}",
-                    "unit_cost": f"{unit_cost:.2f}",
-                    "cost": f"{con_cost:.2f}",
-                    "subsidy": f"{subsidy_percent:.2f}",
-                    "subtotal": f"{subtotal:.2f}"
-                }
-            )
-        
-
     def _get_or_make_charge(self, proj_of_user):
         # Now make a staff charge for the project
         staff_hours = self.hours_charged_df.loc[proj_of_user,:].sum()
@@ -650,15 +1337,14 @@ class Invoicing:
         results = self.cur.fetchall()
         if not results:
             # The project does not already exist and we need to create the project
-            if self._get_n_y_user_response(question_text=f"\n\nProject with title: {proj_title} does not exist in the database. \n\nWould you like to create this project now?\nEntering n will skip this project.\n[y/n]:") == "y":
+            if self._get_n_y_user_response(question_text=f"\n\nProject with title: {proj_title} does not exist in the database. \n\nWould you like to create this project now?\nEntering n will skip this project.\n[y/n]:", decision=(NEW_PROJECT, proj_of_user)) == "y":
                         
-                if self._get_n_y_user_response(question_text=f"\n\nProject details are:\n\ttitle: {proj_title}\n\tproject_type: {proj_type}\n\tuser: {self.current_user.first_name} {self.current_user.last_name} {self.current_user.email}\n\tIs this correct? Entering n will exit the program so that you can correct the project information in PPMS input.\n[y/n]: ") == "y":
+                if self._get_n_y_user_response(question_text=f"\n\nProject details are:\n\ttitle: {proj_title}\n\tproject_type: {proj_type}\n\tuser: {self.current_user.first_name} {self.current_user.last_name} {self.current_user.email}\n\tIs this correct? Entering n will exit the program so that you can correct the project information in PPMS input.\n[y/n]: ", decision=(NEW_PROJECT, proj_of_user)) == "y":
                     # Create the project
                     self.cur.execute(
                                 "INSERT INTO projects (project_title, project_type, user_id) VALUES (:title, :proj_type, :user_id)",
                                 {"title": proj_title, "proj_type": proj_type, "user_id": self.current_user.user_id}
                                 )
-                    self.con.commit()
                 else:
                     sys.exit("\nExiting at users request.")
         else:
@@ -667,7 +1353,7 @@ class Invoicing:
         self.cur.execute("SELECT project_id, project_title, project_type FROM projects WHERE project_title=:proj_title AND project_type=:proj_type", {"proj_title": proj_title, "proj_type":proj_type})
         results = self.cur.fetchall()
         assert(len(results) == 1)
-        return Project(results[0][0], con=self.con)
+        return self.repository.get_project(results[0][0])
 
     def _get_or_make_invoice(self):
         # Now check to see if there are already invoices linked to this user for the given period
@@ -710,7 +1396,6 @@ class Invoicing:
                     # matches the user supplied chargeable account.
                     self.cur.execute("UPDATE invoices SET invoice_timestamp=:timestamp, chargeable_account=:chargeable_account WHERE invoice_id=:invoice_id",
                     {"timestamp": datetime.datetime.now(), "chargeable_account":self.chargeable_account, "invoice_id":invoice_id})
-                    self.con.commit()
                     # Then pull the results back out of the database
                     self.cur.execute(
                         "SELECT invoice_id, first_month, last_month, invoice_timestamp, chargeable_account, sent FROM invoices WHERE invoice_id=:invoice_id",
@@ -732,24 +1417,22 @@ class Invoicing:
                     )
             
             self.cur.execute("SELECT invoice_id, first_month, last_month, invoice_timestamp, chargeable_account, sent FROM invoices WHERE invoice_id=:invoice_id", {"invoice_id": self.cur.lastrowid})
-            self.con.commit()
             result = self.cur.fetchall()
             assert(len(result) == 1)
-        return Invoice(result[0][0], self.con)
+        return self.repository.get_invoice(result[0][0], reload=True)
 
     def _get_or_make_user_for_invoicing(self, user_last_name):
         self.cur.execute("SELECT last_name FROM users where last_name=:user_last_name", {"user_last_name": user_last_name})
         results = self.cur.fetchall()
         if not results:
                 # Then the user is not already in the database and it needs to be added or skipped
-            if self._get_n_y_user_response(question_text=f"\n\nUser with last name: {user_last_name} does not exist in the database. Would you like to create this user now?\nEntering n will exit the script.\n[y/n]:") == "y":
+            if self._get_n_y_user_response(question_text=f"\n\nUser with last name: {user_last_name} does not exist in the database. Would you like to create this user now?\nEntering n will exit the script.\n[y/n]:", decision=(NEW_USER, user_last_name)) == "y":
                     # Create the user
                 first_name, user_last_name, email, staff_subsidy, consumable_subsidy = self._get_first_name_email_subsidy_of_user(user_last_name)
                 self.cur.execute(
                         "INSERT INTO users (first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent) VALUES (:first_name, :user_last_name, :email, :staff_subsidy, :consumable_subsidy)",
                         {"first_name":first_name, "user_last_name":user_last_name, "email":email, "staff_subsidy":staff_subsidy, "consumable_subsidy":consumable_subsidy}
                         )
-                self.con.commit()
                 print(f"User {first_name} {user_last_name} successfully added to database.")
             else:
                 sys.exit(f"Exiting script at users request.")
@@ -759,39 +1442,94 @@ class Invoicing:
         # Now get the user_id for use in creating the invoice, projects and charges
         # If user chose to skip then the user will not exist and we will move on to the next user.
         self.cur.execute("SELECT user_id FROM users WHERE last_name=:user_last_name", {"user_last_name": user_last_name})
-        return User(self.cur.fetchone()[0], con=self.con)
+        return self.repository.get_user(self.cur.fetchone()[0])
 
-    def _populate_context_with_projects_for_project_type(self, project_type):
-        self.cur.execute(
-            "SELECT staff_hours, staff_hourly_rate_eur, subsidy_percent, project_type, project_title \
-                FROM staff_time_charges INNER JOIN projects ON projects.project_id = staff_time_charges.project_id \
-                    WHERE invoice_id=:invoice_id AND project_type=:project_type ORDER BY staff_hours DESC", 
-                    {"invoice_id": self.current_invoice.invoice_id, "project_type":project_type}
-                    )
-        results = self.cur.fetchall()
-        self.context[f"{project_type}_projects"] = []
-        for user_charge in results:
-            staff_hours, staff_hourly_rate_eur, subsidy_percent, project_type, project_title = user_charge
-            staff_cost = staff_hours * staff_hourly_rate_eur
-            subsidy_dec = subsidy_percent/100
-            subtotal = staff_cost - (staff_cost * subsidy_dec)
-            self.current_invoice.balance += subtotal
-            self.current_invoice.total_staff_hours += staff_hours
-            self.current_invoice.total_staff_cost += staff_cost
-            self.current_invoice.total_staff_subsidy_amount += staff_cost * subsidy_dec
-            self.context[f"{project_type}_projects"].append(
-                {
-                    "project_title": project_title,
-                    "staff_hours": f"{staff_hours:.2f}",
-                    "staff_hourly_rate_eur": f"{staff_hourly_rate_eur:.2f}",
-                    "staff_cost": f"{staff_cost:.2f}",
-                    "subsidy": f"{subsidy_percent:.2f}",
-                    "subtotal": f"{subtotal:.2f}"
-                }
-            )
-            self.current_invoice.charges_count += 1
+    def _load_decisions(self):
+        """
+        If a decisions file was given, the run is unattended and every question must be answered by it.
+        """
+        if self.args.decisions:
+            self.decisions = Decisions.from_file(self.args.decisions)
+            self.unattended = True
+
+    def _resolve_decisions(self):
+        """
+        Pre-pass that finds all of the questions that the run will ask and answers them
+        up front, from the decisions file or else by asking, so that the rest of the run
+        does not wait for input. An unattended run lists any questions that the
+        decisions file does not answer and exits.
+        """
+        questions = self._get_run_questions()
+        unanswered = [_ for _ in questions if self.decisions.get_answer(_[0], _[1]) is None]
+        if unanswered and self.unattended:
+            print("\nThe decisions file does not answer the following questions:")
+            print("decision\tsubject")
+            for decision, subject, question_text, allow_skip in unanswered:
+                print(f"{decision}\t{subject}")
+            sys.exit("Exiting")
+
+        for decision, subject, question_text, allow_skip in unanswered:
+            answer = self._get_n_y_user_response(question_text=question_text, allow_skip=allow_skip)
+            if decision == NEW_USER:
+                if answer != "y":
+                    sys.exit(f"Exiting script at users request.")
+                first_name, last_name, email, staff_subsidy, consumable_subsidy = self._get_first_name_email_subsidy_of_user(subject)
+                self.decisions.add_new_user(last_name, first_name, email, staff_subsidy, consumable_subsidy)
+                continue
+            if decision == NEW_PROJECT and answer == "y":
+                proj_title, proj_type = self._get_project_title_and_type(subject)
+                if self._get_n_y_user_response(question_text=f"\n\nProject details are:\n\ttitle: {proj_title}\n\tproject_type: {proj_type}\n\tuser: {self._get_last_name_from_project_name(subject)}\n\tIs this correct? Entering n will exit the program so that you can correct the project information in PPMS input.\n[y/n]: ") != "y":
+                    sys.exit("\nExiting at users request.")
+            self.decisions.add_answer(decision, subject, answer)
+
+        for decision, subject, question_text, allow_skip in questions:
+            if decision == SIMILAR_NAME and self.decisions.get_answer(decision, subject) != "y":
+                sys.exit("Exiting at users request")
+
+    def _get_run_questions(self):
+        """
+        Returns a list of the (decision, subject, question_text, allow_skip) of the questions that the run will ask.
+        """
+        questions = []
+        for last_name, close_matches in self.similar_last_names.items():
+            questions.append((SIMILAR_NAME, last_name, f"One of the last names in the PPMS output is very similar to one or more other last names:\n{last_name} is similar to {close_matches}.\nDo you want to continue anyway? [y/n]. Enter n to exit the program and fix the PPMS input.", True))
+        for proj_name, close_matches in self.similar_project_names.items():
+            questions.append((SIMILAR_NAME, proj_name, f"One of the project names in the PPMS output is very similar to one or more other project names:\n{proj_name} is similar to {close_matches}.\nDo you want to continue anyway?\nEnter n to exit the program and fix the PPMS input.\n [y/n]: ", False))
+
+        # The PPMS projects of the users being invoiced, including those that only have consumables
+        ppms_projects = [_ for _ in self.hours_charged_df.index]
+        if self.args.PPMS_input_consumables_csv:
+            ppms_projects.extend(self.consumables_df["Project name"])
+        ppms_projects = list(dict.fromkeys(ppms_projects))
+
+        self.cur.execute("SELECT last_name FROM users")
+        db_last_names = {_[0] for _ in self.cur.fetchall()}
+        last_names = dict.fromkeys(list(self.user_last_names_to_invoice) + [self._get_last_name_from_project_name(_) for _ in ppms_projects])
+        for last_name in last_names:
+            if last_name not in db_last_names:
+                questions.append((NEW_USER, last_name, f"\n\nUser with last name: {last_name} does not exist in the database. Would you like to create this user now?\nEntering n will exit the script.\n[y/n]:", True))
+
+        self.cur.execute("SELECT project_title, project_type, last_name FROM projects INNER JOIN users ON users.user_id=projects.user_id")
+        db_projects = set(self.cur.fetchall())
+        for proj_of_user in ppms_projects:
+            proj_title, proj_type = self._get_project_title_and_type(proj_of_user)
+            if (proj_title, proj_type, self._get_last_name_from_project_name(proj_of_user)) not in db_projects:
+                questions.append((NEW_PROJECT, proj_of_user, f"\n\nProject with title: {proj_title} does not exist in the database. \n\nWould you like to create this project now?\nEntering n will skip this project.\n[y/n]:", True))
+
+        for last_name in self.user_last_names_to_invoice:
+            for extension in self.output_formats:
+                outpath = self._get_invoice_outpath(last_name, extension)
+                # Documents written by an earlier run that have not been changed since are never asked about
+                if os.path.exists(outpath) and not self.plan and not is_written_document(outpath, load_recorded_document(self.cur, os.path.abspath(outpath))):
+                    questions.append((OVERWRITE, outpath, f"\n\n{outpath} already exists.\nOverwrite? [y/n]: ", True))
+        return questions
 
     def _get_first_name_email_subsidy_of_user(self, last_name=None):
+        new_user = self.decisions.get_new_user(last_name)
+        if new_user is not None:
+            return new_user
+        if self.unattended:
+            sys.exit(f"\nThe decisions file has no new_user decision for {last_name}. Exiting.")
         if last_name is None:
             last_name = input("Please provide the last name of the user: ")
         first_name = input("Please provide the first name of the user: ")
@@ -805,16 +1543,17 @@ class Invoicing:
         if self._get_n_y_user_response(question_text=f"\n\nFirst name: {first_name}\nLast name: {last_name}\nEmail: {email}\nStaff cost subsidy: {staff_subsidy_percent}\nConsumable cost subsidy: {consumable_subsidy_percent}\nIs this correct? [y/n]: ") == "y":
             return first_name, last_name, email, staff_subsidy_percent, consumable_subsidy_percent
         else:
-            self._get_first_name_email_subsidy_of_user(last_name)
+            return self._get_first_name_email_subsidy_of_user(last_name)
 
-    def _do_argument_qc(self):
+    def _do_argument_qc(self, first_month, last_month):
         """
-        Do a range of QC on the arguments provided on the command line and explicitly return the
-        self variables that will be used in the remainder of the program for readability purposes
+        Do a range of QC on the arguments provided on the command line for the billing period
+        from first_month to last_month and explicitly return the self variables that will be
+        used in the remainder of the program for readability purposes
         """
         self.skip_user_input = self.args.answer_yes
 
-        self._do_first_last_month_qc()
+        self._do_first_last_month_qc(first_month, last_month)
         
         if self.args.PPMS_input_consumables_csv:
             self._do_ppms_input_consumables_csv_qc()
@@ -822,19 +1561,39 @@ class Invoicing:
         self.month_range, self.hours_charged_df = self._do_ppms_input_staff_hours_csv_qc()
                 
         self.user_last_names_to_invoice = self._do_user_input_qc()
-        
-        self._do_template_qc()
+
+        # The extensions of the documents written for each invoice
+        self.output_formats = OUTPUT_FORMATS[self.args.format]
+
+        # The template is only needed for the .docx documents
+        if "docx" in self.output_formats:
+            self._do_template_qc()
+            # Part of the hash of each .docx document so that a change of template re-renders the invoices
+            from template_cache import get_template_cache
+            self.template_hash = get_template_cache().template_hash(self.template_path)
+        else:
+            self.template_path = None
+            self.template_hash = None
 
         self.chargeable_account = self.args.chargeable_account
 
         self.staff_hourly_rate_eur = self.args.staff_hourly_rate_eur
 
+        # The (template_path, context, outpath) of each of the invoices to be rendered
+        self.render_jobs = []
+        self.documents_written = 0
+        # The absolute outpath of each of the queued invoices to its record in invoice_documents. See invoice_documents.py
+        self.documents_to_record = {}
+        self.workers = self.args.workers
+        self.template_cache_dir = self.args.template_cache_dir
+
+        # A plan writes nothing so the directories are not needed
         self.output_dir = os.path.abspath(self.args.output_dir)
-        if not os.path.exists(self.output_dir):
+        if not os.path.exists(self.output_dir) and not self.plan:
             os.makedirs(self.output_dir)
 
         self.db_backup_dir = self.args.db_backup_dir
-        if not os.path.exists(self.db_backup_dir):
+        if not os.path.exists(self.db_backup_dir) and not self.plan:
             os.makedirs(self.db_backup_dir, exist_ok=True)
 
         return self.month_range, self.hours_charged_df, self.user_last_names_to_invoice, self.chargeable_account, self.staff_hourly_rate_eur, self.output_dir
@@ -893,11 +1652,11 @@ class Invoicing:
                 raise RuntimeError("user_last_names_to_invoice list is empty")
 
         # run two: check for similarity in values
-        for last_name in self.user_last_names_to_invoice:
-            close_matches = get_close_matches(last_name, [_ for _ in self.user_last_names_to_invoice if _ != last_name], n=99, cutoff=0.8)
-            if close_matches:
-                if self._get_n_y_user_response(question_text=f"One of the last names in the PPMS output is very similar to one or more other last names:\n{last_name} is similar to {close_matches}.\nDo you want to continue anyway? [y/n]. Enter n to exit the program and fix the PPMS input.") != 'y':
-                    sys.exit("Exiting at users request")
+        # New last names are also checked against the last names of the users already in the db
+        # The user is asked about them in _resolve_decisions
+        self.cur.execute("SELECT last_name FROM users")
+        db_last_names = [_[0] for _ in self.cur.fetchall()]
+        self.similar_last_names = self._find_similar_names(self.user_last_names_to_invoice, db_last_names)
 
         # Trim down the input to only those of the requested users
         if self.user_last_names_to_invoice:
@@ -910,11 +1669,35 @@ class Invoicing:
 
         return self.user_last_names_to_invoice
 
+    def _find_similar_names(self, names, known_names):
+        """
+        find_similar_names of names against themselves and the known_names from the db.
+        The result for the same names is reused by the later periods of a run. The only names added
+        to the db by the earlier periods are from the same PPMS inputs, and have been compared already,
+        and any questions about the similar names have been answered.
+        """
+        key = frozenset(names)
+        if key not in self.similar_names_cache:
+            self.similar_names_cache[key] = find_similar_names(names, known_names=known_names)
+        return self.similar_names_cache[key]
+
     @staticmethod
     def _get_last_name_from_project_name(project_string):
         return "_".join(project_string.split(":")[0].split("_")[:-1]).replace("_", " ")
 
-    def _get_n_y_user_response(self, question_text, allow_skip=True):
+    def _get_n_y_user_response(self, question_text, allow_skip=True, decision=None):
+        """
+        decision is the (decision type, subject) that answers the question (see decisions.py).
+        If the question has been answered in the decisions, that answer is used.
+        An unattended run exits rather than wait for an answer.
+        """
+        if decision is not None:
+            answer = self.decisions.get_answer(*decision)
+            if answer is not None:
+                print(f"Answering {answer} to: {question_text}")
+                return answer
+        if self.unattended:
+            sys.exit(f"\nThe decisions file does not answer: {question_text}\nExiting.")
         try:
             if self.skip_user_input and allow_skip:
                 print(f"Answering y to: {question_text}")
@@ -933,83 +1716,25 @@ class Invoicing:
     def _do_ppms_input_consumables_csv_qc(self):
         # QC of consumables inputs
         # There should be only one such file
-        self.ppms_consumables_input_csv_path = self.args.PPMS_input_consumables_csv
-        if not os.path.exists(self.ppms_consumables_input_csv_path):
-            raise FileNotFoundError(f"{self.ppms_consumables_input_csv_path} not found.")
-        
-        self.consumables_df = df = pd.read_csv(self.ppms_consumables_input_csv_path, encoding = "ISO-8859-1")
-        self.consumables_df.drop("Group", axis=1, inplace=True)
-        self.consumables_df.drop("User", axis=1, inplace=True)
-        
-        # Convert the Completed date from DD/MM/YYY TT:TT to YYYYMM
-        self.consumables_df["month"] = [self._format_completed_date(_) for _ in self.consumables_df["Completed date"]]
-        self.consumables_df.drop("Completed date", axis=1, inplace=True)
+        # It is only read once for all of the periods of a run
+        if self.ppms_consumables_df is None:
+            import pandas as pd
+            self.ppms_consumables_input_csv_path = self.args.PPMS_input_consumables_csv
+            if not os.path.exists(self.ppms_consumables_input_csv_path):
+                raise FileNotFoundError(f"{self.ppms_consumables_input_csv_path} not found.")
+            
+            self.ppms_consumables_df = pd.read_csv(self.ppms_consumables_input_csv_path, encoding = "ISO-8859-1")
+            self.ppms_consumables_df.drop("Group", axis=1, inplace=True)
+            self.ppms_consumables_df.drop("User", axis=1, inplace=True)
+            
+            # Convert the Completed date from DD/MM/YYY TT:TT to YYYYMM
+            self.ppms_consumables_df["month"] = [self._format_completed_date(_) for _ in self.ppms_consumables_df["Completed date"]]
+            self.ppms_consumables_df.drop("Completed date", axis=1, inplace=True)
+        self.consumables_df = self.ppms_consumables_df
         
         # Filter down to only those months that fall within the first and last month
         self.consumables_df = self.consumables_df.loc[(self.consumables_df["month"] >= int(self.first_month)) & (self.consumables_df["month"] <= int(self.last_month)),:]
 
-    def _create_consumable_charge(self, ser):
-        # We should be able to get the user, project and invoice  or make them  using the project_info only.
-        last_name = self._get_last_name_from_project_name(ser["Project name"])
-        
-        # Then we need to create the project and the invoice
-        self.current_user = self._get_or_make_user_for_invoicing(user_last_name=last_name)
-        self.current_project = self._get_or_make_project(ser["Project name"])
-        self.current_invoice = self._get_or_make_invoice()
-        
-        # Then we need to create a consumable charge
-        self.cur.execute(
-            "INSERT INTO consumable_charges (name, unit_cost, quantity, date, invoice_id, project_id, PPMS_reference) VALUES (:name, :unit_cost, :quantity, :date, :invoice_id, :project_id, :PPMS_reference)",
-            {"name": ser["Consumable name"], "unit_cost": ser["Unit price"], "quantity": ser["Quantity"], "date": ser["month"], "invoice_id": self.current_invoice.invoice_id, "project_id": self.current_project.project_id, "PPMS_reference": ser["Ref."]}
-            )
-        self.con.commit()
-        
-    def _consumable_charge_exits(self, project_id, invoice_id, name, date, unit_cost, quantity, ref):
-        self.cur.execute(
-            "SELECT charge_id from consumable_charges where project_id=:project_id AND invoice_id=:invoice_id AND name=:name AND date=:date AND unit_cost=:unit_cost AND quantity=:quantity AND PPMS_reference=:ref",
-            {"project_id": project_id, "invoice_id": invoice_id, "name": name, "date": date, "unit_cost":unit_cost, "quantity": quantity, "ref":ref}
-            )
-        if len(self.cur.fetchall()) == 1:
-            return True
-        return False
-
-    def _get_invoice_id(self, user_id):
-        self.cur.execute(
-            "SELECT invoice_id from invoices where user_id=:user_id AND first_month<=:first_month AND last_month>=:last_month", 
-            {"first_month":int(self.first_month), "last_month":int(self.last_month), "user_id": user_id}
-            )
-        return self.cur.fetchall()[0][0]
-    
-    def _invoice_exists(self, user_id):
-        self.cur.execute(
-            "SELECT invoice_id from invoices where user_id=:user_id AND first_month<=:first_month AND last_month>=:last_month", 
-            {"first_month":int(self.first_month), "last_month":int(self.last_month), "user_id": user_id}
-            )
-        if len(self.cur.fetchall()) == 1:
-            return True
-        else:
-            return False
-
-    def _get_project_id_user_id_from_project(self, project_name):
-        project_title = ":".join(project_name.split(":")[1:]).strip()
-        project_type = project_name.split(":")[0].split("_")[-1]
-        self.cur.execute("SELECT project_id, user_id FROM projects WHERE project_title=:project_title AND projects.project_type=:project_type", {"project_title": project_title, "project_type": project_type})
-        results = self.cur.fetchall()
-        return results[0]
-
-    def _project_exists(self, project_name):
-        project_title = ":".join(project_name.split(":")[1:]).strip()
-        project_type = project_name.split(":")[0].split("_")[-1]
-        last_name = self._get_last_name_from_project_name(project_name)
-        self.cur.execute("SELECT projects.project_id, projects.user_id FROM projects INNER JOIN users ON projects.user_id = users.user_id WHERE projects.project_title=:project_title AND projects.project_type=:project_type AND users.last_name=:last_name", {"project_title": project_title, "project_type": project_type, "last_name": last_name })
-        results = self.cur.fetchall()
-        if len(results) == 1:
-            return True
-        if len(results) > 1:
-            raise RuntimeError("Multiple results returned when 1 was expected")
-        else:
-            return False
-
     def _do_ppms_input_staff_hours_csv_qc(self):
         # QC of PPMS_input_csvs
         self.ppms_input_csvs_paths = self.args.PPMS_input_staff_hours_csvs.split(",")
@@ -1019,46 +1744,13 @@ class Invoicing:
         
         # If all found then put them into one big df where the columns are in the format YYYYMM
         # There are likely to be two files for any given period
-        # one for ben and one for alyssa which separately log their respective hours
-        # A dict with year as key and df as value
-        year_to_df_dict = {}
-        for ppms_path in self.ppms_input_csvs_paths:
-            df = pd.read_csv(ppms_path, encoding = "ISO-8859-1")
-            df.set_index("Project", inplace=True)
-            year = list(df)[13].split(" ")[0]
-            df.drop(["Type", f"{year} Total"], inplace=True, axis=1)
-            # Check that we are left with only the 12 months
-            if len(list(df)) != 12:
-                raise RuntimeError("DataFrame formatting error")
-            # Change the columns to format YYYMM
-            new_cols = range(int(year)*100 + 1, (int(year)*100) + 13, 1)
-            df.columns = new_cols
-            df = df.fillna(0)
-
-            # Remove SequAana projects from the PPMS
-            df = df.loc[[_ for _ in df.index if "sequana" not in _.lower()], :]
-
-            if year in year_to_df_dict:
-                print(f"\n\nPPMS input {ppms_path} contains inputs for the same period as another PPMS input.")
-                print("The two inputs will be merged")
-                # Then a df for this year already exists and we need to merge the two dfs
-                # making sure to summate any two projects with exactly the same name
-                existing_df = year_to_df_dict[year]
-                existing_indices = existing_df.index
-                for ind, series in df.iterrows():
-                    if ind in existing_indices:
-                        # The exact same project exists in both dataframes
-                        existing_df.loc[ind, :] = existing_df.loc[ind, :].add(series)
-                    else:
-                        existing_df.loc[ind] = series
-                year_to_df_dict[year] = existing_df
-            else:
-                year_to_df_dict[year] = df
-                
-        
-        self.hours_charged_df = pd.concat(year_to_df_dict.values(), axis=1).fillna(0)
-        # Order the columns
-        self.hours_charged_df = self.hours_charged_df.loc[:,sorted(list(self.hours_charged_df))]
+        # one for ben and one for alyssa which separately log their respective hours.
+        # Hours for the same project in the same month are summed. See ppms_staff_hours.py
+        # They are only read once for all of the periods of a run
+        if self.ppms_staff_hours_df is None:
+            from ppms_staff_hours import load_staff_hours
+            self.ppms_staff_hours_df = load_staff_hours(self.ppms_input_csvs_paths)
+        self.hours_charged_df = self.ppms_staff_hours_df
 
         # Check that all of the months inbetween the first_month and last_month have data
         self.month_range = []
@@ -1091,11 +1783,11 @@ class Invoicing:
             proj_name = proj_index.split(":")[-1].rstrip().strip()
             projects.add(proj_name)
 
-        for proj_name in projects:
-            close_matches = get_close_matches(proj_name, [_ for _ in projects if _ != proj_name], n=99, cutoff=0.8)
-            if close_matches:
-                if self._get_n_y_user_response(allow_skip=False, question_text=f"One of the project names in the PPMS output is very similar to one or more other project names:\n{proj_name} is similar to {close_matches}.\nDo you want to continue anyway?\nEnter n to exit the program and fix the PPMS input.\n [y/n]: ") != 'y':
-                    sys.exit("Exiting at users request")
+        # New project names are also checked against the titles of the projects already in the db
+        self.cur.execute("SELECT project_title FROM projects")
+        db_project_titles = [_[0] for _ in self.cur.fetchall()]
+        # The user is asked about them in _resolve_decisions
+        self.similar_project_names = self._find_similar_names(projects, db_project_titles)
 
         # Trim down to the user specified months
         self.hours_charged_df = self.hours_charged_df.loc[:,self.month_range]
@@ -1105,13 +1797,13 @@ class Invoicing:
 
         return self.month_range, self.hours_charged_df
 
-    def _do_first_last_month_qc(self):
+    def _do_first_last_month_qc(self, first_month, last_month):
         # first and last month QC
-        self.first_month = str(self.args.first_month)
+        self.first_month = str(first_month)
         if len(self.first_month) != 6:
             raise FormatError("first_month should be in format YYYYMM")
         
-        self.last_month = str(self.args.last_month)
+        self.last_month = str(last_month)
         if len(self.last_month) != 6:
             raise FormatError("first_month should be in format YYYYMM")
 
@@ -1143,12 +1835,18 @@ class Invoicing:
             It can be used to make an invoice for one or more users across a single time period.'
             )
         create_invoices_parser.add_argument(
-            '--first_month', action='store', required=True,
-            help="The first month of the charging period to be charged. Fomat is YYYYMM."
+            '--first_month', action='store', required=False,
+            help="The first month of the charging period to be charged. Fomat is YYYYMM. Required unless --periods is given."
+            )
+        create_invoices_parser.add_argument(
+            '--last_month', action='store', required=False,
+            help="The last moth of the charging period. Fomat is YYYYMM. Required unless --periods is given."
             )
         create_invoices_parser.add_argument(
-            '--last_month', action='store', required=True,
-            help="The last moth of the charging period. Fomat is YYYYMM."
+            '--periods', action='store', required=False,
+            help="Instead of --first_month and --last_month, a comma separated list of charging periods that are invoiced in order \
+                in a single run, sharing the PPMS inputs and the template. Each is YYYYMM (a single month), YYYYMM-YYYYMM \
+                (a period from the first to the last month) or YYYYMM..YYYYMM (a period for each of the months). E.g. 202201..202212 to backfill a year."
             )
         create_invoices_parser.add_argument(
             '--PPMS_input_staff_hours_csvs', action='store', required=True,
@@ -1173,6 +1871,10 @@ class Invoicing:
             help='Path to the invoice template. If not specified a *sequana_invoice_template.docx will be searched for in current directory and used.\
                 If not found an error will be raised.'
         )
+        create_invoices_parser.add_argument(
+            '--format', action="store", required=False, default="docx", choices=list(OUTPUT_FORMATS),
+            help="The format of the invoice documents: docx (rendered from the --template), pdf (laid out directly as PDF) or both. Default: docx"
+            )
         create_invoices_parser.add_argument(
             '--output_dir', action='store', required=False, default='.',
             help='The directory in which the invoices will be written. Default is current directory.'
@@ -1189,10 +1891,55 @@ class Invoicing:
             '--answer_yes', action="store_true", required=False,
             help="When passed, all interactive prompts will be skipped as though the answer 'y' was given."
             )
+        create_invoices_parser.add_argument(
+            '--plan', action="store_true", required=False,
+            help="When passed, the run is made against an in memory copy of the database and no documents are rendered. \
+                The invoices and the changes that the run would make to the database are reported instead. invoicing.db is not changed."
+            )
+        create_invoices_parser.add_argument(
+            '--plan_json', action="store", required=False, default=None,
+            help="Optional. Make a plan (see --plan) and also write it to this .json file."
+            )
+        create_invoices_parser.add_argument(
+            '--decisions', action="store", required=False, default=None,
+            help="Optional. A .csv or .yml file of decisions that answer the questions of the run (new users, new projects, \
+                similar names and overwriting existing invoices) so that it can run unattended. \
+                The run exits before any work is done if a question is not answered. See decisions.py for the format."
+            )
+        create_invoices_parser.add_argument(
+            '--batch', action="store_true", required=False,
+            help="When passed, the users, projects, invoices and staff charges for the charging period are loaded once \
+                and all inserts, updates and deletes are applied in bulk rather than one user and project at a time. \
+                Recommended for large charging periods."
+            )
+        create_invoices_parser.add_argument(
+            '--workers', action="store", type=int, required=False, default=1,
+            help="The number of processes used to render the invoice documents once the database work is complete. Default: 1"
+            )
+        create_invoices_parser.add_argument(
+            '--template_cache_dir', action="store", required=False, default=None,
+            help="Optional. A directory in which the compiled invoice template is kept so that later runs do not need to recompile it."
+            )
+        create_invoices_parser.add_argument(
+            '--commit_every', action="store", type=int, required=False, default=None,
+            help="Optional. By default the run is made in a single transaction so that either all or none of its changes are saved. \
+                For very long runs, pass N to instead commit after every N users. The documents of each N users are written once they are committed. \
+                Can't be used with --batch, which always applies the whole period in a single transaction."
+            )
         create_invoices_parser.add_argument(
             '--db_backup_dir', action="store", required=False, default="db_backup",
             help="The directory in which backups of the database are made. Defaults to './db_backup'. A backup is automatically made after every successful run of create_invoices."
             )
+        create_invoices_parser.add_argument(
+            '--background_xlsx_export', action="store_true", required=False,
+            help="When passed, the .xlsx export of the database is written by a detached background process once the database changes have been committed \
+                so that the run returns right away. The result of the export is logged to a .log file next to the .xlsx."
+            )
+        create_invoices_parser.add_argument(
+            '--profile', action="store_true", required=False,
+            help="When passed, the wall time of each phase of the run and of each user, the count and time of every SQL statement \
+                and the peak memory are reported at the end of the run and written to a .json file in the output_dir."
+            )
         create_invoices_parser.set_defaults(func=self._init_create_invoices)
 
         # Create credit invoices
@@ -1209,17 +1956,43 @@ class Invoicing:
             help="The account that charged users should transfer the money to. Default: 1414 11171 08 2151040901"
             )
         create_credit_invoices_parser.add_argument(
-            '--template', action='store', required=True,
-            help='Path to the credit invoice template.'
+            '--template', action='store', required=False,
+            help='Path to the credit invoice template. Required unless --format is pdf.'
         )
+        create_credit_invoices_parser.add_argument(
+            '--format', action="store", required=False, default="docx", choices=list(OUTPUT_FORMATS),
+            help="The format of the credit invoice documents: docx (rendered from the --template), pdf (laid out directly as PDF) or both. Default: docx"
+            )
         create_credit_invoices_parser.add_argument(
             '--output_dir', action='store', required=False, default='.',
             help='The directory in which the credit invoices will be written. Default is current directory.'
         )
+        create_credit_invoices_parser.add_argument(
+            '--decisions', action="store", required=False, default=None,
+            help="Optional. A .csv or .yml file of decisions (e.g. overwrite,*,n) that answer the questions of the run so that it can run unattended. See decisions.py for the format."
+            )
+        create_credit_invoices_parser.add_argument(
+            '--workers', action="store", type=int, required=False, default=1,
+            help="The number of processes used to render the invoice documents once the database work is complete. Default: 1"
+            )
+        create_credit_invoices_parser.add_argument(
+            '--template_cache_dir', action="store", required=False, default=None,
+            help="Optional. A directory in which the compiled invoice template is kept so that later runs do not need to recompile it."
+            )
+        create_credit_invoices_parser.add_argument(
+            '--commit_every', action="store", type=int, required=False, default=None,
+            help="Optional. By default the run is made in a single transaction so that either all or none of its changes are saved. \
+                For very long runs, pass N to instead commit after every N users."
+            )
         create_credit_invoices_parser.add_argument(
             '--db_backup_dir', action="store", required=False, default="db_backup",
             help="The directory in which backups of the database are made. Defaults to './db_backup'. A backup is automatically made after every successful run of create_invoices."
             )
+        create_credit_invoices_parser.add_argument(
+            '--background_xlsx_export', action="store_true", required=False,
+            help="When passed, the .xlsx export of the database is written by a detached background process once the database changes have been committed \
+                so that the run returns right away. The result of the export is logged to a .log file next to the .xlsx."
+            )
         create_credit_invoices_parser.set_defaults(func=self._init_create_credit_invoices)
 
         # Set invoice as sent
@@ -1234,6 +2007,11 @@ class Invoicing:
             '--db_backup_dir', action="store", required=False, default="db_backup",
             help="The directory in which backups of the database are made. Defaults to './db_backup'. A backup is automatically made after every successful run of create_invoices."
             )
+        set_invoices_sent.add_argument(
+            '--background_xlsx_export', action="store_true", required=False,
+            help="When passed, the .xlsx export of the database is written by a detached background process once the database changes have been committed \
+                so that the run returns right away. The result of the export is logged to a .log file next to the .xlsx."
+            )
         set_invoices_sent.set_defaults(func=self._set_invoice_to_sent)
 
         # Set invoice as paid
@@ -1248,6 +2026,11 @@ class Invoicing:
             '--db_backup_dir', action="store", required=False, default="db_backup",
             help="The directory in which backups of the database are made. Defaults to './db_backup'. A backup is automatically made after every successful run of create_invoices."
             )
+        set_invoices_paid.add_argument(
+            '--background_xlsx_export', action="store_true", required=False,
+            help="When passed, the .xlsx export of the database is written by a detached background process once the database changes have been committed \
+                so that the run returns right away. The result of the export is logged to a .log file next to the .xlsx."
+            )
         set_invoices_paid.set_defaults(func=self._set_invoices_paid)
 
         # Create new user
@@ -1258,7 +2041,89 @@ class Invoicing:
             )
         make_new_user.set_defaults(func=self._make_new_user)
 
+        # Migrate the database
+        # This upgrades invoicing.db to the latest schema version.
+        # NB this is also done automatically at the start of every other subcommand.
+        migrate_db = subparsers.add_parser(
+            'migrate_db',
+            help='Upgrade invoicing.db to the latest schema version.'
+            )
+        migrate_db.set_defaults(func=self._migrate_db)
+
+        # Verify the credit balances
+        # This recomputes the credit balance of every user and compares them to the user_credit_balances ledger
+        verify_credit_balances = subparsers.add_parser(
+            'verify_credit_balances',
+            help='Recompute the credit balances of all users from scratch and report any drift from the user_credit_balances ledger.'
+            )
+        verify_credit_balances.add_argument(
+            '--repair', action="store_true", required=False,
+            help="When passed, the ledger is rebuilt from the recomputed balances if any drift is found."
+            )
+        verify_credit_balances.set_defaults(func=self._verify_credit_balances)
+
+        # Restore a backup
+        # This is used to restore invoicing.db from one of the snapshots made in the db_backup directory
+        restore_backup_parser = subparsers.add_parser(
+            'restore_backup',
+            help='Restore invoicing.db from a backup snapshot. A snapshot of the current database is taken first.'
+            )
+        restore_backup_parser.add_argument(
+            '--snapshot', action="store", required=False, default=None,
+            help="The timestamp (e.g. 20221123T101010) or the start of the sha256 of the snapshot to restore. Defaults to the most recent snapshot."
+            )
+        restore_backup_parser.add_argument(
+            '--list', action="store_true", required=False,
+            help="List the available snapshots rather than restoring one."
+            )
+        restore_backup_parser.add_argument(
+            '--db_backup_dir', action="store", required=False, default="db_backup",
+            help="The directory in which backups of the database are made. Defaults to './db_backup'."
+            )
+        restore_backup_parser.set_defaults(func=self._restore_backup)
+
+        # Check the query plans
+        # This checks that the queries made by the invoicing code are served by the indexes of invoicing.db
+        check_query_plans_parser = subparsers.add_parser(
+            'check_query_plans',
+            help='Check that none of the queries made by invoicing.py, users.py or invoices.py do a full table scan of invoicing.db. \
+                Exits with a non-zero status if any do.'
+            )
+        check_query_plans_parser.set_defaults(func=self._check_query_plans)
+
+        # Report
+        # This prints the finance reports from the monthly_rollups table that each run keeps up to date
+        report_parser = subparsers.add_parser(
+            'report',
+            help='Report the outstanding balances of the users, the revenue of each month by project type, the subsidy totals and the invoice aging.'
+            )
+        report_parser.add_argument(
+            '--report', action="store", required=False, default="all", choices=["all", "outstanding", "revenue", "subsidies", "aging"],
+            help="The report to print. Default: all"
+            )
+        report_parser.add_argument(
+            '--first_month', action='store', required=False, default=None,
+            help="Optional. Only report the invoices of this month and later. Format is YYYYMM."
+            )
+        report_parser.add_argument(
+            '--last_month', action='store', required=False, default=None,
+            help="Optional. Only report the invoices of this month and earlier. Format is YYYYMM."
+            )
+        report_parser.add_argument(
+            '--as_of', action='store', required=False, default=None,
+            help="The date the outstanding amounts are aged to. Format is YYYY-MM-DD. Default: today"
+            )
+        report_parser.add_argument(
+            '--refresh', action="store_true", required=False,
+            help="When passed, the monthly_rollups table is rebuilt from the whole history before reporting, e.g. after invoicing.db has been edited by hand."
+            )
+        report_parser.set_defaults(func=self._report)
+
         self.args = parser.parse_args()
+        # The batch path applies the whole period at once so it has no users to commit between
+        if getattr(self.args, "batch", False) and self.args.commit_every:
+            create_invoices_parser.error("--commit_every can't be used with --batch")
         self.args.func()
 
-Invoicing()
\ No newline at end of file
+if __name__ == "__main__":
+    Invoicing()
@@ -0,0 +1,199 @@
+"""
+Versioned schema migrations for invoicing.db.
+
+The version of the database schema is stored in the sqlite user_version pragma.
+Each migration is applied, in order, in its own transaction together with the
+bump of user_version so that a database is never left between versions.
+To change the schema, append a new migration to MIGRATIONS and describe the
+change in db_structure.txt. Never edit a migration that has already been released.
+"""
+
+import sqlite3
+
+# A list of (version, description, list of sql statements)
+MIGRATIONS = [
+    (
+        1, "Add the indexes used by the invoicing queries",
+        [
+            "CREATE INDEX IF NOT EXISTS invoices_user_id_invoice_type_first_month ON invoices (user_id, invoice_type, first_month)",
+            "CREATE INDEX IF NOT EXISTS invoices_invoice_type_first_month ON invoices (invoice_type, first_month)",
+            "CREATE INDEX IF NOT EXISTS invoices_invoice_timestamp ON invoices (invoice_timestamp)",
+            "CREATE INDEX IF NOT EXISTS staff_time_charges_invoice_id_project_id ON staff_time_charges (invoice_id, project_id)",
+            "CREATE INDEX IF NOT EXISTS consumable_charges_natural_key ON consumable_charges (invoice_id, project_id, name, date, unit_cost, quantity, PPMS_reference)",
+            "CREATE INDEX IF NOT EXISTS projects_project_title_project_type ON projects (project_title, project_type)",
+            "CREATE INDEX IF NOT EXISTS credit_debit_debit_invoice_id ON credit_debit (debit_invoice_id)",
+            "CREATE INDEX IF NOT EXISTS credit_debit_user_id ON credit_debit (user_id)",
+        ]
+    ),
+    (
+        2, "Add the user_credit_balances ledger maintained by triggers",
+        [
+            """CREATE TABLE user_credit_balances (
+                user_id INTEGER PRIMARY KEY,
+                total_credit REAL NOT NULL DEFAULT 0,
+                total_debit REAL NOT NULL DEFAULT 0,
+                FOREIGN KEY (user_id)
+                    REFERENCES users(user_id)
+                        ON UPDATE RESTRICT
+                        ON DELETE RESTRICT
+                )""",
+            # Only paid and sent credit invoices count towards a user's credit
+            """CREATE TRIGGER user_credit_balances_invoices_insert AFTER INSERT ON invoices
+                WHEN new.invoice_type='credit' AND new.sent=1 AND new.paid=1
+                BEGIN
+                    INSERT INTO user_credit_balances (user_id, total_credit) VALUES (new.user_id, new.amount_payable)
+                        ON CONFLICT (user_id) DO UPDATE SET total_credit=total_credit + excluded.total_credit;
+                END""",
+            """CREATE TRIGGER user_credit_balances_invoices_delete AFTER DELETE ON invoices
+                WHEN old.invoice_type='credit' AND old.sent=1 AND old.paid=1
+                BEGIN
+                    UPDATE user_credit_balances SET total_credit=total_credit - old.amount_payable WHERE user_id=old.user_id;
+                END""",
+            """CREATE TRIGGER user_credit_balances_invoices_update_old AFTER UPDATE OF invoice_type, sent, paid, amount_payable, user_id ON invoices
+                WHEN old.invoice_type='credit' AND old.sent=1 AND old.paid=1
+                BEGIN
+                    UPDATE user_credit_balances SET total_credit=total_credit - old.amount_payable WHERE user_id=old.user_id;
+                END""",
+            """CREATE TRIGGER user_credit_balances_invoices_update_new AFTER UPDATE OF invoice_type, sent, paid, amount_payable, user_id ON invoices
+                WHEN new.invoice_type='credit' AND new.sent=1 AND new.paid=1
+                BEGIN
+                    INSERT INTO user_credit_balances (user_id, total_credit) VALUES (new.user_id, new.amount_payable)
+                        ON CONFLICT (user_id) DO UPDATE SET total_credit=total_credit + excluded.total_credit;
+                END""",
+            """CREATE TRIGGER user_credit_balances_credit_debit_insert AFTER INSERT ON credit_debit
+                BEGIN
+                    INSERT INTO user_credit_balances (user_id, total_debit) VALUES (new.user_id, new.amount)
+                        ON CONFLICT (user_id) DO UPDATE SET total_debit=total_debit + excluded.total_debit;
+                END""",
+            """CREATE TRIGGER user_credit_balances_credit_debit_delete AFTER DELETE ON credit_debit
+                BEGIN
+                    UPDATE user_credit_balances SET total_debit=total_debit - old.amount WHERE user_id=old.user_id;
+                END""",
+            """CREATE TRIGGER user_credit_balances_credit_debit_update AFTER UPDATE OF amount, user_id ON credit_debit
+                BEGIN
+                    UPDATE user_credit_balances SET total_debit=total_debit - old.amount WHERE user_id=old.user_id;
+                    INSERT INTO user_credit_balances (user_id, total_debit) VALUES (new.user_id, new.amount)
+                        ON CONFLICT (user_id) DO UPDATE SET total_debit=total_debit + excluded.total_debit;
+                END""",
+            # Populate the ledger from the existing history
+            """INSERT INTO user_credit_balances (user_id, total_credit, total_debit)
+                SELECT user_id, SUM(total_credit), SUM(total_debit) FROM (
+                    SELECT user_id, amount_payable AS total_credit, 0 AS total_debit FROM invoices WHERE invoice_type='credit' AND sent=1 AND paid=1
+                    UNION ALL
+                    SELECT user_id, 0 AS total_credit, amount AS total_debit FROM credit_debit
+                    ) GROUP BY user_id""",
+        ]
+    ),
+    (
+        3, "Make the natural key of consumable_charges unique",
+        [
+            # This will fail, and leave the db at version 2, if there are duplicate consumable charges.
+            # They must be removed by hand before the migration can be applied.
+            "DROP INDEX IF EXISTS consumable_charges_natural_key",
+            "CREATE UNIQUE INDEX consumable_charges_natural_key ON consumable_charges (invoice_id, project_id, name, date, unit_cost, quantity, PPMS_reference)",
+        ]
+    ),
+    (
+        4, "Add invoice_documents to record the context each invoice document was rendered from",
+        [
+            """CREATE TABLE invoice_documents (
+                path TEXT PRIMARY KEY,
+                invoice_id INTEGER NOT NULL,
+                context_hash TEXT NOT NULL,
+                context_json TEXT NOT NULL,
+                document_sha256 TEXT NOT NULL,
+                FOREIGN KEY (invoice_id)
+                    REFERENCES invoices(invoice_id)
+                        ON UPDATE RESTRICT
+                        ON DELETE RESTRICT
+                )""",
+        ]
+    ),
+    (
+        5, "Add monthly_rollups of the charges and invoices of each month for the report subcommand",
+        [
+            """CREATE TABLE monthly_rollups (
+                month TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                project_type TEXT NOT NULL,
+                staff_hours REAL NOT NULL DEFAULT 0,
+                staff_cost REAL NOT NULL DEFAULT 0,
+                staff_subsidy REAL NOT NULL DEFAULT 0,
+                consumables_cost REAL NOT NULL DEFAULT 0,
+                consumables_subsidy REAL NOT NULL DEFAULT 0,
+                invoice_count INTEGER NOT NULL DEFAULT 0,
+                amount_payable REAL NOT NULL DEFAULT 0,
+                credit_applied REAL NOT NULL DEFAULT 0,
+                amount_unsent REAL NOT NULL DEFAULT 0,
+                amount_outstanding REAL NOT NULL DEFAULT 0,
+                amount_paid REAL NOT NULL DEFAULT 0,
+                outstanding_since TIMESTAMP,
+                PRIMARY KEY (month, user_id, project_type),
+                FOREIGN KEY (user_id)
+                    REFERENCES users(user_id)
+                        ON UPDATE RESTRICT
+                        ON DELETE RESTRICT
+                )""",
+            # Populate the rollups from the existing history. See rollups.refresh_rollups
+            """INSERT INTO monthly_rollups (month, user_id, project_type, staff_hours, staff_cost, staff_subsidy, consumables_cost, consumables_subsidy)
+                SELECT month, user_id, project_type, SUM(staff_hours), SUM(staff_cost), SUM(staff_subsidy), SUM(consumables_cost), SUM(consumables_subsidy) FROM (
+                    SELECT invoices.first_month AS month, invoices.user_id AS user_id, projects.project_type AS project_type,
+                        staff_hours, staff_hours * staff_hourly_rate_eur AS staff_cost,
+                        staff_hours * staff_hourly_rate_eur * staff_time_charges.subsidy_percent / 100 AS staff_subsidy,
+                        0 AS consumables_cost, 0 AS consumables_subsidy
+                        FROM invoices INNER JOIN staff_time_charges ON staff_time_charges.invoice_id = invoices.invoice_id
+                            INNER JOIN projects ON projects.project_id = staff_time_charges.project_id
+                                WHERE invoices.invoice_type = 'debit'
+                    UNION ALL
+                    SELECT invoices.first_month AS month, invoices.user_id AS user_id, projects.project_type AS project_type,
+                        0 AS staff_hours, 0 AS staff_cost, 0 AS staff_subsidy, unit_cost * quantity AS consumables_cost,
+                        unit_cost * quantity * consumable_charges.subsidy_percent / 100 AS consumables_subsidy
+                        FROM invoices INNER JOIN consumable_charges ON consumable_charges.invoice_id = invoices.invoice_id
+                            INNER JOIN projects ON projects.project_id = consumable_charges.project_id
+                                WHERE invoices.invoice_type = 'debit'
+                    ) GROUP BY month, user_id, project_type""",
+            """INSERT INTO monthly_rollups (month, user_id, project_type, invoice_count, amount_payable, credit_applied,
+                amount_unsent, amount_outstanding, amount_paid, outstanding_since)
+                SELECT invoices.first_month, invoices.user_id, invoices.invoice_type, COUNT(*), SUM(amount_payable),
+                    SUM((SELECT IFNULL(SUM(amount), 0) FROM credit_debit WHERE credit_debit.debit_invoice_id = invoices.invoice_id)),
+                    SUM(CASE WHEN sent = 0 THEN amount_payable ELSE 0 END),
+                    SUM(CASE WHEN sent = 1 AND paid = 0 THEN amount_payable ELSE 0 END),
+                    SUM(CASE WHEN paid = 1 THEN amount_payable ELSE 0 END),
+                    MIN(CASE WHEN sent = 1 AND paid = 0 THEN invoice_timestamp END)
+                    FROM invoices WHERE invoices.invoice_type IN ('debit', 'credit')
+                        GROUP BY invoices.first_month, invoices.user_id, invoices.invoice_type""",
+        ]
+    ),
+]
+
+
+def get_schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con, verbose=True):
+    """
+    Bring the database on con up to the latest schema version.
+    con must have been opened with isolation_level=None.
+    Returns the list of versions that were applied.
+    """
+    con: sqlite3.Connection
+    current_version = get_schema_version(con)
+    applied_versions = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        if verbose:
+            print(f"Migrating invoicing.db to schema version {version}: {description}")
+        con.execute("BEGIN")
+        try:
+            for statement in statements:
+                con.execute(statement)
+            # NB pragmas cannot take bound parameters
+            con.execute(f"PRAGMA user_version = {int(version)}")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+        applied_versions.append(version)
+    return applied_versions
@@ -0,0 +1,253 @@
+"""
+Rendering of the invoice documents straight to PDF.
+
+The invoices and credit invoices are laid out from the same contexts that are
+rendered into the .docx templates so that a PDF no longer has to be made by hand
+from each .docx. The layout is built in (it does not read the .docx template) and
+uses the standard Helvetica fonts that every PDF viewer provides, so nothing beyond
+the standard library is needed.
+
+The output only depends on the context: there are no creation dates and the
+document ID is the hash of the content, so that reruns can be compared by hash.
+Like rendering.py, nothing here touches the database so that the PDFs can be
+rendered by the worker processes.
+"""
+
+import hashlib
+import zlib
+
+# A4 in points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 50
+FONT_SIZE = 9
+LINE_HEIGHT = 13
+
+# The widths of the printable ASCII characters (32 to 126) in 1/1000 of the font size
+# from the Adobe font metrics of the standard fonts. Other characters use DEFAULT_WIDTH.
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ]
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+    ]
+DEFAULT_WIDTH = 556
+FONTS = {"F1": ("Helvetica", HELVETICA_WIDTHS), "F2": ("Helvetica-Bold", HELVETICA_BOLD_WIDTHS)}
+
+# The columns of the tables of charges: (heading, context key, width in points, right aligned)
+STAFF_COLUMNS = [
+    ("Project", "project_title", 185, False), ("Hours", "staff_hours", 50, True),
+    ("Rate (EUR)", "staff_hourly_rate_eur", 60, True), ("Cost (EUR)", "staff_cost", 60, True),
+    ("Subsidy (%)", "subsidy", 60, True), ("Subtotal (EUR)", "subtotal", 80, True),
+    ]
+CONSUMABLE_COLUMNS = [
+    ("Item", "name", 165, False), ("Quantity", "quantity", 50, True),
+    ("Unit cost (EUR)", "unit_cost", 80, True), ("Cost (EUR)", "cost", 60, True),
+    ("Subsidy (%)", "subsidy", 60, True), ("Subtotal (EUR)", "subtotal", 80, True),
+    ]
+PROJECT_TABLES = [("wetlab_projects", "Wetlab projects"), ("bioinf_projects", "Bioinformatics projects"), ("training_projects", "Training")]
+
+
+def text_width(text, font="F1", size=FONT_SIZE):
+    widths = FONTS[font][1]
+    return sum(widths[ord(_) - 32] if 32 <= ord(_) <= 126 else DEFAULT_WIDTH for _ in text) * size / 1000
+
+
+def _fit(text, width, font="F1", size=FONT_SIZE):
+    """
+    text shortened with ... so that it fits in width.
+    """
+    if text_width(text, font, size) <= width:
+        return text
+    while text and text_width(text + "...", font, size) > width:
+        text = text[:-1]
+    return text + "..."
+
+
+def _pdf_string(text):
+    # The standard fonts are used with WinAnsiEncoding, i.e. cp1252
+    encoded = text.encode("cp1252", errors="replace")
+    return b"(" + encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+class PDFDocument:
+    """
+    A minimal PDF writer. Text is laid out top down on A4 pages that are added as needed.
+    """
+    def __init__(self):
+        self.pages = []
+        self.y = None
+        self.new_page()
+
+    def new_page(self):
+        self.pages.append([])
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def ensure_space(self, height):
+        """
+        Start a new page if there is less than height left on the current one. Returns True if a page was started.
+        """
+        if self.y - height < MARGIN:
+            self.new_page()
+            return True
+        return False
+
+    def text(self, x, text, font="F1", size=FONT_SIZE, right_aligned=False):
+        if right_aligned:
+            x -= text_width(text, font, size)
+        self.pages[-1].append(b"BT /%s %d Tf %.2f %.2f Td %s Tj ET" % (font.encode(), size, x, self.y, _pdf_string(text)))
+
+    def rule(self, x_start=MARGIN, x_end=PAGE_WIDTH - MARGIN):
+        line_y = self.y + LINE_HEIGHT - 3
+        self.pages[-1].append(b"0.5 w %.2f %.2f m %.2f %.2f l S" % (x_start, line_y, x_end, line_y))
+
+    def line(self, text="", font="F1", size=FONT_SIZE):
+        self.ensure_space(LINE_HEIGHT)
+        if text:
+            self.text(MARGIN, text, font, size)
+        self.y -= max(LINE_HEIGHT, size + 4)
+
+    def key_values(self, rows, key_width=150):
+        for key, value in rows:
+            self.ensure_space(LINE_HEIGHT)
+            self.text(MARGIN, key, "F2")
+            self.text(MARGIN + key_width, _fit(str(value), PAGE_WIDTH - 2 * MARGIN - key_width))
+            self.y -= LINE_HEIGHT
+
+    def table(self, columns, rows):
+        """
+        Lay out rows (dicts) under the headings of columns. The headings are repeated on each new page.
+        """
+        def headings():
+            x = MARGIN
+            for heading, key, width, right_aligned in columns:
+                self.text(x + width - 4 if right_aligned else x, heading, "F2", right_aligned=right_aligned)
+                x += width
+            self.y -= LINE_HEIGHT
+            self.rule()
+
+        self.ensure_space(2 * LINE_HEIGHT)
+        headings()
+        for row in rows:
+            if self.ensure_space(LINE_HEIGHT):
+                headings()
+            x = MARGIN
+            for heading, key, width, right_aligned in columns:
+                value = _fit(str(row[key]), width - 8)
+                self.text(x + width - 4 if right_aligned else x, value, right_aligned=right_aligned)
+                x += width
+            self.y -= LINE_HEIGHT
+
+    def to_bytes(self):
+        """
+        The document as PDF bytes. The objects are always written in the same order with no dates.
+        """
+        font_ids = {name: 3 + i for i, name in enumerate(FONTS)}
+        first_page_id = 3 + len(FONTS)
+        page_ids = [first_page_id + 2 * i for i in range(len(self.pages))]
+        fonts = b" ".join(b"/%s %d 0 R" % (name.encode(), font_ids[name]) for name in FONTS)
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % _ for _ in page_ids), len(page_ids)),
+            ]
+        for name, (base_font, widths) in FONTS.items():
+            objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % base_font.encode())
+        for page_id, operations in zip(page_ids, self.pages):
+            objects.append(
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << %s >> >> /Contents %d 0 R >>"
+                % (PAGE_WIDTH, PAGE_HEIGHT, fonts, page_id + 1)
+                )
+            stream = zlib.compress(b"\n".join(operations), 9)
+            objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(stream), stream))
+
+        pdf = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for object_id, obj in enumerate(objects, start=1):
+            offsets.append(len(pdf))
+            pdf += b"%d 0 obj\n%s\nendobj\n" % (object_id, obj)
+        xref_offset = len(pdf)
+        pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+        for offset in offsets:
+            pdf += b"%010d 00000 n \n" % offset
+        document_id = hashlib.sha256(bytes(pdf)).hexdigest()[:32].encode()
+        pdf += b"trailer\n<< /Size %d /Root 1 0 R /ID [<%s> <%s>] >>\nstartxref\n%d\n%%%%EOF\n" % (
+            len(objects) + 1, document_id, document_id, xref_offset
+            )
+        return bytes(pdf)
+
+
+def _invoice_pdf(context):
+    doc = PDFDocument()
+    doc.line("SequAna Invoice", "F2", 16)
+    doc.line()
+    doc.key_values([
+        ("Invoice ID", context["invoice_id"]), ("Invoice date", context["invoice_date"]),
+        ("Invoice period", context["invoice_period"]), ("Name", context["user_name"]),
+        ("Email", context["user_email"]), ("Chargeable account", context["chargeable_account"]),
+        ])
+    for key, title in PROJECT_TABLES:
+        if context.get(key):
+            doc.line()
+            doc.line(title, "F2", 11)
+            doc.table(STAFF_COLUMNS, context[key])
+    if context.get("consumables"):
+        doc.line()
+        doc.line("Consumables", "F2", 11)
+        doc.table(CONSUMABLE_COLUMNS, context["consumables"])
+
+    doc.line()
+    doc.line("Summary", "F2", 11)
+    summary = [
+        ("Total staff hours", context["total_staff_hours"]),
+        ("Total staff cost (EUR)", context["total_staff_cost"]),
+        ("Total staff subsidy (EUR)", context["total_subsidy_amount"]),
+        ("Staff amount payable (EUR)", context["amount_payable_staff"]),
+        ("Total consumables cost (EUR)", context["total_consumables_cost"]),
+        ("Total consumables subsidy (EUR)", context["total_consumables_subsidy"]),
+        ("Consumables amount payable (EUR)", context["total_consumables_amount_payable"]),
+        ]
+    if "user_balance" in context:
+        summary.extend([
+            ("Starting available credit (EUR)", context["user_balance"]["starting_available_credit"]),
+            ("Applied available credit (EUR)", context["user_balance"]["applied_available_credit"]),
+            ("Closing available credit (EUR)", context["user_balance"]["closing_available_credit"]),
+            ])
+    doc.key_values(summary, key_width=200)
+    doc.line()
+    doc.key_values([("Balance payable (EUR)", context["balance"])], key_width=200)
+    return doc
+
+
+def _credit_invoice_pdf(context):
+    doc = PDFDocument()
+    doc.line("SequAna Credit Invoice", "F2", 16)
+    doc.line()
+    doc.key_values([
+        ("Invoice ID", context["invoice_id"]), ("Invoice date", context["invoice_date"]),
+        ("Name", context["user_name"]), ("Email", context["user_email"]),
+        ("Chargeable account", context["chargeable_account"]),
+        ])
+    doc.line()
+    doc.key_values([("Credit amount payable (EUR)", f"{float(context['amount']):.2f}")], key_width=200)
+    return doc
+
+
+def render_pdf(context, outpath):
+    """
+    Lay out context as a PDF at outpath. Credit invoice contexts (see Invoicing._queue_credit_invoice)
+    are told apart from standard invoice contexts by their amount.
+    """
+    doc = _credit_invoice_pdf(context) if "amount" in context else _invoice_pdf(context)
+    with open(outpath, "wb") as f:
+        f.write(doc.to_bytes())
+    return outpath
@@ -0,0 +1,93 @@
+"""
+Plans (dry runs) of create_invoices.
+
+A plan runs create_invoices against an in memory copy of invoicing.db, taken
+with a single read of the database, and renders no documents. The changes the
+run would make are found by diffing the tables of the copy before and after
+the run. They are reported as a table on the terminal and, optionally, as JSON.
+"""
+
+import json
+import sqlite3
+
+# The tables that a run of create_invoices can change and their primary keys
+PLANNED_TABLES = {
+    "users": "user_id",
+    "projects": "project_id",
+    "invoices": "invoice_id",
+    "staff_time_charges": "charge_id",
+    "consumable_charges": "charge_id",
+    "credit_debit": "credit_id",
+}
+
+# Columns whose changes are not reported as they change on every run
+IGNORED_COLUMNS = {"invoices": {"invoice_timestamp"}}
+
+
+def copy_db_to_memory(db_path, factory=sqlite3.Connection):
+    """
+    Returns a connection to an in memory copy of the database at db_path.
+    The copy is opened with isolation_level=None, and the given connection factory, as for invoicing.db.
+    """
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(":memory:", isolation_level=None, factory=factory)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+    return dst
+
+
+def snapshot_tables(con, tables=PLANNED_TABLES):
+    """
+    Returns a dict of table to a dict of primary key to a dict of column to value.
+    """
+    snapshot = {}
+    for table, primary_key in tables.items():
+        cur = con.execute(f"SELECT * FROM {table}")
+        columns = [_[0] for _ in cur.description]
+        snapshot[table] = {row[columns.index(primary_key)]: dict(zip(columns, row)) for row in cur.fetchall()}
+    return snapshot
+
+
+def diff_snapshots(before, after):
+    """
+    Returns a dict of table to a dict with the lists of inserted, updated and deleted rows.
+    Each updated row is given as {"key": primary key, "changes": {column: [old, new]}}.
+    """
+    diff = {}
+    for table in before:
+        ignored_columns = IGNORED_COLUMNS.get(table, set())
+        old_rows, new_rows = before[table], after[table]
+        updated = []
+        for key in sorted(old_rows.keys() & new_rows.keys()):
+            changes = {
+                column: [value, new_rows[key][column]] for column, value in old_rows[key].items()
+                if column not in ignored_columns and new_rows[key][column] != value
+                }
+            if changes:
+                updated.append({"key": key, "changes": changes})
+        diff[table] = {
+            "inserted": [new_rows[_] for _ in sorted(new_rows.keys() - old_rows.keys())],
+            "updated": updated,
+            "deleted": [old_rows[_] for _ in sorted(old_rows.keys() - new_rows.keys())],
+        }
+    return diff
+
+
+def write_plan_json(path, plan):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2, default=str)
+
+
+def print_plan(plan):
+    print("\n\nPlan. No changes have been made to invoicing.db and no documents have been written.\n")
+    print("invoice_id\tuser\tstaff_hours\tstaff_payable\tconsumables_payable\tcredit_applied\tbalance\tdocument")
+    for invoice in plan["invoices"]:
+        print("\t".join(str(invoice[_]) for _ in (
+            "invoice_id", "user_name", "total_staff_hours", "amount_payable_staff",
+            "total_consumables_amount_payable", "applied_available_credit", "balance", "document"
+            )))
+    print("\ntable\tinserted\tupdated\tdeleted")
+    for table, changes in plan["changes"].items():
+        print(f"{table}\t{len(changes['inserted'])}\t{len(changes['updated'])}\t{len(changes['deleted'])}")
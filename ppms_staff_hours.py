@@ -0,0 +1,86 @@
+"""
+Ingestion of the PPMS staff hours csv exports.
+
+Each export holds one year of hours with a row per project and the columns
+Project, Type, one column per month and a "YYYY Total" column. There is
+typically one export per member of staff per year.
+
+All exports are read concurrently with explicit dtypes and reshaped into a single
+long table of (project, month, hours). Projects that appear in several exports
+are merged with a single groupby-sum and the result is returned as a float
+matrix of projects by months (YYYYMM), as a DataFrame indexed by project name.
+"""
+
+import csv
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+ENCODING = "ISO-8859-1"
+
+
+def read_staff_hours_csv(ppms_path):
+    """
+    Read a single PPMS staff hours export.
+    Returns the year of the export and the (project, month, hours) of each of its cells
+    as three arrays. SequAna's own projects are not charged and are dropped.
+    """
+    with open(ppms_path, encoding=ENCODING, newline="") as f:
+        header = next(csv.reader(f))
+    # Columns are Project, Type, the 12 months and then the year total
+    year = header[14].split(" ")[0] if len(header) > 14 else None
+    month_cols = header[2:14]
+    if year is None or len(header) != 15 or header[14] != f"{year} Total" or len(set(month_cols)) != 12:
+        raise RuntimeError(f"DataFrame formatting error in {ppms_path}")
+
+    df = pd.read_csv(
+        ppms_path, encoding=ENCODING, usecols=["Project"] + month_cols,
+        dtype={"Project": str, **{_: "float64" for _ in month_cols}}
+        )
+    # Remove SequAana projects from the PPMS
+    df = df.loc[~df["Project"].str.lower().str.contains("sequana", regex=False)]
+
+    hours = np.nan_to_num(df[month_cols].to_numpy(dtype=np.float64))
+    months = np.arange(int(year)*100 + 1, int(year)*100 + 13, dtype=np.int64)
+    projects = df["Project"].to_numpy(dtype=object)
+    return year, np.repeat(projects, 12), np.tile(months, len(projects)), hours.ravel()
+
+
+def load_staff_hours(ppms_paths, max_workers=None):
+    """
+    Read all of the PPMS staff hours exports in ppms_paths and merge them.
+    Returns a DataFrame of hours with a row per project, in the order that the projects
+    are first seen, and a column per month (YYYYMM) of every year read, in order.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        exports = list(executor.map(read_staff_hours_csv, ppms_paths))
+
+    # The exports are combined a year at a time in the order that the years are first seen
+    years = list(dict.fromkeys(_[0] for _ in exports))
+    seen_years = set()
+    for ppms_path, (year, _, _, _) in zip(ppms_paths, exports):
+        if year in seen_years:
+            print(f"\n\nPPMS input {ppms_path} contains inputs for the same period as another PPMS input.")
+            print("The two inputs will be merged")
+        seen_years.add(year)
+    exports = sorted(exports, key=lambda _: years.index(_[0]))
+
+    long_df = pd.DataFrame({
+        "project": np.concatenate([_[1] for _ in exports]),
+        "month": np.concatenate([_[2] for _ in exports]),
+        "hours": np.concatenate([_[3] for _ in exports]),
+        })
+    # Intern the project names so that each is held once however many cells refer to it
+    project_codes, projects = pd.factorize(long_df["project"], sort=False)
+    month_codes, months = pd.factorize(long_df["month"], sort=True)
+    long_df["project_code"] = project_codes
+    long_df["month_code"] = month_codes
+
+    # Any project that appears in more than one export for the same month is summed
+    summed = long_df.groupby(["project_code", "month_code"], sort=False)["hours"].sum()
+    matrix = np.zeros((len(projects), len(months)), dtype=np.float64)
+    matrix[summed.index.get_level_values(0), summed.index.get_level_values(1)] = summed.to_numpy()
+
+    index = pd.Index([sys.intern(_) for _ in projects], name="Project")
+    return pd.DataFrame(matrix, index=index, columns=[int(_) for _ in months])
@@ -0,0 +1,251 @@
+"""
+Profiling of an invoicing run (the --profile option of create_invoices).
+
+The wall time of each phase of the run and of the work done for each user is recorded.
+Every SQL statement run on the connection is reported by sqlite3's trace callback. The
+statements are counted and timed grouped by their normalized text, i.e. with their
+literal values replaced by ?, as the callback is given the statement with its bound
+values expanded.
+
+The trace callback is only called when a statement starts, so to time a statement the
+connection is opened with ProfiledConnection, whose cursors mark when control returns
+from sqlite. A statement's time is the time from its trace to the return of the call
+that ran it, plus the time of any fetches of its rows. The Python work between calls
+is not counted.
+
+The statements run by triggers are reported by the trace callback with the text of
+the statement that fired them. They are counted as part of that statement.
+"""
+
+import heapq
+import json
+import re
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+TOP_N = 10
+
+
+def normalize_sql(sql):
+    """
+    Returns sql with its literal values replaced by ? and its whitespace collapsed.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", "?", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"(?<!IS )(?<!NOT )\bNULL\b", "?", sql, flags=re.IGNORECASE)
+    # Lists of values, e.g. IN (?, ?, ?), are the same statement whatever their length
+    sql = re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+    return " ".join(sql.split())
+
+
+def peak_rss_mb():
+    """
+    The peak resident memory of the process in MB or None where it can't be read.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return round(max_rss / (1024*1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        with self.connection.profiler.sql_call(self):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        with self.connection.profiler.sql_call(self):
+            return super().executemany(*args)
+
+    def fetchone(self):
+        with self.connection.profiler.sql_call(self, fetch=True):
+            return super().fetchone()
+
+    def fetchmany(self, *args):
+        with self.connection.profiler.sql_call(self, fetch=True):
+            return super().fetchmany(*args)
+
+    def fetchall(self):
+        with self.connection.profiler.sql_call(self, fetch=True):
+            return super().fetchall()
+
+    def __next__(self):
+        with self.connection.profiler.sql_call(self, fetch=True):
+            return super().__next__()
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    A connection whose cursors report their calls to self.profiler. See Profiler.attach.
+    """
+    profiler = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfiledCursor)
+
+    # The Connection shortcuts don't use self.cursor so are routed through it here
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class Profiler:
+    def __init__(self, top_n=TOP_N):
+        self.top_n = top_n
+        self.start = time.perf_counter()
+        # phase to [calls, seconds, peak_rss_mb at the end of the phase]
+        self.phases = {}
+        # user to seconds
+        self.units = {}
+        # normalized sql to [count, seconds, max_seconds]
+        self.statements = {}
+        # (seconds, sql) of the slowest single executions
+        self.slowest = []
+        # id of cursor to [normalized sql, sql, seconds] of the last statement it ran
+        self._executions = {}
+        # [normalized sql, sql, seconds] of the statement being run and when it was last timed from
+        self._current = None
+        self._since = None
+        self._in_call = False
+
+    def attach(self, con):
+        con.profiler = self
+        con.set_trace_callback(self._trace)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            calls_seconds = self.phases.setdefault(name, [0, 0.0, None])
+            calls_seconds[0] += 1
+            calls_seconds[1] += time.perf_counter() - start
+            calls_seconds[2] = peak_rss_mb()
+
+    @contextmanager
+    def unit(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.units[name] = self.units.get(name, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def sql_call(self, cursor, fetch=False):
+        """
+        Time a call into sqlite made by cursor. A fetch continues the timing of the
+        statement that the cursor last executed.
+        """
+        if self._in_call:
+            # e.g. executemany iterating a cursor for its parameters
+            yield
+            return
+        self._in_call = True
+        self._current = self._executions.get(id(cursor)) if fetch else None
+        self._since = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stop_timing()
+            if not fetch and self._current is not None:
+                self._finish(self._executions.pop(id(cursor), None))
+                self._executions[id(cursor)] = self._current
+            self._current = None
+            self._in_call = False
+
+    def _trace(self, sql):
+        if self._current is not None and self._current[1] == sql:
+            # A statement run by a trigger of the current statement
+            return
+        self._stop_timing()
+        if self._current is not None:
+            # The previous statement of the same call, e.g. a row of executemany, is complete
+            self._finish(self._current)
+        normalized_sql = normalize_sql(sql)
+        self.statements.setdefault(normalized_sql, [0, 0.0, 0.0])[0] += 1
+        self._current = [normalized_sql, sql, 0.0]
+        self._since = time.perf_counter()
+
+    def _stop_timing(self):
+        if self._current is not None and self._since is not None:
+            seconds = time.perf_counter() - self._since
+            self._current[2] += seconds
+            self.statements[self._current[0]][1] += seconds
+        self._since = time.perf_counter()
+
+    def _finish(self, execution):
+        if execution is None:
+            return
+        normalized_sql, sql, seconds = execution
+        statement = self.statements[normalized_sql]
+        statement[2] = max(statement[2], seconds)
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, (seconds, sql))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, sql))
+
+    def report(self, **details):
+        """
+        Returns the profile as a dict. details (e.g. the charging period) are included as given.
+        """
+        for execution in self._executions.values():
+            self._finish(execution)
+        self._executions = {}
+        statements = sorted(self.statements.items(), key=lambda _: _[1][1], reverse=True)
+        return {
+            **details,
+            "wall_seconds": round(time.perf_counter() - self.start, 6),
+            "peak_rss_mb": peak_rss_mb(),
+            "phases": {
+                name: {"calls": calls, "seconds": round(seconds, 6), "peak_rss_mb": rss}
+                for name, (calls, seconds, rss) in self.phases.items()
+                },
+            "users": {name: round(seconds, 6) for name, seconds in sorted(self.units.items(), key=lambda _: _[1], reverse=True)},
+            "sql": {
+                "statements": sum(_[1][0] for _ in statements),
+                "seconds": round(sum(_[1][1] for _ in statements), 6),
+                "by_statement": [
+                    {"sql": sql, "count": count, "seconds": round(seconds, 6), "max_seconds": round(max_seconds, 6)}
+                    for sql, (count, seconds, max_seconds) in statements
+                    ],
+                "slowest": [{"seconds": round(seconds, 6), "sql": sql} for seconds, sql in sorted(self.slowest, reverse=True)],
+                },
+            }
+
+
+def _short(sql, length=120):
+    return sql if len(sql) <= length else sql[:length - 3] + "..."
+
+
+def print_profile(profile, top_n=TOP_N):
+    print(f"\n\nProfile. Wall time {profile['wall_seconds']:.3f} s. Peak memory {profile['peak_rss_mb']} MB.")
+    print("\nphase\tcalls\tseconds\tpeak_rss_mb")
+    for name, phase in profile["phases"].items():
+        print(f"{name}\t{phase['calls']}\t{phase['seconds']:.3f}\t{phase['peak_rss_mb']}")
+    print(f"\nThe {top_n} slowest of {len(profile['users'])} users")
+    print("user\tseconds")
+    for name, seconds in list(profile["users"].items())[:top_n]:
+        print(f"{name}\t{seconds:.3f}")
+    sql = profile["sql"]
+    print(f"\n{sql['statements']} SQL statements ({len(sql['by_statement'])} distinct) took {sql['seconds']:.3f} s")
+    print(f"\nThe {top_n} statements that took the most time")
+    print("count\tseconds\tmax_seconds\tsql")
+    for statement in sql["by_statement"][:top_n]:
+        print(f"{statement['count']}\t{statement['seconds']:.3f}\t{statement['max_seconds']:.4f}\t{_short(statement['sql'])}")
+    print(f"\nThe {top_n} slowest single statements")
+    print("seconds\tsql")
+    for statement in sql["slowest"]:
+        print(f"{statement['seconds']:.4f}\t{_short(' '.join(statement['sql'].split()))}")
+
+
+def write_profile_json(path, profile):
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
@@ -0,0 +1,107 @@
+"""
+Check that the queries issued by the invoicing code are served by indexes.
+
+Every string or f-string passed to execute or executemany in the checked modules
+is collected from the source and run through EXPLAIN QUERY PLAN against the
+database. Any step of a plan that scans a whole table, rather than searching it
+using an index, is reported. Formatted values in f-strings are replaced
+with bound parameters before the plan is made.
+
+Statements that have no WHERE clause read the whole of a table by design
+(e.g. the loading of in-memory indexes and the database export) and are not reported.
+Neither are scans of the temporary tables that the code creates to stage its inputs.
+The temporary tables are created on the checking connection so that the statements
+that use them can be planned.
+"""
+
+import ast
+import os
+import re
+import sqlite3
+
+CHECKED_MODULES = ["invoicing.py", "repository.py", "invoice_totals.py", "invoice_documents.py", "rollups.py"]
+
+# Tables whose scans are never a problem.
+IGNORED_TABLES = {"sqlite_master", "sqlite_schema", "sqlite_temp_master"}
+
+
+def collect_queries(source_path):
+    """
+    Returns a list of (line_number, sql) for each execute or executemany call in source_path.
+    """
+    with open(source_path) as f:
+        tree = ast.parse(f.read(), filename=source_path)
+    queries = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in ("execute", "executemany")):
+            continue
+        if not node.args:
+            continue
+        sql = _sql_from_node(node.args[0])
+        if sql is not None:
+            queries.append((node.lineno, sql))
+    return sorted(queries)
+
+
+def _sql_from_node(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        sql_parts = []
+        for i, value in enumerate(node.values):
+            if isinstance(value, ast.Constant):
+                sql_parts.append(value.value)
+            else:
+                sql_parts.append(f":formatted_value_{i}")
+        return "".join(sql_parts)
+    # Statements built in some other way can't be checked statically.
+    return None
+
+
+def find_full_scans(con, sql, ignored_tables=IGNORED_TABLES):
+    """
+    Returns the details of the steps of the query plan for sql that scan a whole table.
+    """
+    con: sqlite3.Connection
+    # Bind every named parameter to NULL. The plan does not depend on the values.
+    params = {name: None for name in re.findall(r":(\w+)", sql)}
+    full_scans = []
+    for row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+        detail = row[-1]
+        match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+        if match and "USING" not in detail and match.group(1) not in ignored_tables:
+            full_scans.append(detail)
+    return full_scans
+
+
+def check_query_plans(con, source_dir=".", modules=CHECKED_MODULES):
+    """
+    Print a report of the queries in modules that scan a whole table.
+    Returns the number of such queries.
+    """
+    queries = [(module, line_number, sql) for module in modules for line_number, sql in collect_queries(os.path.join(source_dir, module))]
+
+    ignored_tables = set(IGNORED_TABLES)
+    for module, line_number, sql in queries:
+        match = re.match(r"\s*CREATE\s+TEMP(?:ORARY)?\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", sql, re.IGNORECASE)
+        if match:
+            con.execute(f"DROP TABLE IF EXISTS temp.{match.group(1)}")
+            con.execute(sql)
+            ignored_tables.add(match.group(1))
+
+    n_checked = 0
+    problems = []
+    for module, line_number, sql in queries:
+        if not re.match(r"\s*(SELECT|UPDATE|DELETE|INSERT)", sql, re.IGNORECASE):
+            continue
+        if not re.search(r"\bWHERE\b", sql, re.IGNORECASE):
+            continue
+        n_checked += 1
+        full_scans = find_full_scans(con, sql, ignored_tables)
+        if full_scans:
+            problems.append((module, line_number, " ".join(sql.split()), full_scans))
+
+    for module, line_number, sql, full_scans in problems:
+        print(f"{module}:{line_number}: {'; '.join(full_scans)}\n\t{sql}")
+    print(f"{n_checked} queries checked. {len(problems)} do a full table scan.")
+    return len(problems)
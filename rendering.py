@@ -0,0 +1,68 @@
+"""
+Rendering of the invoice documents from their populated contexts.
+
+Nothing in this module touches the database so that the rendering
+can be farmed out to a pool of worker processes once all of the
+database work for a run has been done.
+"""
+
+import io
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pdf_rendering import render_pdf
+from template_cache import configure_template_cache, get_template_cache
+
+# The zip entry timestamp written to every document so that the output only depends on the
+# template and the context and not on when or in which process the document was rendered.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def render_document(template_path, context, outpath):
+    """
+    Render context into the template at template_path and save the result to outpath.
+    This is the only place that invoice documents are rendered so that the serial and
+    parallel paths produce the same output.
+    A .pdf outpath is laid out by pdf_rendering and does not use the template.
+    """
+    if outpath.endswith(".pdf"):
+        return render_pdf(context, outpath)
+    template_cache = get_template_cache()
+    doc = template_cache.get(template_path)
+    doc.render(context, template_cache.jinja_env)
+    docx_buffer = io.BytesIO()
+    doc.save(docx_buffer)
+    _write_normalised_docx(docx_buffer, outpath)
+    return outpath
+
+
+def _write_normalised_docx(docx_buffer, outpath):
+    """
+    Rewrite the .docx zip held in docx_buffer to outpath with fixed entry timestamps.
+    """
+    with zipfile.ZipFile(docx_buffer) as source, zipfile.ZipFile(outpath, "w", zipfile.ZIP_DEFLATED) as dest:
+        for info in source.infolist():
+            normalised_info = zipfile.ZipInfo(info.filename, date_time=ZIP_DATE_TIME)
+            normalised_info.compress_type = zipfile.ZIP_DEFLATED
+            normalised_info.external_attr = info.external_attr
+            dest.writestr(normalised_info, source.read(info.filename))
+
+
+def render_documents(render_jobs, workers=1, template_cache_dir=None):
+    """
+    Render a list of (template_path, context, outpath) jobs.
+    If workers is greater than 1 the jobs are rendered using a pool of that many processes.
+    The outpaths are reported in the order of the jobs.
+    If template_cache_dir is given, the compiled templates are kept in this directory between runs.
+    """
+    if template_cache_dir is not None and get_template_cache().jinja_env.cache_dir != template_cache_dir:
+        configure_template_cache(cache_dir=template_cache_dir)
+    if workers > 1 and len(render_jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(render_jobs)), initializer=configure_template_cache, initargs=(template_cache_dir,)
+            ) as executor:
+            futures = [executor.submit(render_document, *render_job) for render_job in render_jobs]
+            for future in futures:
+                print(f"\nWriting {future.result()}.")
+    else:
+        for render_job in render_jobs:
+            print(f"\nWriting {render_document(*render_job)}.")
@@ -0,0 +1,96 @@
+"""
+Loading of the users, projects and invoices of the invoicing database as objects.
+
+A Repository keeps an identity map of each table for its connection so that
+a row is loaded at most once per run and every reference to the row shares
+the same object. Rows are turned into objects by a cursor row_factory and
+every statement is a fixed string with bound parameters so that sqlite3
+reuses its prepared statements rather than compiling a new one per row.
+
+The identity maps must be cleared (see clear) whenever changes to the
+database are rolled back, as the ids of rolled back rows can be reused.
+"""
+
+import sqlite3
+from users import User
+from projects import Project
+from invoices import Invoice
+
+
+class Repository:
+    def __init__(self, con):
+        self.con: sqlite3.Connection
+        self.con = con
+        self._identity_maps = {User: {}, Project: {}, Invoice: {}}
+        self._cursors = {model: self._make_cursor(model) for model in self._identity_maps}
+
+    def _make_cursor(self, model):
+        identity_map = self._identity_maps[model]
+
+        def row_factory(cursor, row):
+            obj = identity_map.get(row[0])
+            if obj is None:
+                obj = identity_map[row[0]] = model(self, row)
+            else:
+                # The row has been read again so bring the shared object up to date
+                obj._load(row)
+            return obj
+
+        cur = self.con.cursor()
+        cur.row_factory = row_factory
+        return cur
+
+    def clear(self):
+        """
+        Forget every loaded object. Objects already handed out are left as they are.
+        """
+        for identity_map in self._identity_maps.values():
+            identity_map.clear()
+
+    def get_user(self, user_id, reload=False):
+        return self._get(User, "SELECT user_id, email, first_name, last_name, staff_subsidy_percent, consumable_subsidy_percent FROM users WHERE user_id=:key", user_id, reload)
+
+    def get_project(self, project_id, reload=False):
+        return self._get(Project, "SELECT project_id, project_type, project_title, user_id FROM projects WHERE project_id=:key", project_id, reload)
+
+    def get_invoice(self, invoice_id, reload=False):
+        """
+        If reload, the invoice is read from the db even if it has already been loaded
+        e.g. because it has been modified with sql since.
+        """
+        return self._get(Invoice, "SELECT invoice_id, invoice_timestamp, first_month, last_month, chargeable_account, user_id, amount_payable, reference_text, sent, paid FROM invoices WHERE invoice_id=:key", invoice_id, reload)
+
+    def _get(self, model, sql, key, reload):
+        if not reload:
+            obj = self._identity_maps[model].get(key)
+            if obj is not None:
+                return obj
+        cur = self._cursors[model]
+        cur.execute(sql, {"key": key})
+        results = cur.fetchall()
+        assert(len(results) == 1), f"Expected one {model.__name__} with id {key} but found {len(results)}"
+        return results[0]
+
+    def get_invoices_of_user(self, user_id):
+        """
+        All of the invoices of a user, ordered by invoice_id, loaded in a single query.
+        """
+        cur = self._cursors[Invoice]
+        cur.execute(
+            "SELECT invoice_id, invoice_timestamp, first_month, last_month, chargeable_account, user_id, amount_payable, reference_text, sent, paid FROM invoices WHERE user_id=:user_id ORDER BY invoice_id ASC",
+            {"user_id": user_id}
+            )
+        return cur.fetchall()
+
+    def get_credit_balance(self, user_id):
+        """
+        Returns the (total_credit, total_debit) of the user from the user_credit_balances ledger
+        or None if the user has no entry.
+        """
+        return self.con.execute("SELECT total_credit, total_debit FROM user_credit_balances WHERE user_id=:user_id", {"user_id": user_id}).fetchone()
+
+    def get_consumable_charges(self, invoice_id):
+        return self.con.execute("SELECT charge_id, unit_cost, quantity, subsidy_percent FROM consumable_charges WHERE invoice_id=:invoice_id", {"invoice_id": invoice_id}).fetchall()
+
+    def set_invoice_amount_payable(self, invoice_id, amount):
+        self.con.execute("UPDATE invoices SET amount_payable=:amount WHERE invoice_id=:invoice_id", {"amount": amount, "invoice_id": invoice_id})
@@ -0,0 +1,161 @@
+"""
+The monthly_rollups table behind the report subcommand.
+
+The charges and invoices of each month are rolled up at (month, user_id, project_type)
+grain so that the finance reports (outstanding balances, revenue and subsidies per
+month by project type and invoice aging) are read from a small table rather than
+joined across the whole history. The month of a row is the first_month of the
+invoices it rolls up.
+
+The staff and consumable charges are rolled up by the project_type of their project.
+The amounts that belong to an invoice as a whole (the amount payable after credit,
+the credit applied and the unsent, outstanding and paid amounts) can't be split
+between project types and are rolled up in rows whose project_type is the
+invoice_type of the invoices: 'debit' or 'credit'.
+
+The table is created and populated from the existing history by migration 5 (see
+migrations.py). After that each run refreshes only the months of the invoices it
+has changed, in the same transaction as its changes, with refresh_rollups.
+"""
+
+import datetime
+import sqlite3
+
+INVOICE_TYPES = ["debit", "credit"]
+
+# The (label, first day, last day) of the invoice aging buckets. The last bucket is open ended
+AGING_BUCKETS = [("0_30_days", 0, 30), ("31_60_days", 31, 60), ("61_90_days", 61, 90), ("over_90_days", 91, None)]
+
+# The month range of a report when none is given
+FIRST_MONTH = "000000"
+LAST_MONTH = "999999"
+
+
+def refresh_rollups(con, months):
+    """
+    Recompute the rows of monthly_rollups of each of months from the invoices whose first_month it is.
+    Must be called inside a transaction.
+    """
+    con: sqlite3.Connection
+    con.execute("CREATE TEMP TABLE rollup_months (month TEXT PRIMARY KEY)")
+    try:
+        con.executemany("INSERT INTO rollup_months (month) VALUES (:month)", [{"month": str(_)} for _ in set(months)])
+        con.execute("DELETE FROM monthly_rollups WHERE month IN (SELECT month FROM rollup_months)")
+        # The charges, by the project_type of their project
+        con.execute(
+            "INSERT INTO monthly_rollups (month, user_id, project_type, staff_hours, staff_cost, staff_subsidy, consumables_cost, consumables_subsidy) \
+                SELECT month, user_id, project_type, SUM(staff_hours), SUM(staff_cost), SUM(staff_subsidy), SUM(consumables_cost), SUM(consumables_subsidy) FROM ( \
+                    SELECT invoices.first_month AS month, invoices.user_id AS user_id, projects.project_type AS project_type, \
+                        staff_hours, staff_hours * staff_hourly_rate_eur AS staff_cost, \
+                        staff_hours * staff_hourly_rate_eur * staff_time_charges.subsidy_percent / 100 AS staff_subsidy, \
+                        0 AS consumables_cost, 0 AS consumables_subsidy \
+                        FROM rollup_months INNER JOIN invoices INNER JOIN staff_time_charges ON staff_time_charges.invoice_id = invoices.invoice_id \
+                            INNER JOIN projects ON projects.project_id = staff_time_charges.project_id \
+                                WHERE invoices.invoice_type = 'debit' AND invoices.first_month = rollup_months.month \
+                    UNION ALL \
+                    SELECT invoices.first_month AS month, invoices.user_id AS user_id, projects.project_type AS project_type, \
+                        0 AS staff_hours, 0 AS staff_cost, 0 AS staff_subsidy, unit_cost * quantity AS consumables_cost, \
+                        unit_cost * quantity * consumable_charges.subsidy_percent / 100 AS consumables_subsidy \
+                        FROM rollup_months INNER JOIN invoices INNER JOIN consumable_charges ON consumable_charges.invoice_id = invoices.invoice_id \
+                            INNER JOIN projects ON projects.project_id = consumable_charges.project_id \
+                                WHERE invoices.invoice_type = 'debit' AND invoices.first_month = rollup_months.month \
+                    ) GROUP BY month, user_id, project_type"
+            )
+        # The invoices as a whole, by invoice_type. An invoice can only be paid once it has been sent
+        con.execute(
+            "INSERT INTO monthly_rollups (month, user_id, project_type, invoice_count, amount_payable, credit_applied, \
+                amount_unsent, amount_outstanding, amount_paid, outstanding_since) \
+                SELECT invoices.first_month, invoices.user_id, invoices.invoice_type, COUNT(*), SUM(amount_payable), \
+                    SUM((SELECT IFNULL(SUM(amount), 0) FROM credit_debit WHERE credit_debit.debit_invoice_id = invoices.invoice_id)), \
+                    SUM(CASE WHEN sent = 0 THEN amount_payable ELSE 0 END), \
+                    SUM(CASE WHEN sent = 1 AND paid = 0 THEN amount_payable ELSE 0 END), \
+                    SUM(CASE WHEN paid = 1 THEN amount_payable ELSE 0 END), \
+                    MIN(CASE WHEN sent = 1 AND paid = 0 THEN invoice_timestamp END) \
+                    FROM rollup_months INNER JOIN invoices \
+                        WHERE invoices.invoice_type IN ('debit', 'credit') AND invoices.first_month = rollup_months.month \
+                            GROUP BY invoices.first_month, invoices.user_id, invoices.invoice_type"
+            )
+    finally:
+        con.execute("DROP TABLE temp.rollup_months")
+
+
+def rebuild_rollups(con):
+    """
+    Recompute the whole of monthly_rollups from the history. Must be called inside a transaction.
+    """
+    months = [_[0] for _ in con.execute("SELECT DISTINCT first_month FROM invoices").fetchall()]
+    con.execute("DELETE FROM monthly_rollups")
+    refresh_rollups(con, months)
+
+
+def outstanding_balances(con, first_month=FIRST_MONTH, last_month=LAST_MONTH):
+    """
+    Returns a list of (user_id, last_name, email, unsent, outstanding, available_credit) for each user
+    with an unsent or outstanding (sent but not paid) amount in the months.
+    available_credit is the user's current prepaid credit from the user_credit_balances ledger.
+    """
+    return con.execute(
+        "SELECT users.user_id, users.last_name, users.email, SUM(amount_unsent), SUM(amount_outstanding), \
+            IFNULL(user_credit_balances.total_credit - user_credit_balances.total_debit, 0) \
+            FROM monthly_rollups INNER JOIN users ON users.user_id = monthly_rollups.user_id \
+                LEFT JOIN user_credit_balances ON user_credit_balances.user_id = monthly_rollups.user_id \
+                    WHERE monthly_rollups.month BETWEEN :first_month AND :last_month AND monthly_rollups.project_type IN ('debit', 'credit') \
+                        GROUP BY users.user_id HAVING SUM(amount_unsent) != 0 OR SUM(amount_outstanding) != 0 \
+                            ORDER BY users.last_name",
+        {"first_month": first_month, "last_month": last_month}
+        ).fetchall()
+
+
+def revenue_by_month(con, first_month=FIRST_MONTH, last_month=LAST_MONTH):
+    """
+    Returns a list of (month, project_type, staff_hours, staff_cost, staff_subsidy, consumables_cost,
+    consumables_subsidy, net) for each month and project type. net is the cost less the subsidies.
+    """
+    return con.execute(
+        "SELECT month, project_type, SUM(staff_hours), SUM(staff_cost), SUM(staff_subsidy), SUM(consumables_cost), SUM(consumables_subsidy), \
+            SUM(staff_cost - staff_subsidy + consumables_cost - consumables_subsidy) \
+            FROM monthly_rollups WHERE month BETWEEN :first_month AND :last_month AND project_type NOT IN ('debit', 'credit') \
+                GROUP BY month, project_type ORDER BY month, project_type",
+        {"first_month": first_month, "last_month": last_month}
+        ).fetchall()
+
+
+def subsidy_totals(con, first_month=FIRST_MONTH, last_month=LAST_MONTH):
+    """
+    Returns a list of (project_type, staff_subsidy, consumables_subsidy, total_subsidy) for each project type over the months.
+    """
+    return con.execute(
+        "SELECT project_type, SUM(staff_subsidy), SUM(consumables_subsidy), SUM(staff_subsidy + consumables_subsidy) \
+            FROM monthly_rollups WHERE month BETWEEN :first_month AND :last_month AND project_type NOT IN ('debit', 'credit') \
+                GROUP BY project_type ORDER BY project_type",
+        {"first_month": first_month, "last_month": last_month}
+        ).fetchall()
+
+
+def invoice_aging(con, as_of, first_month=FIRST_MONTH, last_month=LAST_MONTH):
+    """
+    Returns a list of (user_id, last_name, email, amount in each of AGING_BUCKETS..., total) of the outstanding
+    (sent but not paid) amounts of each user, aged from the invoice_timestamp to the date as_of.
+    The invoices of a user, month and invoice_type are aged together from the oldest of them.
+    """
+    rows = con.execute(
+        "SELECT users.user_id, users.last_name, users.email, amount_outstanding, outstanding_since \
+            FROM monthly_rollups INNER JOIN users ON users.user_id = monthly_rollups.user_id \
+                WHERE monthly_rollups.month BETWEEN :first_month AND :last_month AND monthly_rollups.project_type IN ('debit', 'credit') \
+                    AND amount_outstanding != 0 ORDER BY users.last_name",
+        {"first_month": first_month, "last_month": last_month}
+        ).fetchall()
+    aging = {}
+    for user_id, last_name, email, amount_outstanding, outstanding_since in rows:
+        if user_id not in aging:
+            aging[user_id] = [user_id, last_name, email] + [0.0] * (len(AGING_BUCKETS) + 1)
+        age = (as_of - datetime.date.fromisoformat(str(outstanding_since)[:10])).days
+        for i, (label, first_day, last_day) in enumerate(AGING_BUCKETS):
+            if age >= first_day and (last_day is None or age <= last_day):
+                aging[user_id][3 + i] += amount_outstanding
+                break
+        else:
+            # Invoices dated after as_of are not yet due
+            aging[user_id][3] += amount_outstanding
+        aging[user_id][-1] += amount_outstanding
+    return [tuple(_) for _ in aging.values()]
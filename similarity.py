@@ -0,0 +1,128 @@
+"""
+Indexed approximate matching of names (e.g. user last names and project titles).
+
+NameIndex finds the same close matches as difflib.get_close_matches, with the same
+scores and cutoff, without comparing a name against every other name.
+Candidates are generated from an index of the q-grams of the names and only
+candidates that could reach the cutoff are scored with difflib.SequenceMatcher.
+
+Two filters are used, neither of which can drop a true match:
+- Length: SequenceMatcher's ratio can't exceed 2*min(len_a, len_b)/(len_a + len_b).
+- Shared q-grams: a ratio >= cutoff means that at least m = ceil(cutoff*(len_a + len_b)/2)
+  characters of the names match. Turning a into b then deletes at most len_a - m characters
+  of a, each destroying at most q of its q-grams, and inserts at most len_b - m characters,
+  each destroying at most q - 1. So the names must share at least
+  len_a - q + 1 - q*(len_a - m) - (q - 1)*(len_b - m) q-grams (and likewise with a and b swapped).
+  When this bound is not positive (short names) every name of a compatible length is a candidate.
+  With the default cutoff of 0.8 the bound is only ever positive for bigrams, hence Q = 2.
+"""
+
+import heapq
+import math
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+CUTOFF = 0.8
+Q = 2
+
+
+class NameIndex:
+    def __init__(self, names=(), q=Q):
+        self.q = q
+        # q-gram to {name: number of times the q-gram occurs in the name}
+        self._postings = defaultdict(dict)
+        # length to set of names of that length
+        self._names_by_length = defaultdict(set)
+        self._names = set()
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        if name in self._names:
+            return
+        self._names.add(name)
+        self._names_by_length[len(name)].add(name)
+        for gram, count in self._grams(name).items():
+            self._postings[gram][name] = count
+
+    def _grams(self, name):
+        return Counter(name[i:i + self.q] for i in range(len(name) - self.q + 1))
+
+    def _min_shared_grams(self, len_a, len_b, cutoff):
+        q = self.q
+        min_matched = math.ceil(cutoff * (len_a + len_b) / 2 - 1e-9)
+        return max(
+            len_a - q + 1 - q * (len_a - min_matched) - (q - 1) * (len_b - min_matched),
+            len_b - q + 1 - q * (len_b - min_matched) - (q - 1) * (len_a - min_matched)
+            )
+
+    def _candidates(self, name, cutoff):
+        len_a = len(name)
+        # The lengths for which 2*min(len_a, len_b)/(len_a + len_b) >= cutoff
+        min_length = math.ceil(len_a * cutoff / (2 - cutoff) - 1e-9)
+        max_length = math.floor(len_a * (2 - cutoff) / cutoff + 1e-9) if cutoff > 0 else max(self._names_by_length, default=0)
+        lengths = [_ for _ in self._names_by_length if min_length <= _ <= max_length]
+
+        candidates = set()
+        for len_b in lengths:
+            if self._min_shared_grams(len_a, len_b, cutoff) <= 0:
+                candidates.update(self._names_by_length[len_b])
+
+        shared = Counter()
+        for gram, count in self._grams(name).items():
+            for other, other_count in self._postings.get(gram, {}).items():
+                shared[other] += min(count, other_count)
+        for other, n_shared in shared.items():
+            if min_length <= len(other) <= max_length and n_shared >= self._min_shared_grams(len_a, len(other), cutoff):
+                candidates.add(other)
+        candidates.discard(name)
+        return candidates
+
+    def close_matches(self, name, n=99, cutoff=CUTOFF):
+        """
+        The names of the index, other than name itself, that are close to name.
+        Returns the same as difflib.get_close_matches(name, names, n, cutoff) where names
+        are all of the names of the index other than name.
+        """
+        return [_ for score, _ in self.scored_close_matches(name, n=n, cutoff=cutoff)]
+
+    def scored_close_matches(self, name, n=99, cutoff=CUTOFF):
+        """
+        As for close_matches but returns a list of (score, name) best first.
+        """
+        result = []
+        s = SequenceMatcher()
+        s.set_seq2(name)
+        for other in self._candidates(name, cutoff):
+            s.set_seq1(other)
+            if s.real_quick_ratio() >= cutoff and s.quick_ratio() >= cutoff and s.ratio() >= cutoff:
+                result.append((s.ratio(), other))
+        return heapq.nlargest(n, result)
+
+
+def find_similar_names(names, known_names=(), n=99, cutoff=CUTOFF):
+    """
+    For each of names, the other names and the known_names that are close to it.
+    known_names (e.g. the names already in the db) are only compared against the names
+    that are not known already, so that a known name that is used again is not reported
+    for the names it was already similar to.
+    Returns a dict of name to its close matches, best first, for the names that have any.
+    """
+    names = list(dict.fromkeys(names))
+    name_index = NameIndex(names)
+    known_index = NameIndex(known_names)
+    similar = {}
+    for name in names:
+        scored = name_index.scored_close_matches(name, n=n, cutoff=cutoff)
+        if name not in known_index:
+            scored_names = {_ for score, _ in scored}
+            scored.extend(_ for _ in known_index.scored_close_matches(name, n=n, cutoff=cutoff) if _[1] not in scored_names)
+        if scored:
+            similar[name] = [_ for score, _ in heapq.nlargest(n, scored)]
+    return similar
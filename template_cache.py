@@ -0,0 +1,170 @@
+"""
+Cache of the parsed and compiled docxtpl invoice templates.
+
+Templates are keyed by the sha256 of their content so that a template is only
+read, parsed, patched and compiled once per process however many invoices are
+rendered from it. Each render is handed its own DocxTemplate holding a copy of the
+parsed template in which only the parts that rendering changes (the main document,
+the core properties and the footnotes) are copied. The other parts, e.g. the styles,
+are shared with the cached template.
+Optionally, the compiled jinja code is also kept in a directory on disk so that
+later runs can skip compiling the template altogether.
+"""
+
+import copy
+import hashlib
+import io
+import marshal
+import os
+import sys
+import docxtpl
+import jinja2
+from docx import Document
+from docxtpl import DocxTemplate
+from jinja2 import Environment
+
+# The content types of the parts of a template that docxtpl changes when it renders
+RENDERED_CONTENT_TYPES = {
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml",
+    "application/vnd.ms-word.document.macroEnabled.main+xml",
+    "application/vnd.ms-word.template.macroEnabledTemplate.main+xml",
+    "application/vnd.openxmlformats-package.core-properties+xml",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml",
+}
+
+
+class CachingEnvironment(Environment):
+    """
+    Jinja environment that compiles each template source only once.
+    docxtpl calls from_string for the body, headers and footers of every render
+    so the compiled templates are looked up by the sha256 of their source.
+    """
+    def __init__(self, cache_dir=None):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self._compiled_templates = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        if globals is None and template_class is None and key in self._compiled_templates:
+            return self._compiled_templates[key]
+        template = (template_class or self.template_class).from_code(
+            self, self._get_code(source, key), self.make_globals(globals), None
+            )
+        if globals is None and template_class is None:
+            self._compiled_templates[key] = template
+        return template
+
+    def _get_code(self, source, key):
+        """
+        Get the compiled code for source, from the disk cache if possible.
+        The marshal format is specific to the python version and the compiled code to the jinja2
+        version (and the source to the docxtpl version that patched it) so these form part of the file name.
+        """
+        if self.cache_dir is None:
+            return self.compile(source)
+        code_path = os.path.join(
+            self.cache_dir, f"{key}.{sys.implementation.cache_tag}.jinja2-{jinja2.__version__}.docxtpl-{docxtpl.__version__}.jinja"
+            )
+        if os.path.exists(code_path):
+            with open(code_path, "rb") as f:
+                try:
+                    return marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    # A partially written or otherwise unreadable entry. Recompile it.
+                    pass
+        code = self.compile(source)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_code_path = f"{code_path}.{os.getpid()}.tmp"
+        with open(tmp_code_path, "wb") as f:
+            marshal.dump(code, f)
+        os.replace(tmp_code_path, code_path)
+        return code
+
+
+class CachedDocxTemplate(DocxTemplate):
+    """
+    DocxTemplate that is rendered from a copy of the parsed template and that shares the
+    result of patch_xml between all of the renders of the same template.
+    """
+    def __init__(self, template_file, document, patched_xml):
+        super().__init__(template_file)
+        self._document = document
+        self._patched_xml = patched_xml
+
+    def init_docx(self, reload=True):
+        if not self.docx or (self.is_rendered and reload):
+            self.docx = copy_document(self._document)
+            self.is_rendered = False
+
+    def patch_xml(self, src_xml):
+        if src_xml not in self._patched_xml:
+            self._patched_xml[src_xml] = super().patch_xml(src_xml)
+        return self._patched_xml[src_xml]
+
+
+class TemplateCache:
+    def __init__(self, cache_dir=None):
+        self.jinja_env = CachingEnvironment(cache_dir=cache_dir)
+        # template content hash to template bytes
+        self._template_bytes = {}
+        # template content hash to the dict of patched xml shared by its CachedDocxTemplates
+        self._patched_xml = {}
+        # template content hash to the parsed template. It is only parsed once it is rendered
+        self._documents = {}
+        # (template path, mtime, size) to template content hash
+        self._path_hashes = {}
+
+    def template_hash(self, template_path):
+        """
+        The sha256 of the template content.
+        The template is only re-read if its modification time or size has changed.
+        """
+        stat = os.stat(template_path)
+        path_key = (os.path.abspath(template_path), stat.st_mtime_ns, stat.st_size)
+        if path_key not in self._path_hashes:
+            with open(template_path, "rb") as f:
+                template_bytes = f.read()
+            template_hash = hashlib.sha256(template_bytes).hexdigest()
+            self._template_bytes.setdefault(template_hash, template_bytes)
+            self._patched_xml.setdefault(template_hash, {})
+            self._path_hashes[path_key] = template_hash
+        return self._path_hashes[path_key]
+
+    def get(self, template_path):
+        """
+        Get a fresh DocxTemplate for template_path that is ready to be rendered.
+        """
+        template_hash = self.template_hash(template_path)
+        if template_hash not in self._documents:
+            self._documents[template_hash] = Document(io.BytesIO(self._template_bytes[template_hash]))
+        return CachedDocxTemplate(
+            io.BytesIO(self._template_bytes[template_hash]), self._documents[template_hash], self._patched_xml[template_hash]
+            )
+
+
+def copy_document(document):
+    """
+    A copy of the parsed document in which the parts that rendering changes are copied
+    and all of the other parts are shared with document.
+    """
+    unchanged_parts = {id(_): _ for _ in document.part.package.iter_parts() if _.content_type not in RENDERED_CONTENT_TYPES}
+    return copy.deepcopy(document, unchanged_parts)
+
+
+# The cache used by the current process.
+_template_cache = TemplateCache()
+
+
+def configure_template_cache(cache_dir=None):
+    """
+    Replace the cache used by the current process. Used to set the on disk cache directory,
+    including as the initializer of rendering worker processes.
+    """
+    global _template_cache
+    _template_cache = TemplateCache(cache_dir=cache_dir)
+
+
+def get_template_cache():
+    return _template_cache
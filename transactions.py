@@ -0,0 +1,82 @@
+"""
+Transaction management for the invoicing subcommands.
+
+A subcommand runs inside a single transaction so that a run either
+completes in full or leaves the database untouched. Each unit of work
+within the run (e.g. a user being invoiced) runs inside its own SAVEPOINT.
+For very long runs, the transaction can optionally be committed
+after every N units of work. The caller commits with commit() once
+commit_due() so that it can do the work that belongs with the units
+(e.g. totalling their invoices) first and the work that must only follow
+a commit (e.g. writing their documents) after.
+"""
+
+import sqlite3
+from contextlib import contextmanager
+
+
+class RunTransaction:
+    def __init__(self, con, commit_every=None, on_rollback=None):
+        """
+        con must have been opened with isolation_level=None so that
+        the transaction boundaries are controlled explicitly here.
+        on_rollback, if given, is called after any changes have been rolled back
+        (e.g. to discard objects loaded from rows that no longer exist).
+        """
+        self.con: sqlite3.Connection
+        self.con = con
+        self.commit_every = commit_every
+        self.on_rollback = on_rollback
+        # The units of work completed since the last commit
+        self.units_completed = 0
+
+    def __enter__(self):
+        self.con.execute("BEGIN")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.con.execute("COMMIT")
+        elif self.con.in_transaction:
+            self.con.execute("ROLLBACK")
+            self._rolled_back()
+            print("\nThe run did not complete. All uncommitted changes to the database have been rolled back.")
+        return False
+
+    @contextmanager
+    def savepoint(self, count=True):
+        """
+        Run a unit of work inside a savepoint.
+        If the unit of work raises, its changes are rolled back before the exception is propagated.
+        Only savepoints with count=True are units of work for commit_every. Pass count=False for
+        the savepoints of steps that aren't a user, e.g. those of the consumable charges.
+        """
+        self.con.execute("SAVEPOINT unit_of_work")
+        try:
+            yield
+        except BaseException:
+            self.con.execute("ROLLBACK TO unit_of_work")
+            self.con.execute("RELEASE unit_of_work")
+            self._rolled_back()
+            raise
+        self.con.execute("RELEASE unit_of_work")
+        if count:
+            self.units_completed += 1
+
+    def commit_due(self):
+        """
+        True if commit_every units of work have been completed since the last commit.
+        """
+        return bool(self.commit_every) and self.units_completed >= self.commit_every
+
+    def commit(self):
+        """
+        Commit the changes so far and begin a new transaction for the rest of the run.
+        """
+        self.con.execute("COMMIT")
+        self.con.execute("BEGIN")
+        self.units_completed = 0
+
+    def _rolled_back(self):
+        if self.on_rollback is not None:
+            self.on_rollback()
@@ -1,52 +1,39 @@
 """
 Class representation of te users table from the dadtabase.
+Users are loaded through a repository.Repository so that each row is only loaded once per run.
 """
 
-import sqlite3
-from invoices import Invoice
-import sys
-
 class User:
-    def __init__(self, user_id, con):
-        self.con: sqlite3.Connection
-        self.con = con
-
-        self.cur = self.con.cursor()
-        self._user_id = user_id
-        self.cur.execute(
-            f"select email, first_name, last_name, \
-            staff_subsidy_percent, consumable_subsidy_percent \
-            from users where user_id={self._user_id}"
-            )
-        results = self.cur.fetchall()
-        assert(len(results) == 1)
+    __slots__ = (
+        "_repository", "_user_id", "_email", "_first_name", "_last_name",
+        "_staff_subsidy_percent", "_consumable_subsidy_percent", "_invoices"
+        )
+
+    def __init__(self, repository, row):
+        self._repository = repository
+        self._load(row)
+        # The user's invoices are only loaded when first accessed
+        self._invoices = None
+
+    def _load(self, row):
         (
-            self._email, self._first_name, self._last_name,
+            self._user_id, self._email, self._first_name, self._last_name,
             self._staff_subsidy_percent, self._consumable_subsidy_percent
-            ) = results[0]
-
-        self._invoices = self._get_ordered_list_of_invoices()
+            ) = row
 
     @property
     def available_credit(self):
         """
         The credit available to a user is simply the sum of their paid credit invoices
         with the sum of the credit_debit objects subtracted.
+        Both sums are maintained in the user_credit_balances ledger by triggers (see migrations.py).
+        The ledger changes as credit is applied so it is read on every access.
         """
-        self.cur.execute("select sum(amount_payable) from invoices where user_id=:user_id and invoice_type='credit' and sent=:sent and paid=:paid", {"user_id":self._user_id, "sent":True, "paid":True})
-        sum_result = self.cur.fetchone()[0]
-        if sum_result is None:
+        result = self._repository.get_credit_balance(self._user_id)
+        if result is None or result[0] == 0:
             return 0.00
-        else:
-            total_credit = float(sum_result)
-        
-        self.cur.execute("select sum(amount) from credit_debit where user_id=:user_id", {"user_id":self._user_id})
-        sum_result = self.cur.fetchone()[0]
-        if sum_result is None:
-            return total_credit
-        else:
-            total_debit = float(sum_result)
-            return total_credit - total_debit
+        total_credit, total_debit = result
+        return float(total_credit) - float(total_debit)
 
     @property
     def user_id(self):
@@ -54,11 +41,17 @@ class User:
 
     @property
     def invoices(self):
-        return self._get_ordered_list_of_invoices()
+        """
+        The user's invoices ordered by invoice_id.
+        They are loaded in a single query on first access and reused for the rest of the run.
+        """
+        if self._invoices is None:
+            self._invoices = self._repository.get_invoices_of_user(self._user_id)
+        return self._invoices
 
     @property
     def sent_invoices(self):
-        return self._get_ordered_list_of_sent_invoices()
+        return [_ for _ in self.invoices if _.sent]
 
     @property
     def staff_subsidy_percent(self):
@@ -79,21 +72,3 @@ class User:
     @property
     def email(self):
         return self._email
-
-    def _get_ordered_list_of_invoices(self):
-        self.cur.execute(f"select invoice_id from invoices where user_id = {self._user_id} order by invoice_id asc")
-        results = self.cur.fetchall()
-        if len(results) == 0:
-            return []
-        else:
-            return [Invoice(int(_[0]), self.con) for _ in results]
-
-    def _get_ordered_list_of_sent_invoices(self):
-        self.cur.execute(f"select invoice_id from invoices where user_id = {self._user_id} and sent = 1 order by invoice_id asc")
-        results = self.cur.fetchall()
-        if len(results) == 0:
-            return []
-        else:
-            return [Invoice(int(_[0]), self.con) for _ in results]
-
-    
\ No newline at end of file